@@ -0,0 +1,342 @@
+"""
+End to end benchmark suite for footwm.
+
+Starts a private Xvfb server and runs footwm, footkeys and the footrun daemon against it, each as their own process.
+Synthetic client windows are then created, activated, switched between desktops and closed while the time for the
+window manager to act is measured from the client side. eg,
+
+$ footbench suite --output results.json --baseline baseline.json
+
+Results are p50/p99 latencies (in milliseconds) per operation per window count. See compare for regression checks.
+footbench also adds the per operation cost of the operations that must not depend on the window count, measured
+against the fake server at a small and large window count. See flatrows.
+
+Copyright (c) 2016 Akce
+"""
+
+# Python standard modules.
+import ctypes
+import functools
+import json
+import math
+import os
+import platform
+import select
+import subprocess
+import sys
+import tempfile
+import time
+
+# Local modules.
+from . import clientcmd
+from . import display
+from . import log as logger
+from . import window
+from . import xlib
+
+log = logger.make(name=__name__)
+
+# Operations measured, in run order.
+operations = ['map', 'focus', 'desktop', 'close']
+# Flat cost operations regress when they're this many times slower at the largest window count than the smallest.
+# An operation that loops over every window is about 10 times slower at footbench's default 300 and 3000 windows.
+maxratio = 3.0
+
+class BenchError(Exception):
+    """ Benchmark environment failed to start, or the window manager failed to respond in time. """
+    pass
+
+def percentile(samples, pct):
+    """ Nearest rank percentile. """
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarise(samples):
+    """ Summarise a list of latencies (seconds) as milliseconds. """
+    return {
+            'count': len(samples),
+            'p50': percentile(samples, 50) * 1000,
+            'p99': percentile(samples, 99) * 1000,
+            }
+
+class Session:
+    """ Xvfb plus the footwm processes. Use as a context manager so that everything is cleaned up. """
+
+    def __init__(self, displayname, startuptimeout=10):
+        self.displayname = displayname
+        self.startuptimeout = startuptimeout
+        self._procs = []
+        self._tmpdir = tempfile.TemporaryDirectory(prefix='footbench')
+
+    def __enter__(self):
+        try:
+            self._start()
+        except:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _spawn(self, name, cmdline, env=None):
+        log.debug('%s: starting %s', name, cmdline)
+        logfile = open(os.path.join(self._tmpdir.name, '{}.log'.format(name)), 'w')
+        try:
+            proc = subprocess.Popen(cmdline, env=env, stdout=logfile, stderr=subprocess.STDOUT, cwd=self._tmpdir.name)
+        except FileNotFoundError:
+            logfile.close()
+            raise BenchError('{} not found. Is it installed?'.format(cmdline[0]))
+        self._procs.append((name, proc, logfile))
+        return proc
+
+    def _start(self):
+        self._spawn('Xvfb', ['Xvfb', self.displayname, '-screen', '0', '1920x1080x24', '-nolisten', 'tcp'])
+        self.display = self._connect()
+        self.root = window.ClientRoot(self.display, self.display.defaultrootwindow)
+        env = dict(os.environ)
+        env['DISPLAY'] = self.displayname
+        # Run footwm from the same tree as this module.
+        pkgdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(p for p in [pkgdir, env.get('PYTHONPATH')] if p)
+        python = [sys.executable, '-c']
+        self._spawn('footwm', python + ['from footwm import footwm; footwm.main()'], env=env)
+        self._waitforwm()
+        # Use the sample key config so that results don't depend on the users own config.
+        keysargs = ['--display', self.displayname, '--configfile', os.path.join(pkgdir, 'footwm', 'footkeysconfig.py'), '--pidfile', os.path.join(self._tmpdir.name, 'footkeys.pid'), 'start']
+        self._spawn('footkeys', python + ['import sys; from footwm import footkeys; sys.argv[1:] = {!r}; footkeys.main()'.format(keysargs)], env=env)
+        runargs = ['daemon', '--sockname', os.path.join(self._tmpdir.name, 'run.sock'), 'start']
+        self._spawn('footrun', python + ['import sys; from footwm import footrun; sys.argv[1:] = {!r}; footrun.main()'.format(runargs)], env=env)
+        self.checkrunning()
+
+    def _connect(self):
+        """ Connect to the Xvfb server, waiting for it to start. """
+        deadline = time.monotonic() + self.startuptimeout
+        while True:
+            try:
+                return display.Display(self.displayname)
+            except display.DisplayError:
+                if time.monotonic() > deadline:
+                    raise BenchError('Xvfb did not start on {}'.format(self.displayname))
+                self.checkrunning()
+                time.sleep(0.05)
+
+    def _waitforwm(self):
+        """ Wait until footwm has installed itself. ie, _NET_SUPPORTING_WM_CHECK has been set on the root window. """
+        deadline = time.monotonic() + self.startuptimeout
+        while self.display.getpropertywindowid(self.root, '_NET_SUPPORTING_WM_CHECK') is None:
+            if time.monotonic() > deadline:
+                raise BenchError('footwm did not start')
+            self.checkrunning()
+            time.sleep(0.05)
+
+    def checkrunning(self):
+        for name, proc, _ in self._procs:
+            if proc.poll() is not None:
+                raise BenchError('{} exited with status {}. See {}.log'.format(name, proc.returncode, name))
+
+    def stop(self):
+        # Stop in reverse start order, Xvfb last.
+        for name, proc, logfile in reversed(self._procs):
+            if proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            logfile.close()
+        self._procs = []
+        self._tmpdir.cleanup()
+
+class SyntheticWindow:
+    """ A client window, as far as the window manager can tell. """
+
+    def __init__(self, client, name):
+        dobj = client.display
+        self.display = dobj
+        self.name = name
+        self.window = dobj.createsimplewindow(client.root, 0, 0, 100, 100, 0, 0, 0)
+        dobj.selectinput(self, xlib.InputEventMask.StructureNotify | xlib.InputEventMask.FocusChange | xlib.InputEventMask.PropertyChange)
+        wmclass = '{}\0Footbench\0'.format(name).encode('latin1')
+        dobj.changeproperty(self, 'WM_CLASS', xlib.XA.STRING, 8, xlib.PropMode.Replace, ctypes.c_char_p(wmclass), len(wmclass))
+        dobj.settextproperty(self, [name], 'WM_NAME')
+        # Passive input model. See ICCCM 4.1.7
+        hints = xlib.WMHints()
+        hints.flags = xlib.HintsFlags.Input
+        hints.input_ = True
+        dobj.changeproperty(self, 'WM_HINTS', dobj.atom['WM_HINTS'], 32, xlib.PropMode.Replace, ctypes.byref(hints), ctypes.sizeof(hints) // ctypes.sizeof(ctypes.c_long))
+        protocols = (xlib.Atom * 1)(dobj.atom['WM_DELETE_WINDOW'])
+        dobj.changeproperty(self, 'WM_PROTOCOLS', xlib.XA.ATOM, 32, xlib.PropMode.Replace, protocols, 1)
+
+class Client:
+    """ Synthetic X clients. All windows share the one Xlib connection. """
+
+    def __init__(self, root, timeout):
+        self.display = root.display
+        self.root = root
+        self.command = clientcmd.ClientCommand(root)
+        self.timeout = timeout
+        self.display.selectinput(root, xlib.InputEventMask.PropertyChange)
+        # Intern up front so that atom round trips aren't included in the measurements.
+        self.display.add_atoms(['_NET_CLIENT_LIST', '_NET_ACTIVE_WINDOW', '_NET_CURRENT_DESKTOP', '_NET_DESKTOP_NAMES', '_NET_CLOSE_WINDOW', '_NET_WM_DESKTOP', 'WM_HINTS'])
+        self.display.atom.intern()
+
+    def waitfor(self, predicate, what):
+        """ Process client events until predicate(event) is True. Raises BenchError on timeout. """
+        deadline = time.monotonic() + self.timeout
+        self.display.flush()
+        while True:
+            while self.display.pendingevents:
+                event = self.display.nextevent
+                self._handle(event)
+                if predicate(event):
+                    return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BenchError('Timed out waiting for {}'.format(what))
+            select.select([self.display], [], [], remaining)
+
+    def _handle(self, event):
+        """ Act like a well behaved client. ie, destroy windows when the window manager asks us to close them. """
+        if event.type == xlib.EventName.ClientMessage and event.xclient.message_type == self.display.atom['WM_PROTOCOLS']:
+            if event.xclient.data.l[0] == self.display.atom['WM_DELETE_WINDOW']:
+                self.display.destroywindow(event.xclient.window)
+                self.display.flush()
+
+    def timed(self, func, predicate, what):
+        start = time.perf_counter()
+        func()
+        self.waitfor(predicate, what)
+        return time.perf_counter() - start
+
+    def rootproperty(self, propname):
+        """ Predicate for a root window property change. """
+        atom = self.display.atom[propname]
+        def predicate(e):
+            return e.type == xlib.EventName.PropertyNotify and e.xproperty.window == self.root.window and e.xproperty.atom == atom
+        return predicate
+
+def windowevent(eventtype, field, win):
+    """ Predicate for an event on the window. field is the XEvent union member, eg 'xmap'. """
+    def predicate(e):
+        return e.type == eventtype and getattr(e, field).window == win.window
+    return predicate
+
+def measure(client, count, switches):
+    """ Run each operation against count windows. Returns dict(operation -> [seconds]). """
+    samples = {op: [] for op in operations}
+    # map: MapRequest through to the window manager mapping the window.
+    windows = []
+    for i in range(count):
+        win = SyntheticWindow(client, 'bench{}'.format(i))
+        samples['map'].append(client.timed(lambda: client.display.mapwindow(win), windowevent(xlib.EventName.MapNotify, 'xmap', win), 'map'))
+        windows.append(win)
+    # focus: _NET_ACTIVE_WINDOW request through to the window receiving focus.
+    # Activate oldest first, so the requested window is never the one that already has focus.
+    for win in windows[:-1] if count > 1 else []:
+        samples['focus'].append(client.timed(functools.partial(client.root.clientmessage, '_NET_ACTIVE_WINDOW', win=win), windowevent(xlib.EventName.FocusIn, 'xfocus', win), '_NET_ACTIVE_WINDOW'))
+    # desktop: _NET_CURRENT_DESKTOP request through to the other desktop's window being shown or hidden.
+    client.command.adddesktop('footbench', 1)
+    client.waitfor(client.rootproperty('_NET_DESKTOP_NAMES'), 'desktop insert')
+    marker = windows[0]
+    client.root.setwindowdesktop(marker, 1)
+    client.waitfor(windowevent(xlib.EventName.PropertyNotify, 'xproperty', marker), 'window desktop move')
+    visible = False
+    for _ in range(switches):
+        event = xlib.EventName.UnmapNotify if visible else xlib.EventName.MapNotify
+        field = 'xunmap' if visible else 'xmap'
+        # The previous desktop is always at index 1.
+        samples['desktop'].append(client.timed(lambda: client.command.selectdesktop(1), windowevent(event, field, marker), '_NET_CURRENT_DESKTOP'))
+        visible = not visible
+    if visible:
+        client.command.selectdesktop(1)
+        client.waitfor(windowevent(xlib.EventName.UnmapNotify, 'xunmap', marker), '_NET_CURRENT_DESKTOP')
+    client.command.deletedesktop(1)
+    client.waitfor(client.rootproperty('_NET_DESKTOP_NAMES'), 'desktop delete')
+    # close: _NET_CLOSE_WINDOW request through to the window manager dropping the destroyed window from its client list.
+    clientlist = client.rootproperty('_NET_CLIENT_LIST')
+    for win in windows:
+        destroyed = windowevent(xlib.EventName.DestroyNotify, 'xdestroywindow', win)
+        gone = False
+        def closed(e):
+            nonlocal gone
+            gone = gone or destroyed(e)
+            return gone and clientlist(e)
+        samples['close'].append(client.timed(lambda: client.root.closewindow(win), closed, '_NET_CLOSE_WINDOW'))
+    return samples
+
+def runsuite(displayname, counts, switches, timeout=10):
+    """ Start a session and measure each window count. Returns the results dict, see compare. """
+    results = {
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'switches': switches,
+                },
+            'results': {},
+            }
+    with Session(displayname, startuptimeout=timeout) as session:
+        client = Client(session.root, timeout)
+        for count in counts:
+            log.info('measuring %d windows', count)
+            samples = measure(client, count, switches)
+            session.checkrunning()
+            results['results'][str(count)] = {op: summarise(s) for op, s in samples.items() if s}
+    return results
+
+def flatrows(scaling, maxratio=maxratio):
+    """ scaling is dict(operation -> dict(count -> microseconds)). Returns
+    [(operation, smallcount, smallus, largecount, largeus, ratio, regressed)]. An operation regresses when its cost at
+    the largest window count is more than maxratio times its cost at the smallest. """
+    rows = []
+    for op, costs in sorted(scaling.items()):
+        ordered = sorted(costs.items(), key=lambda x: int(x[0]))
+        if len(ordered) < 2:
+            continue
+        (small, smallus), (large, largeus) = ordered[0], ordered[-1]
+        ratio = largeus / smallus if smallus else float('inf')
+        rows.append((op, small, smallus, large, largeus, ratio, ratio > maxratio))
+    return rows
+
+def compare(results, baseline, threshold, maxratio=maxratio):
+    """ Compare results against baseline. Returns [(count, op, stat, baselinems, resultms, ratio, regressed)].
+    A regression is any p50/p99 that's more than threshold times its baseline value.
+    Flat cost operations in results have stat 'flat', and their baseline is the cost at the smallest window count of
+    the same run. See flatrows. """
+    rows = []
+    for count, ops in sorted(results['results'].items(), key=lambda x: int(x[0])):
+        for op in operations:
+            try:
+                base = baseline['results'][count][op]
+                now = ops[op]
+            except KeyError:
+                continue
+            for stat in ['p50', 'p99']:
+                ratio = now[stat] / base[stat] if base[stat] else float('inf')
+                rows.append((count, op, stat, base[stat], now[stat], ratio, ratio > threshold))
+    for op, _, smallus, large, largeus, ratio, regressed in flatrows(results.get('scaling', {}), maxratio):
+        rows.append((large, op, 'flat', smallus / 1000, largeus / 1000, ratio, regressed))
+    return rows
+
+def printresults(results):
+    for count, ops in sorted(results['results'].items(), key=lambda x: int(x[0])):
+        for op in operations:
+            if op in ops:
+                print('windows={:>5} {:<8} p50={:8.2f}ms p99={:8.2f}ms n={}'.format(count, op, ops[op]['p50'], ops[op]['p99'], ops[op]['count']))
+    for op, costs in sorted(results.get('scaling', {}).items()):
+        print('{:<8} flat {}'.format(op, ' '.join('windows={}:{:.1f}us/op'.format(count, us) for count, us in sorted(costs.items(), key=lambda x: int(x[0])))))
+
+def printcompare(rows):
+    for count, op, stat, base, now, ratio, regressed in rows:
+        print('windows={:>5} {:<8} {:<4} baseline={:8.2f}ms now={:8.2f}ms {:6.2f}x{}'.format(count, op, stat, base, now, ratio, ' REGRESSION' if regressed else ''))
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def save(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -4,18 +4,28 @@ Client window commands.
 Copyright (c) 2016 Akce
 """
 
+import contextlib
+import select
+import time
 import types
 
+from . import command
 from . import display
 from . import log as logger
 from . import window
+from . import xlib
 
 log = logger.make(name=__name__)
 
 class ClientCommand:
-    """ Higher level X client commands. They will interpret things like indexes etc. """
+    """ Higher level X client commands. They will interpret things like indexes etc.
+    Desktop indexes are most recently used positions, ie 0 is the current desktop and 1 the previous desktop. """
     def __init__(self, root):
         self.root = root
+        # Window for footwm replies, made on first use. See sendrequest.
+        self._replywin = None
+        # Replies read but not yet waited on. dict(seq -> reply)
+        self._replies = {}
 
     @property
     def activewindow(self):
@@ -40,26 +50,43 @@ class ClientCommand:
         win = self._getwindow(stacking=stacking, index=index, window=window)
         if win:
             log.debug("0x%08x: setwindowdesktop desktop=%d index=%s", win.window, desktopindex, index)
-            self.root.setwindowdesktop(win, desktopindex)
+            self.root.setwindowdesktop(win, self._desktopnumber(desktopindex))
 
     def adddesktop(self, name, index):
         self.root.adddesktop(name, index)
 
     def deletedesktop(self, index):
-        self.root.deletedesktop(index)
+        self.root.deletedesktop(self._desktopnumber(index))
 
     def renamedesktop(self, index, name):
-        self.root.renamedesktop(index, name)
+        self.root.renamedesktop(self._desktopnumber(index), name)
 
     def selectdesktop(self, index):
-        self.root.currentdesktop = index
+        self.root.currentdesktop = self._desktopnumber(index)
 
     def getdesktopnames(self):
-        return self.root.desktopnames
+        """ Desktop names, most recently used first. """
+        names = self.root.desktopnames
+        mru = self.root.desktopmru
+        # Fallback to number order for window managers that don't publish FOOT_DESKTOP_MRU.
+        return [names[i] for i in mru] if mru else names
 
     @property
     def currentdesktop(self):
-        return self.root.currentdesktop
+        """ Always 0 for footwm, as the current desktop is the most recently used. """
+        current = self.root.currentdesktop
+        try:
+            return self.root.desktopmru.index(current)
+        except ValueError:
+            return current
+
+    def _desktopnumber(self, index):
+        """ Convert a most recently used position to a desktop number. """
+        try:
+            number = self.root.desktopmru[index]
+        except IndexError:
+            number = index
+        return number
 
     def getwindowlist(self, stacking=True):
         # Filter on desktop since stacklist has all windows.
@@ -78,21 +105,116 @@ class ClientCommand:
             except IndexError:
                 win = None
         elif window is not None:
-            win = self.root.children[window]
+            try:
+                win = self.root.children[window]
+            except KeyError:
+                # eg, window id came from a snapshot.
+                win = self.root.newchild(window)
             assert win.window == window
         else:
             # internal error!
             win = None
         return win
 
+    def request(self, commandv, timeout=5.0):
+        """ Send a FOOT_COMMANDV command and wait for footwm to run it. Returns the command result.
+        Raises command.CommandError if the command failed or there was no reply within timeout seconds. """
+        return self.waitreply(self.sendrequest(commandv), timeout)
+
+    def querystate(self, timeout=5.0):
+        """ footwm desktop and window state. See desktop.Desktop.snapshot """
+        return self.request(['query', 'state'], timeout)
+
+    def snapshot(self):
+        """ footwm desktop and window state read from FOOT_STATE and FOOT_STATE_LOG. See desktop.Desktop.snapshot
+        Window managers that don't publish FOOT_STATE get the same dict built from EWMH hints. """
+        state = self.root.footstate
+        if state is None:
+            state = self._ewmhsnapshot()
+        return state
+
+    def _ewmhsnapshot(self):
+        root = self.root
+        names = root.desktopnames
+        mru = list(root.desktopmru) or list(range(len(names)))
+        active = root.display.getpropertywindowid(root, '_NET_ACTIVE_WINDOW')
+        return {
+                'desktops': names,
+                'mru': mru,
+                'current': root.currentdesktop,
+                'active': active or None,
+                'clients': list(root.clientlistids),
+                'windows': [{
+                    'window': w.window,
+                    'desktop': w.desktop,
+                    'name': w.name,
+                    'res': w.resourcename,
+                    'cls': w.resourceclass,
+                    'host': w.clientmachine,
+                    } for w in root.clientliststacking],
+                }
+
+    def sendrequest(self, commandv):
+        """ Send a command that footwm will reply to. Returns the request sequence number for waitreply. """
+        return self.root.sendcommand(commandv, replywindow=self._replywindow())
+
+    def waitreply(self, seq, timeout=5.0):
+        """ Wait for the reply to request seq. See request. """
+        win = self._replywindow()
+        deadline = time.monotonic() + timeout
+        self.root.display.flush()
+        while seq not in self._replies:
+            self._waitreplychange(win, seq, deadline)
+            for reply in self.root.takereplies(win):
+                self._replies[reply['seq']] = reply
+        reply = self._replies.pop(seq)
+        if not reply['ok']:
+            raise command.CommandError(reply['error'])
+        return reply['result']
+
+    def _waitreplychange(self, win, seq, deadline):
+        """ Wait for replies to be added to FOOT_REPLY. Other events are left for the caller's event loop. """
+        display = self.root.display
+        while True:
+            event = display.checkwindowevent(win, xlib.InputEventMask.PropertyChange)
+            if event is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise command.CommandError('no reply to request {}'.format(seq))
+                select.select([display], [], [], remaining)
+            elif event.xproperty.atom == display.atom['FOOT_REPLY'] and event.xproperty.state.value == xlib.PropertyState.NewValue:
+                # Deletes are from us reading replies.
+                break
+
+    def _replywindow(self):
+        if self._replywin is None:
+            display = self.root.display
+            # Never mapped, it only carries the FOOT_REPLY property.
+            self._replywin = window.ClientWindow(display, display.createsimplewindow(self.root, 0, 0, 1, 1, 0, 0, 0))
+            display.selectinput(self._replywin, xlib.InputEventMask.PropertyChange)
+        return self._replywin
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ The window manager applies the commands sent within the block, then publishes hints and redraws once.
+        The commands are sent together when the block ends, so that they reach the window manager in one batch. A
+        request that waits on the server within the block sends what's been queued so far. See command.WmCommandReader. """
+        with self.root.display.batch():
+            self.root.begintransaction()
+            try:
+                yield self
+            finally:
+                self.root.committransaction()
+
     def startlogging(self, modulenames, levelname, outfilename):
         self.root.startlogging(modulenames=modulenames, levelname=levelname, outfilename=outfilename)
 
     def stoplogging(self):
         self.root.stoplogging()
 
-def makedisplayroot(displayname=None):
-    displayobj = display.Display(displayname)
+def makedisplayroot(displayname=None, backend='xlib', mirror=False):
+    """ mirror: See window.ClientRoot. The caller must pass PropertyNotify events to root.handle_propertynotify. """
+    displayobj = display.opendisplay(displayname, backend=backend)
     log.debug('Connect name=%s display=%s', displayname, displayobj)
-    root = window.ClientRoot(displayobj, displayobj.defaultrootwindow)
+    root = window.ClientRoot(displayobj, displayobj.defaultrootwindow, mirror=mirror)
     return displayobj, root
@@ -8,44 +8,260 @@ belonging to more than one desktop etc.
 Custom foot commands will go through the FOOT_COMMANDV (foot command
 vector) atom, so named because like argv (argument vector), it's a
 list of strings.
+
+FOOT_COMMANDV is a queue. Clients append command records with
+PropModeAppend and footwm reads and deletes the property in one request,
+so commands sent faster than footwm can read them are not lost.
+The property type is FOOT_COMMAND and each record is a netstring, ie
+<length>:<data>, where data is the NUL separated utf8 strings of a
+client sequence number, a reply window id and the command vector.
+eg, 20:1\00\0desktop\0delete\02,
+
+Commands read from the queue together are run as one batch, with hint
+updates and redraws deferred to the end of the batch. 'transaction
+begin' and 'transaction commit' group commands within a batch. A
+transaction that's still open when its batch ends is committed then,
+so a client that exits between the two can't leave footwm deferring
+redraws.
+
+When the reply window is not 0, footwm appends a JSON reply netstring to
+the FOOT_REPLY property (type UTF8_STRING) of that window once the
+command has run. ie, {"seq": 1, "ok": true, "result": ...} or
+{"seq": 1, "ok": false, "error": "..."}
+
+For older clients, a FOOT_COMMANDV text property (STRING or UTF8_STRING)
+is still read as a single command vector.
+
+footwm also publishes its state as JSON in the FOOT_STATE root property
+(type UTF8_STRING) so clients can read desktops, MRU order and windows
+without a request per window. See Desktop.snapshot for the layout.
+FOOT_STATE also has a "serial" number.
+
+Rewriting FOOT_STATE costs the size of the whole state, so changes are
+appended to the FOOT_STATE_LOG root property (type UTF8_STRING) instead.
+Each change is a JSON record on its own line, with the serial of the
+FOOT_STATE it applies to. ie,
+{"serial":1,"mru":[2,0,1],"current":2}   desktop selected
+{"serial":1,"active":4194313}            focus, window id or null
+{"serial":1,"raise":[4194313,4194320]}   windows to the top, top first
+{"serial":1,"window":{...}}              window entry changed
+{"serial":1,"manage":{...}}              new window entry, top window
+{"serial":1,"unmanage":4194313}          window removed
+footwm publishes FOOT_STATE with a new serial, and empties the log, when
+the desktops are added, deleted or renamed or once the log has grown
+larger than FOOT_STATE. See applystatelog.
 """
 
+import collections
+import contextlib
+import itertools
+import json
+
 from . import log as logmodule
+from . import utils
+from . import xlib
 
 log = logmodule.make(name=__name__)
 
 class Base:
 
-    def __init__(self, display, windowid):
-        super().__init__(display, windowid)
+    def __init__(self, display, windowid, **kwargs):
+        super().__init__(display, windowid, **kwargs)
         # FootWM will monitor changes to this atom for actionable
         # commands.
-        self.display.add_atom('FOOT_COMMANDV')
+        self.display.add_atoms(['FOOT_COMMANDV', 'FOOT_COMMAND', 'FOOT_DESKTOP_MRU', 'FOOT_REPLY', 'FOOT_STATE', 'FOOT_STATE_LOG', 'UTF8_STRING'])
+
+    @property
+    def desktopmru(self):
+        """ FOOT_DESKTOP_MRU: Desktop numbers in most recently used order. """
+        return self.display.getcardinalproperties(self, 'FOOT_DESKTOP_MRU')
+
+    @property
+    def footstate(self):
+        """ FOOT_STATE with FOOT_STATE_LOG applied: dict of window manager state, or None if footwm hasn't published it. """
+        # footwm may publish a new FOOT_STATE between the two reads, read both again when that happens.
+        for _ in range(3):
+            prop = self.display.getbytesproperty(self, 'FOOT_STATE')
+            if prop is None:
+                return None
+            logprop = self.display.getbytesproperty(self, 'FOOT_STATE_LOG')
+            try:
+                state = json.loads(str(prop[1], 'utf8'))
+                if applystatelog(state, b'' if logprop is None else logprop[1]):
+                    return state
+            except (KeyError, TypeError, ValueError) as e:
+                log.error('0x%08x: FOOT_STATE bad value: %s', self.window, e)
+                return None
+        log.error('0x%08x: FOOT_STATE changed on every read', self.window)
+        return None
+
+def applystatelog(state, data):
+    """ Apply the FOOT_STATE_LOG records in bytes data to the FOOT_STATE dict state, removing its serial.
+    Returns False if the log was written for a newer FOOT_STATE. """
+    serial = state.pop('serial')
+    windows = collections.OrderedDict((w['window'], w) for w in state['windows'])
+    clients = collections.OrderedDict.fromkeys(state['clients'])
+    for line in data.splitlines():
+        record = json.loads(str(line, 'utf8'))
+        if record['serial'] != serial:
+            if record['serial'] > serial:
+                return False
+            # Left over from an older FOOT_STATE.
+            continue
+        if 'mru' in record:
+            state['mru'] = record['mru']
+            state['current'] = record['current']
+        elif 'active' in record:
+            state['active'] = record['active']
+        elif 'raise' in record:
+            for windowid in reversed(record['raise']):
+                windows.move_to_end(windowid, last=False)
+        elif 'window' in record:
+            entry = record['window']
+            windows[entry['window']] = entry
+        elif 'manage' in record:
+            entry = record['manage']
+            windows[entry['window']] = entry
+            windows.move_to_end(entry['window'], last=False)
+            clients[entry['window']] = None
+        elif 'unmanage' in record:
+            windowid = record['unmanage']
+            windows.pop(windowid, None)
+            clients.pop(windowid, None)
+            if state['active'] == windowid:
+                state['active'] = None
+    state['windows'] = list(windows.values())
+    state['clients'] = list(clients)
+    return True
+
+class CommandError(Exception):
+    pass
+
+def encodenetstring(data):
+    return b'%d:%s,' % (len(data), data)
+
+def decodenetstrings(data):
+    """ Generator of the data of each netstring in data. Raises ValueError for malformed netstrings. """
+    pos = 0
+    while pos < len(data):
+        colon = data.index(b':', pos)
+        start = colon + 1
+        end = start + int(data[pos:colon])
+        if data[end:end + 1] != b',':
+            raise ValueError('netstring at {} is not terminated'.format(pos))
+        yield data[start:end]
+        pos = end + 1
+
+def encoderecord(seq, commandv, replyto=0):
+    """ FOOT_COMMANDV queue record for the command vector. replyto is the reply window id, 0 for no reply. """
+    return encodenetstring('\0'.join([str(seq), str(replyto)] + list(commandv)).encode('utf8'))
+
+def decoderecords(data):
+    """ Generator of (seq, replyto, commandv) for each record in FOOT_COMMANDV queue data.
+    Raises ValueError for malformed records. """
+    for record in decodenetstrings(data):
+        seq, replyto, *commandv = str(record, 'utf8').split('\0')
+        yield int(seq), int(replyto), commandv
+
+def encodereply(reply):
+    return encodenetstring(json.dumps(reply).encode('utf8'))
+
+def decodereplies(data):
+    """ Generator of reply dicts in FOOT_REPLY property data. """
+    for reply in decodenetstrings(data):
+        yield json.loads(str(reply, 'utf8'))
 
 class ClientRootMixin(Base):
     """ Client interface for communicating with the Foot window manager. """
 
+    def __init__(self, display, windowid, **kwargs):
+        super().__init__(display, windowid, **kwargs)
+        # Sequence numbers for FOOT_COMMANDV records sent by this client.
+        self._commandseq = itertools.count(1)
+
+    def sendcommand(self, commandv, replywindow=None):
+        """ Append the command to the FOOT_COMMANDV queue. Returns the command sequence number.
+        footwm will reply to the FOOT_REPLY property of replywindow if given. See takereplies. """
+        seq = next(self._commandseq)
+        record = encoderecord(seq, commandv, 0 if replywindow is None else replywindow.window)
+        self.display.setproperty(self, 'FOOT_COMMANDV', self.display.atom['FOOT_COMMAND'], 8, record, xlib.PropMode.Append)
+        return seq
+
+    def takereplies(self, replywindow):
+        """ Read and delete the replies queued on replywindow. Returns list of reply dicts. """
+        prop = self.display.getbytesproperty(replywindow, 'FOOT_REPLY', delete=True)
+        replies = []
+        if prop is not None:
+            try:
+                for reply in decodereplies(prop[1]):
+                    replies.append(reply)
+            except ValueError as e:
+                log.error('FOOT_REPLY bad reply, %d replies read: %s', len(replies), e)
+        return replies
+
+    @utils.cachedproperty('FOOT_DESKTOP_MRU')
+    def desktopmru(self):
+        return super().desktopmru
+
     def _setfootcommand(self, command):
-        """ FOOT_COMMANDV """
-        self.display.settextproperty(self, command, 'FOOT_COMMANDV')
+        """ FOOT_COMMANDV. Appends the command to the queue. """
+        self.sendcommand(command)
 
     footcommand = property(fset=_setfootcommand, doc="FOOT_COMMANDV")
 
     def adddesktop(self, name, index):
+        """ index is the position in most recently used order. """
         self.footcommand = ['desktop', 'insert', name, str(index)]
 
     def deletedesktop(self, index):
+        """ index is the desktop number. """
         self.footcommand = ['desktop', 'delete', str(index)]
 
     def renamedesktop(self, index, newname):
+        """ index is the desktop number. """
         self.footcommand = ['desktop', 'rename', str(index), newname]
 
+    def begintransaction(self):
+        """ Window manager defers hints and redraws until committransaction, or the end of the FOOT_COMMANDV batch that
+        the command arrives in. """
+        self.footcommand = ['transaction', 'begin']
+
+    def committransaction(self):
+        self.footcommand = ['transaction', 'commit']
+
     def startlogging(self, modulenames, levelname, outfilename):
         self.footcommand = ['log', 'start', outfilename, levelname] + modulenames
 
     def stoplogging(self):
         self.footcommand = ['log', 'stop']
 
+class WmRootMixin(Base):
+    """ Window manager side FOOT_* root window properties. """
+
+    @property
+    def desktopmru(self):
+        return super().desktopmru
+
+    @desktopmru.setter
+    def desktopmru(self, desktops):
+        self.display.setcardinalproperties(self, 'FOOT_DESKTOP_MRU', desktops)
+
+    @property
+    def footstate(self):
+        return super().footstate
+
+    @footstate.setter
+    def footstate(self, text):
+        """ text is the JSON encoded state. FOOT_STATE_LOG is emptied, its records were for the previous state. """
+        data = text.encode('utf8')
+        self.display.setproperty(self, 'FOOT_STATE', self.display.atom['UTF8_STRING'], 8, data)
+        self.display.setproperty(self, 'FOOT_STATE_LOG', self.display.atom['UTF8_STRING'], 8, b'')
+
+    def appendstatelog(self, text):
+        """ Append text, newline terminated JSON records, to FOOT_STATE_LOG. """
+        data = text.encode('utf8')
+        self.display.setproperty(self, 'FOOT_STATE_LOG', self.display.atom['UTF8_STRING'], 8, data, xlib.PropMode.Append)
+
 class WmCommandReader:
     """ Window Manager Root window interface. """
 
@@ -53,51 +269,137 @@ class WmCommandReader:
         self.display = display
         self.root = root
         self.desktop = desktop
-        self.display.add_atom('FOOT_COMMANDV')
+        self.display.add_atoms(['FOOT_COMMANDV', 'FOOT_COMMAND', 'FOOT_REPLY', 'UTF8_STRING'])
+        # Transactions opened by 'transaction begin' in the current batch. See batch.
+        self._opened = 0
 
-    @property
-    def footcommand(self):
-        """ FOOT_COMMANDV """
-        return self.display.gettextproperty(self.root, 'FOOT_COMMANDV')
+    @contextlib.contextmanager
+    def batch(self):
+        """ Run commands as one desktop transaction. Client transactions left open are committed when the batch ends. """
+        with self.desktop.transaction():
+            try:
+                yield
+            finally:
+                if self._opened:
+                    log.warning('0x%08x: committing %d transaction(s) left open by the command batch', self.root.window, self._opened)
+                    while self._opened:
+                        self._opened -= 1
+                        self.desktop.commit()
+
+    def takecommands(self):
+        """ Read and delete FOOT_COMMANDV. Returns list of (seq, replyto, commandv).
+        Text property commands have seq None and replyto 0. """
+        prop = self.display.getbytesproperty(self.root, 'FOOT_COMMANDV', delete=True)
+        commands = []
+        if prop is not None:
+            type_, data = prop
+            if type_ == self.display.atom['FOOT_COMMAND']:
+                try:
+                    for record in decoderecords(data):
+                        commands.append(record)
+                except ValueError as e:
+                    # Keep the commands read so far, the rest of the queue is lost.
+                    log.error('FOOT_COMMANDV bad record, %d commands read: %s', len(commands), e)
+            elif type_ in (xlib.XA.STRING, self.display.atom['UTF8_STRING']):
+                encoding = 'latin1' if type_ == xlib.XA.STRING else 'utf8'
+                commandv = str(data, encoding).split('\0')
+                # Text properties may or may not have a trailing NUL.
+                if commandv and commandv[-1] == '':
+                    commandv.pop()
+                commands.append((None, 0, commandv))
+            else:
+                log.error('FOOT_COMMANDV unknown type atom=%d', type_)
+        return commands
 
     def handle_propertynotify(self, atom):
-        """ FOOT_COMMANDV propert change received, parse and action it. """
+        """ FOOT_COMMANDV propert change received, parse and action every queued command. """
         if atom == self.display.atom['FOOT_COMMANDV']:
-            commandv = self.footcommand
-            log.debug('command received: %s', str(commandv))
-            command, subcommand = commandv[:2]
-            if command == 'desktop':
-                # Command modifies desktops in some way.
-                if subcommand == 'insert':
-                    # Insert desktop
-                    name = commandv[2]
-                    index = int(commandv[3])
-                    self.desktop.adddesktop(name=name, index=index)
-                elif subcommand == 'delete':
-                    # Delete desktop
-                    index = int(commandv[2])
-                    self.desktop.deletedesktop(index=index)
-                elif subcommand == 'rename':
-                    # Rename desktop
-                    index = int(commandv[2])
-                    name = commandv[3]
-                    self.desktop.renamedesktop(index=index, newname=name)
-            elif command == 'window':
-                # Command modifies a window in some way.
-                # Copy to desktop
-                # Remove from desktop
-                # Remove from all desktops
-                pass
-            elif command == 'log':
-                if subcommand == 'start':
-                    # Start or reset logging on the given modules to the given logfile and level.
-                    logmodule.startlogging(modulenames=commandv[4:], levelname=commandv[3], outfilename=commandv[2])
-                elif subcommand == 'stop':
-                    # Stop all debug logging.
-                    # XXX Revert to default logging. eg, exceptions to a default file?
-                    logmodule.stoplogging()
+            commands = self.takecommands()
+            # Commands that arrived together only need the one redraw.
+            with self.batch():
+                for seq, replyto, commandv in commands:
+                    log.debug('command received: seq=%s replyto=0x%08x %s', seq, replyto, str(commandv))
+                    try:
+                        result = self.runcommand(commandv)
+                    except CommandError as e:
+                        log.error('command failed: %s %s', str(commandv), e)
+                        reply = {'seq': seq, 'ok': False, 'error': str(e)}
+                    else:
+                        reply = {'seq': seq, 'ok': True, 'result': result}
+                    if replyto:
+                        self.reply(replyto, reply)
+
+    def reply(self, windowid, reply):
+        """ Append reply to the FOOT_REPLY property of the client window. """
+        data = encodereply(reply)
+        self.display.setproperty(windowid, 'FOOT_REPLY', self.display.atom['UTF8_STRING'], 8, data, xlib.PropMode.Append)
+
+    def runcommand(self, commandv):
+        """ Action the command vector. Returns the command result, raises CommandError if it fails. """
+        try:
+            return self._runcommand(commandv)
+        except (IndexError, KeyError, ValueError) as e:
+            # Missing or malformed arguments.
+            raise CommandError('bad arguments {}: {}'.format(commandv, e))
+
+    def _runcommand(self, commandv):
+        command, subcommand = commandv[:2]
+        result = None
+        if command == 'desktop':
+            # Command modifies desktops in some way.
+            if subcommand == 'insert':
+                # Insert desktop
+                name = commandv[2]
+                index = int(commandv[3])
+                if not self.desktop.adddesktop(name=name, index=index):
+                    raise CommandError('desktop {} exists'.format(name))
+            elif subcommand == 'delete':
+                # Delete desktop
+                index = int(commandv[2])
+                if not self.desktop.deletedesktop(index=index):
+                    raise CommandError('cannot delete desktop {}'.format(index))
+            elif subcommand == 'rename':
+                # Rename desktop
+                index = int(commandv[2])
+                name = commandv[3]
+                if not self.desktop.renamedesktop(index=index, newname=name):
+                    raise CommandError('cannot rename desktop {} to {}'.format(index, name))
+            else:
+                raise CommandError('unknown desktop command {}'.format(subcommand))
+        elif command == 'query':
+            if subcommand == 'state':
+                result = self.desktop.snapshot()
+            else:
+                raise CommandError('unknown query {}'.format(subcommand))
+        elif command == 'transaction':
+            # Group the commands that follow, see Desktop.begin.
+            if subcommand == 'begin':
+                self.desktop.begin()
+                self._opened += 1
+            elif subcommand == 'commit':
+                # Only commit what this batch began, the transaction from an earlier batch has already been committed.
+                if not self._opened:
+                    raise CommandError('commit without a transaction')
+                self._opened -= 1
+                self.desktop.commit()
             else:
-                # Unknown command.
-                pass
+                raise CommandError('unknown transaction command {}'.format(subcommand))
+        elif command == 'window':
+            # Command modifies a window in some way.
+            # Copy to desktop
+            # Remove from desktop
+            # Remove from all desktops
+            pass
+        elif command == 'log':
+            if subcommand == 'start':
+                # Start or reset logging on the given modules to the given logfile and level.
+                logmodule.startlogging(modulenames=commandv[4:], levelname=commandv[3], outfilename=commandv[2])
+            elif subcommand == 'stop':
+                # Stop all debug logging.
+                # XXX Revert to default logging. eg, exceptions to a default file?
+                logmodule.stoplogging()
+        else:
+            raise CommandError('unknown command {}'.format(command))
+        return result
 
-__all__ = ClientRootMixin, WmCommandReader
+__all__ = CommandError, ClientRootMixin, WmRootMixin, WmCommandReader
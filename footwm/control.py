@@ -0,0 +1,240 @@
+"""
+Unix socket control interface for footwm.
+
+Clients don't need an X connection. They connect to the control socket
+and make JSON RPC calls (see jsonrpc) on the Control object, eg,
+    {"id": 1, "cmd": "selectdesktop", "args": [2], "kwargs": {}}
+
+Calls that include an id are answered with {"id": 1, "result": ...} or
+{"id": 1, "error": "..."}. Messages are separated by the selectloop
+stream terminal.
+
+After calling subscribe, the client is also sent event messages as the
+window manager state changes. eg,
+    {"event": "desktopselected", "desktop": 2, "name": "work"}
+See events for the names.
+
+Copyright (c) 2016 Akce
+"""
+
+# Python standard modules.
+import collections
+import itertools
+import json
+import os
+import select
+import socket
+
+# Local modules.
+from . import config
+from . import jsonrpc
+from . import log as logmodule
+from . import selectloop
+
+log = logmodule.make(name=__name__)
+
+SOCKNAME = 'footwm.sock'
+TERMINAL = '\n\n\n'
+
+# Events sent to subscribers, and the data that comes with them.
+#   desktops:           desktops, mru, current. Desktops were added, removed, renamed or selected.
+#   desktopselected:    desktop, name
+#   windowmanaged:      window, name. A window has been mapped and is now managed.
+#   windowunmanaged:    window
+#   windowchanged:      window, name. eg, The window title changed.
+#   windowfocused:      window, name
+events = ('desktops', 'desktopselected', 'windowmanaged', 'windowunmanaged', 'windowchanged', 'windowfocused')
+
+class ControlError(Exception):
+    pass
+
+class Control:
+    """ Methods that control clients can call. One per connection. """
+
+    def __init__(self, connection, root, desktop):
+        self._connection = connection
+        self._root = root
+        self._desktop = desktop
+
+    def state(self):
+        """ Desktop and window state. See desktop.Desktop.snapshot """
+        return self._desktop.snapshot()
+
+    def command(self, commandv):
+        """ Run a FOOT_COMMANDV command vector and return its result. See command.WmCommandReader """
+        return self._desktop.runcommand(commandv)
+
+    def selectdesktop(self, desktop):
+        """ desktop is the desktop number. """
+        self._desktop.selectdesktop(desktop)
+
+    def activatewindow(self, window):
+        self._desktop.activatewindow(self._window(window))
+
+    def closewindow(self, window):
+        self._window(window).delete()
+
+    def setwindowdesktop(self, window, desktop):
+        self._desktop.setwindowdesktop(self._window(window), desktop)
+
+    def subscribe(self, names=None):
+        """ Send events to this connection. names limits the events to those named, default is all events. """
+        names = events if names is None else names
+        unknown = set(names).difference(events)
+        if unknown:
+            raise ControlError('unknown events {}'.format(sorted(unknown)))
+        self._connection.subscribed = frozenset(names)
+        return sorted(self._connection.subscribed)
+
+    def unsubscribe(self):
+        self._connection.subscribed = frozenset()
+
+    def _window(self, windowid):
+        """ Return the managed window object for windowid. """
+        try:
+            win = self._root.children[windowid]
+        except KeyError:
+            win = None
+        if win not in self._desktop.stacklist:
+            raise ControlError('unknown window {}'.format(windowid))
+        return win
+
+class ControlConnection(selectloop.StreamRemote):
+    """ A control client connection, dispatched by xevent.run. """
+
+    def __init__(self, sock, server):
+        # Never block the window manager on a slow client. See post.
+        sock.setblocking(False)
+        self._server = server
+        # Names of the events this connection has subscribed to.
+        self.subscribed = frozenset()
+        control = Control(self, server.root, server.desktop)
+        super().__init__(sock, receiver=jsonrpc.LocalObject(control, postfunc=self.post), terminal=TERMINAL)
+
+    def dispatchevent(self):
+        if not self.connected:
+            # Closed earlier in the same select round.
+            return
+        # Like XWatch.dispatchevent, send the X requests made by the call in one flush.
+        with self._server.display.batch():
+            try:
+                ok = self.handle_recv()
+            except (OSError, UnicodeDecodeError) as e:
+                log.debug('%s: receive failed %s', self, e)
+                ok = False
+        if not ok:
+            self._server.removeconnection(self)
+
+    def post(self, msg):
+        if self.connected:
+            try:
+                super().post(msg)
+            except OSError as e:
+                # Includes a full socket buffer, ie the client isn't reading.
+                log.warning('%s: send failed, closing connection. %s', self, e)
+                self._server.removeconnection(self)
+
+class ControlServer(selectloop.StreamServer):
+    """ Accepts control connections. The server and its connections are added to watchers, the list given to
+    xevent.run, and connections are removed from it when they close. """
+
+    def __init__(self, sockname, display, root, desktop, watchers):
+        super().__init__(address=sockname, family=socket.AF_UNIX, newconn=self._addconnection)
+        self.display = display
+        self.root = root
+        self.desktop = desktop
+        self._watchers = watchers
+        self._connections = []
+        self.desktop.subscribers.append(self.publish)
+
+    def start(self):
+        """ Listen on the control socket. Returns False if it can't. """
+        if not selectloop.removestalesocket(self._address):
+            log.error('File %s exists and is not a unix socket. Remove or use alternate filename.', self._address)
+            return False
+        if self.connect():
+            # Only this user may control the window manager.
+            os.chmod(self._address, 0o600)
+            self._watchers.append(self)
+        return self.connected
+
+    def dispatchevent(self):
+        self.handle_recv()
+
+    def _addconnection(self, sock):
+        conn = ControlConnection(sock, self)
+        self._connections.append(conn)
+        self._watchers.append(conn)
+
+    def removeconnection(self, conn):
+        if conn.connected:
+            conn.close()
+        if conn in self._connections:
+            self._connections.remove(conn)
+            self._watchers.remove(conn)
+
+    def publish(self, event, data):
+        """ Send event to the connections subscribed to it. """
+        msg = None
+        for conn in [c for c in self._connections if event in c.subscribed]:
+            if msg is None:
+                msg = json.dumps(dict(data, event=event))
+            conn.post(msg)
+
+class Client:
+    """ Blocking control client. eg,
+    client = Client()
+    client.call('selectdesktop', 1)
+    client.call('subscribe')
+    while True:
+        print(client.nextevent()) """
+
+    def __init__(self, sockname=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(sockname or config.getuserconfig(SOCKNAME))
+        self._terminal = TERMINAL.encode('utf8')
+        self._buffer = bytearray()
+        self._callids = itertools.count(1)
+        # Replies and events received but not yet asked for.
+        self._replies = {}
+        self._events = collections.deque()
+
+    def fileno(self):
+        """ For select.select, readable when there are events to read. """
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+    def call(self, cmd, *args, **kwargs):
+        """ Call the Control method cmd and return its result. Raises ControlError if the call failed. """
+        callid = next(self._callids)
+        self._socket.sendall((jsonrpc.encode_call(callid, cmd, args, kwargs) + TERMINAL).encode('utf8'))
+        while callid not in self._replies:
+            self._receive()
+        reply = self._replies.pop(callid)
+        if 'error' in reply:
+            raise ControlError(reply['error'])
+        return reply['result']
+
+    def nextevent(self, timeout=None):
+        """ Return the next event dict. None if there's none within timeout seconds. """
+        while not self._events:
+            if timeout is not None and not select.select([self._socket], [], [], timeout)[0]:
+                return None
+            self._receive()
+        return self._events.popleft()
+
+    def _receive(self):
+        data = self._socket.recv(1 << 16)
+        if not data:
+            raise ControlError('connection closed')
+        self._buffer += data
+        *msgs, rest = self._buffer.split(self._terminal)
+        self._buffer = bytearray(rest)
+        for m in msgs:
+            msg = json.loads(str(m, 'utf8'))
+            if 'event' in msg:
+                self._events.append(msg)
+            else:
+                self._replies[msg['id']] = msg
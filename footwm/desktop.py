@@ -1,5 +1,12 @@
 """ Desktop management (window grouping) for footwm. """
 
+import array
+import collections
+import contextlib
+import itertools
+import json
+import logging
+
 from . import command
 from . import ewmh
 from . import xlib
@@ -7,26 +14,131 @@ from . import log as logmodule
 
 log = logmodule.make(name=__name__)
 
+# Window properties that are published in FOOT_STATE. See Desktop.windowchanged.
+stateproperties = frozenset(['_NET_WM_NAME', 'WM_NAME', 'WM_CLASS', 'WM_CLIENT_MACHINE'])
+# FOOT_STATE JSON separators, without the default whitespace.
+compact = (',', ':')
+# FOOT_STATE_LOG is compacted into FOOT_STATE when it's larger than FOOT_STATE and at least this many characters.
+statelogmin = 4096
+
+def removeid(ids, windowid):
+    """ Remove windowid from the array('L') ids. array.remove makes a Python int of every item it compares, searching
+    the bytes is many times faster. Raises ValueError if windowid isn't in ids. """
+    data = ids.tobytes()
+    key = array.array('L', [windowid]).tobytes()
+    # Search from the end. Recently used and recently managed windows are at the end and they're the most likely to be
+    # raised or unmanaged.
+    offset = data.rfind(key)
+    # Only matches that line up with an item count.
+    while offset > 0 and offset % ids.itemsize:
+        offset = data.rfind(key, 0, offset + len(key) - 1)
+    if offset < 0:
+        raise ValueError('0x{:08x} not in ids'.format(windowid))
+    del ids[offset // ids.itemsize]
+
+class MruList:
+    """ Windows in most recently used order, most recent first.
+
+    Backed by an OrderedDict so that membership tests, removal and moving a window to the front are all O(1).
+
+    ids=True also keeps the window ids in an array('L'), least recently used first. ie, the bottom to top order of
+    _NET_CLIENT_LIST_STACKING. It's edited in place as the list changes so it can be published without being rebuilt. """
+
+    def __init__(self, windows=(), ids=False):
+        self._windows = collections.OrderedDict.fromkeys(windows)
+        self.ids = array.array('L', (w.window for w in reversed(self._windows))) if ids else None
+
+    def push(self, window):
+        """ Add window, or move it if already present, to the front. """
+        if self.ids is not None:
+            if window in self._windows:
+                removeid(self.ids, window.window)
+            self.ids.append(window.window)
+        self._windows[window] = None
+        self._windows.move_to_end(window, last=False)
+
+    def append(self, window):
+        """ Add window, or move it if already present, to the back. ie, least recently used. """
+        if self.ids is not None:
+            if window in self._windows:
+                removeid(self.ids, window.window)
+            self.ids.insert(0, window.window)
+        self._windows[window] = None
+        self._windows.move_to_end(window)
+
+    def discard(self, window):
+        if window in self._windows:
+            del self._windows[window]
+            if self.ids is not None:
+                removeid(self.ids, window.window)
+
+    def __contains__(self, window):
+        return window in self._windows
+
+    def __getitem__(self, index):
+        """ Index access is O(index), it's intended for looking at the first few windows. """
+        if index < 0:
+            it = itertools.islice(reversed(self._windows), -index - 1, None)
+        else:
+            it = itertools.islice(self._windows, index, None)
+        try:
+            return next(it)
+        except StopIteration:
+            raise IndexError(index)
+
+    def __iter__(self):
+        return iter(self._windows)
+
+    def __len__(self):
+        return len(self._windows)
+
+    def __reversed__(self):
+        return reversed(self._windows)
+
 class Desktop:
     """ Manage user created desktops, plus the null & unassigned desktops. """
 
-    def __init__(self, display, root):
-        """ Desktops are built from root child windows. """
+    def __init__(self, display, root, eventmask=~0):
+        """ Desktops are built from root child windows.
+        eventmask: The events that the window manager handles, see xevent.XWatch. Windows only select these. """
         self.display = display
         self.root = root
+        self.eventmask = eventmask
         self._ewmhreader = ewmh.WmCommandReader(self.display, self.root, self)
         self._footreader = command.WmCommandReader(self.display, self.root, self)
         self._unassigned = 'Unassigned'
         self._specials = [self._unassigned]
-        # Keep the order of desktops: [desktop-name]
+        # Desktops in creation order: [desktop-name]
+        # Index in this list is the desktop number used in EWMH hints. It's stable, switching desktops doesn't change it.
         self._desklist = self._specials[:]
-        # Dict(desktop-name, [window])
-        self._deskwins = {k: [] for k in self._desklist}
+        # Desktops in most recently used order: [desktop-name]. Published as FOOT_DESKTOP_MRU.
+        self._mru = []
+        # Dict(desktop-name, MruList(window))
+        self._deskwins = {k: MruList() for k in self._desklist}
+        # Reverse index, Dict(window, MruList(window)) of the desktop that the window is in.
+        self._windesk = {}
+        # Window that was last given focus.
+        self._focused = None
+        # FOOT_STATE JSON text of each window, Dict(window, text). Entries are dropped when the window changes desktop
+        # or one of its published properties changes, so publishing the state doesn't need to encode every window.
+        self._statewindows = {}
+        # FOOT_STATE JSON text of the client list, None when it needs encoding again.
+        self._stateclients = None
+        # FOOT_STATE serial, the desktops and size it was last published with, and whether it needs publishing again.
+        self._stateserial = 0
+        self._statedesktops = None
+        self._statesize = 0
+        self._statefull = True
+        # FOOT_STATE_LOG records waiting to be appended, and the size of the log so far. See command.applystatelog.
+        self._statelog = []
+        self._statelogsize = 0
+        # Callables, f(event, data), told about changes. See control.events
+        self.subscribers = []
+        # Number of open transactions, and the hint updates and redraw deferred until they're committed.
+        self._transactions = 0
+        self._deferred = set()
         self._makeunassigned()
-        self._updatedesktophints()
         self._currentdesk = None
-        # This is always 0 since the current desktop is always put at the head of the list.
-        self.root.currentdesktop = 0
         self.selectdesktop(0)
 
     def handle_clientmessage(self, msgid, clientevent, win=None):
@@ -36,22 +148,70 @@ class Desktop:
         """ Handle command received from a client. """
         self._footreader.handle_propertynotify(atom)
 
+    def runcommand(self, commandv):
+        """ Run a FOOT_COMMANDV command vector. Returns the command result, raises command.CommandError if it fails. """
+        with self._footreader.batch():
+            return self._footreader.runcommand(commandv)
+
+    def _notify(self, event, **data):
+        for subscriber in self.subscribers:
+            subscriber(event, data)
+
+    def begin(self):
+        """ Start a transaction. Hint updates and redraws are deferred until the matching commit. Can be nested. """
+        self._transactions += 1
+
+    def commit(self):
+        """ End a transaction. The outermost commit publishes hints and redraws once, for the final state. """
+        if self._transactions == 0:
+            log.warning('0x%08x: commit without a transaction', self.root.window)
+            return
+        self._transactions -= 1
+        if self._transactions == 0:
+            deferred, self._deferred = self._deferred, set()
+            log.debug('0x%08x: commit deferred=%s', self.root.window, deferred)
+            with self.display.batch():
+                if 'desktops' in deferred:
+                    self._updatedesktophints()
+                if 'stacking' in deferred:
+                    self._updatewindowhints(clients='clients' in deferred)
+                if 'redraw' in deferred:
+                    self.redraw()
+                if 'state' in deferred:
+                    self._updatestate()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Context manager for begin/commit. eg,
+        with desk.transaction():
+            desk.adddesktop('work', 1)
+            desk.setwindowdesktop(win, 1) """
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.commit()
+
     def adddesktop(self, name, index=0):
-        """ Add a new desktop with name. Name must be unique. """
+        """ Add a new desktop with name. Name must be unique.
+        index is the position in most recently used order, 0 will also select the new desktop.
+        The desktop always gets the next desktop number. Returns True if the desktop was added. """
         if name in self._deskwins:
             log.error('%s exists. Desktop names must be unique', name)
+            return False
         else:
-            self._desklist.insert(index, name)
-            self._deskwins[name] = []
+            self._desklist.append(name)
+            self._deskwins[name] = MruList()
+            self._mru.insert(index, name)
             if index == 0:
                 # Select the desktop.
-                self.selectdesktop(index)
+                self.selectdesktop(len(self._desklist) - 1)
             else:
                 self._updatedesktophints()
+            return True
 
     def selectdesktop(self, index):
-        # Ensure that that the first (current) entry is not selected.
-        #if index != 0 and index != -len(self._desklist):
+        """ Select desktop number index. Only the visible family and the new desktops top family are touched. """
         log.debug('0x%08x: selectdesktop index=%d _currentdesk=%s', self.root.window, index, self._currentdesk)
         try:
             deskname = self._desklist[index]
@@ -59,20 +219,19 @@ class Desktop:
             log.warning('0x%08x: desktop index=%d out of bounds desks=%s', self.root.window, index, str(self._desklist))
         else:
             if deskname != self._currentdesk:
-                # The desktop order will be changed.
-                # Hides all the windows of the *previously drawn desktop*. Note the use of _currentdesk.
-                # This is because add/delete etc will have already changed the desktop order.
-                for w in self._deskwins.get(self._currentdesk, []):
-                    # XXX Check that the window is not already visible before hiding...
-                    w.hide()
-                self._desklist.pop(index)
-                self._desklist.insert(0, deskname)
-                self._updatedesktophints()
-                self._updatewindowhints()
+                # redraw() maps the new top family before hiding what was visible, so the root never shows through.
+                if deskname in self._mru:
+                    self._mru.remove(deskname)
+                self._mru.insert(0, deskname)
                 self._currentdesk = deskname
+                self._updatedesktophints()
                 self.redraw()
+                if self.subscribers:
+                    self._notify('desktopselected', desktop=index, name=deskname)
 
     def deletedesktop(self, index):
+        """ Delete desktop number index. Desktops numbered after it are renumbered. Returns True if deleted. """
+        deleted = False
         try:
             deskname = self._desklist[index]
         except IndexError:
@@ -80,33 +239,47 @@ class Desktop:
         else:
             # Only allow deleting regular (non-special) desktops.
             if deskname not in self._specials:
+                current = deskname == self._currentdesk
                 # Move windows from the deleted desktop to the unassigned desktop.
                 udesk = self._deskwins[self._unassigned]
                 uindex = self._desklist.index(self._unassigned)
+                # Account for the renumbering below.
+                if uindex > index:
+                    uindex -= 1
                 for w in self._deskwins[deskname]:
                     udesk.append(w)
+                    self._windesk[w] = udesk
                     w.desktop = uindex
-                    # XXX Could be smarter here, the selectdesktop/redraw combo should do all the window hiding.
-                    if index == 0:
-                        w.hide()
+                # Window desktop numbers are about to change.
+                self._statewindows.clear()
                 del self._desklist[index]
                 del self._deskwins[deskname]
-                if index == 0:
-                    self.selectdesktop(index)
+                self._mru.remove(deskname)
+                # EWMH desktop numbers are positions, so windows on later desktops need their number updated.
+                for i, dname in enumerate(self._desklist[index:], index):
+                    for w in self._deskwins[dname]:
+                        w.desktop = i
+                if current:
+                    self._currentdesk = None
+                    self.selectdesktop(self._desklist.index(self._mru[0]))
                 else:
                     self._updatedesktophints()
+                deleted = True
+        return deleted
 
     def renamedesktop(self, index, newname):
-        """ Renames the selected desktop. """
+        """ Renames desktop number index. Returns True if renamed. """
+        renamed = False
         if newname in self._deskwins:
             log.error('%s exists. Cannot rename deskop, names must be unique.', newname)
         else:
             try:
-                oldname = self._desklist.pop(index)
+                oldname = self._desklist[index]
             except IndexError:
                 pass
             else:
-                self._desklist.insert(index, newname)
+                self._desklist[index] = newname
+                self._mru[self._mru.index(oldname)] = newname
                 desk = self._deskwins.pop(oldname)
                 self._deskwins[newname] = desk
                 if oldname == self._currentdesk:
@@ -115,11 +288,101 @@ class Desktop:
                 if self._unassigned == oldname:
                     self._unassigned = newname
                 self._updatedesktophints()
+                renamed = True
+        return renamed
 
     @property
     def clientlist(self):
-        """ Client list of windows in creation order. """
-        return [window for windowid, window in self.root.children.items() if window in self.stacklist]
+        """ Client list of windows in the order they were managed. """
+        return list(self._clients)
+
+    def snapshot(self):
+        """ Desktop and window state as a dict. This is what FOOT_STATE with FOOT_STATE_LOG applied gives. ie,
+        desktops: names in desktop number order
+        mru: desktop numbers in most recently used order
+        current: current desktop number
+        active: window id with focus, or None
+        clients: window ids in the order they were managed
+        windows: [dict(window=id, desktop=number, name=str, res=str, cls=str, host=str)] in stacking order, top
+        window first. """
+        return json.loads(self._statetext())
+
+    def _statewindow(self, win, desknumbers=None):
+        """ FOOT_STATE JSON text of window win. desknumbers is dict(MruList, desktop number). """
+        try:
+            return self._statewindows[win]
+        except KeyError:
+            if desknumbers is None:
+                desknumbers = {self._deskwins[name]: i for i, name in enumerate(self._desklist)}
+            text = self._statewindows[win] = json.dumps({
+                    'window': win.window,
+                    'desktop': desknumbers[self._windesk[win]],
+                    'name': win.name,
+                    'res': win.resourcename,
+                    'cls': win.resourceclass,
+                    'host': win.clientmachine,
+                    }, separators=compact)
+            return text
+
+    def _statetext(self):
+        numbers = {name: i for i, name in enumerate(self._desklist)}
+        texts = self._statewindows
+        try:
+            windows = ','.join(map(texts.__getitem__, self.stacklist))
+        except KeyError:
+            # Encode the new and changed windows.
+            desknumbers = {self._deskwins[name]: i for name, i in numbers.items()}
+            for w in self.stacklist:
+                self._statewindow(w, desknumbers)
+            windows = ','.join(map(texts.__getitem__, self.stacklist))
+        if self._stateclients is None:
+            self._stateclients = json.dumps([w.window for w in self._clients], separators=compact)
+        head = json.dumps({
+                'desktops': self._desklist,
+                'mru': [numbers[d] for d in self._mru],
+                'current': numbers[self._currentdesk],
+                'active': None if self._focused is None else self._focused.window,
+                }, separators=compact)
+        # Splice in the cached lists rather than encoding every window again.
+        return '{},"clients":{},"windows":[{}]}}'.format(head[:-1], self._stateclients, windows)
+
+    def _logstate(self, key, value):
+        """ Record a FOOT_STATE change for FOOT_STATE_LOG. value is JSON text. """
+        if not self._statefull:
+            self._statelog.append('{{"serial":{},"{}":{}}}\n'.format(self._stateserial, key, value))
+        self._updatestate()
+
+    def _updatestate(self):
+        """ Publish the recorded FOOT_STATE changes. The whole of FOOT_STATE is only published again when the
+        desktops change, or when the log has grown larger than FOOT_STATE, so the cost of a change doesn't depend on
+        the number of windows. """
+        if self._transactions:
+            self._deferred.add('state')
+            return
+        if self._statelogsize > max(self._statesize, statelogmin):
+            self._statefull = True
+        if self._statefull:
+            self._stateserial += 1
+            text = self._statetext()
+            self.root.footstate = '{{"serial":{},{}'.format(self._stateserial, text[1:])
+            self._statedesktops = self._desklist[:]
+            self._statesize = len(text)
+            self._statefull = False
+            self._statelog = []
+            self._statelogsize = 0
+        elif self._statelog:
+            text = ''.join(self._statelog)
+            self.root.appendstatelog(text)
+            self._statelog = []
+            self._statelogsize += len(text)
+
+    def windowchanged(self, win):
+        """ A published property of window win has changed. """
+        if win in self._windesk:
+            self._statewindows.pop(win, None)
+            self._logstate('window', self._statewindow(win))
+            if self.subscribers:
+                self._notify('windowchanged', window=win.window, name=win.name)
 
     def setwindowdesktop(self, win, desktopindex):
         try:
@@ -128,18 +391,20 @@ class Desktop:
             log.debug('0x%08x: setwindowdesktop failed. index=%d out of bounds', win.window, desktopindex)
         else:
             newdesk = self._deskwins[newdeskname]
-            doredraw = newdesk == self._desklist[0]
-            for dname, dwins in self._deskwins.items():
-                if win in dwins:
-                    dwins.remove(win)
-                    log.debug('0x%08x: removed from desktop name=%s', win.window, dname)
-                    if dname == self._desklist[0]:
-                        # Hide window here - redraw() yet doesn't handle windows still visible from an old desktop!!
-                        win.hide()
-                        doredraw = True
-            newdesk.insert(0, win)
+            doredraw = newdeskname == self._currentdesk
+            olddesk = self._windesk.get(win)
+            if olddesk is not None:
+                olddesk.discard(win)
+                log.debug('0x%08x: removed from desktop', win.window)
+                if olddesk is self.windowlist:
+                    # redraw() will hide the window if it's visible.
+                    doredraw = True
+            newdesk.push(win)
+            self._windesk[win] = newdesk
             log.debug('0x%08x: inserted into desktop name=%s', win.window, newdeskname)
             win.desktop = desktopindex
+            self._statewindows.pop(win, None)
+            self._logstate('window', self._statewindow(win))
             self._updatewindowhints()
             if doredraw:
                 self.redraw()
@@ -147,92 +412,146 @@ class Desktop:
     @property
     def windowlist(self):
         """ Windows for the current desktop only. """
-        return self._deskwins[self._desklist[0]]
+        return self._deskwins[self._currentdesk]
 
     def _makeunassigned(self):
         """ Import windows that look like they'll need to be managed into the unassigned group. """
+        managed = [w for w in self.root.children.values() if managewindowp(w)]
         # stacklist is the usage order of windows.
-        self.stacklist = [w for w in self.root.children.values() if managewindowp(w)]
+        self.stacklist = MruList(managed, ids=True)
+        # Managed windows, in the order they were managed. ie, _NET_CLIENT_LIST order.
+        self._clients = collections.OrderedDict.fromkeys(managed)
+        # And their window ids, kept in step with _clients for publishing.
+        self._clientids = array.array('L', (w.window for w in managed))
+        # Windows that may be mapped on screen, redraw() only needs to look at these to find windows to hide.
+        self._visible = {w for w in managed if w.mapped}
         # So far, all windows are unassigned at startup.
-        self._deskwins[self._unassigned] = self.stacklist[:]
-        for window in self.stacklist:
+        udesk = self._deskwins[self._unassigned] = MruList(managed)
+        for window in managed:
+            self._windesk[window] = udesk
             log.debug('0x%08x: importing window %s', window.window, window)
             # Manage imported windows.
-            window.manage(xlib.InputEventMask.StructureNotify)
+            window.manage(self.eventmask & window.eventmask)
             window.desktop = 0
 
     def managewindow(self, window):
         if not window.override_redirect:
             # Put window to the top of the list and update display.
             # XXX Is this check needed?
-            if window not in self.stacklist:
-                self.windowlist.insert(0, window)
-                self.stacklist.insert(0, window)
-            window.manage(xlib.InputEventMask.EnterWindow | xlib.InputEventMask.FocusChange | xlib.InputEventMask.StructureNotify)
+            newwindow = window not in self.stacklist
+            if newwindow:
+                self.windowlist.push(window)
+                self.stacklist.push(window)
+                self._windesk[window] = self.windowlist
+                self._clients[window] = None
+                self._clientids.append(window.window)
+                self._stateclients = None
+                window.desktop = self._desklist.index(self._currentdesk)
+            window.manage(self.eventmask & window.eventmask)
+            if newwindow:
+                # After manage, so the properties read are cached.
+                self._logstate('manage', self._statewindow(window))
             self.raisewindow(window)
+            if newwindow:
+                # raisewindow only publishes the stacking list.
+                self._updatewindowhints()
             self.redraw()
+            if newwindow and self.subscribers:
+                self._notify('windowmanaged', window=window.window, name=window.name)
 
     def unmanagewindow(self, win):
         """ Remove the window from window lists. """
         # Remove from our managed lists.
-        del self.root.children[win.window]
-        self.stacklist.remove(win)
-        doredraw = False
-        for dname, dwins in self._deskwins.items():
-            if win in dwins:
-                dwins.remove(win)
-                if dname == self._desklist[0]:
-                    # XXX Check if the window is visible!
-                    doredraw = True
-        else:
-            # Window not found... Maybe log an internal error?
-            pass
-        if win in self.stacklist:
-            self.stacklist.remove(win)
-        if doredraw:
+        self.root.children.pop(win.window, None)
+        # Free cached properties now, transients may keep a reference to the window object in their family.
+        win.clearcache()
+        self._visible.discard(win)
+        self._statewindows.pop(win, None)
+        if win is self._focused:
+            self._focused = None
+        desk = self._windesk.pop(win, None)
+        if desk is not None:
+            desk.discard(win)
+            self.stacklist.discard(win)
+            del self._clients[win]
+            removeid(self._clientids, win.window)
+            self._stateclients = None
+            self._logstate('unmanage', win.window)
             self._updatewindowhints()
-            self.redraw()
+            if desk is self.windowlist:
+                # XXX Check if the window is visible!
+                self.redraw()
+            if self.subscribers:
+                self._notify('windowunmanaged', window=win.window)
 
     def _updatedesktophints(self):
         """ Update desktop atoms. """
+        if self._transactions:
+            self._deferred.add('desktops')
+            return
         self.root.numberofdesktops = len(self._desklist)
         #log.debug('0x%08x: numberofdesktops=%s %d', self.root.window, self.root.numberofdesktops, len(self._desklist))
         self.root.desktopnames = self._desklist
+        numbers = {name: i for i, name in enumerate(self._desklist)}
+        self.root.desktopmru = [numbers[d] for d in self._mru]
+        self.root.currentdesktop = numbers[self._currentdesk]
+        if self._desklist != self._statedesktops:
+            # Desktop numbers in the window entries may have changed too.
+            self._statefull = True
+            self._updatestate()
+        else:
+            self._logstate('mru', '{},"current":{}'.format(json.dumps([numbers[d] for d in self._mru], separators=compact), numbers[self._currentdesk]))
+        if self.subscribers:
+            self._notify('desktops', desktops=self._desklist, mru=[numbers[d] for d in self._mru], current=numbers[self._currentdesk])
 
-    def _updatewindowhints(self):
-        """ Update client window lists. """
-        # XXX Only update clientlist on newwindow, delwindow, changedesktop.
-        self.root.clientlist = self.clientlist
-        self.root.clientliststacking = self.stacklist
-        log.debug("_updatewindowhints: stacklist=[{}]".format(' '.join('0x{:08x}'.format(x.window) for x in self.stacklist)))
-        # Update the current desktop for (potentially) *all* windows!
-        for i, dname in enumerate(self._desklist):
-            docheck = True
-            for w in self._deskwins[dname]:
-                # Optimise this check to save an EWMH w.desktop read for successive windows...
-                if docheck and i == w.desktop:
-                    break
-                docheck = False
-                w.desktop = i
+    def _updatewindowhints(self, clients=True):
+        """ Update client window lists. clients=False for stacking only changes, ie the client list is unchanged. """
+        if self._transactions:
+            self._deferred.add('stacking')
+            if clients:
+                self._deferred.add('clients')
+            return
+        if clients:
+            self.root.clientlist = self._clientids
+        self.root.clientliststacking = self.stacklist.ids
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("_updatewindowhints: stacklist=[{}]".format(' '.join('0x{:08x}'.format(x.window) for x in self.stacklist)))
 
     def raisewindow(self, win):
         """ Select the family of windows that belong to the window. """
-        log.debug('0x%08x: raising %s', win.window, str(win))
+        log.debug('0x%08x: raising %s', win.window, win)
         # family accounts for transients
         # TODO window groups. See ICCCM 4.1.11
         # XXX Automatically select group if the window is in a different group?
         # XXX Maybe not, how to handle case where the window is in multiple groups?
-        if win in self.windowlist:
-            for w in win.family:
-                self.windowlist.remove(w)
-                self.stacklist.remove(w)
+        windowlist = self.windowlist
+        if win in windowlist:
+            raised = []
             for w in reversed(win.family):
-                self.windowlist.insert(0, w)
-                self.stacklist.insert(0, w)
-            self._updatewindowhints()
+                # Only raise family that's on this desktop.
+                if self._windesk.get(w) is windowlist:
+                    windowlist.push(w)
+                    self.stacklist.push(w)
+                    raised.append(w.window)
+            raised.reverse()
+            self._logstate('raise', json.dumps(raised, separators=compact))
+            self._updatewindowhints(clients=False)
+
+    def activatewindow(self, win):
+        """ Raise and show the window, if it's on the current desktop. """
+        self.raisewindow(win=win)
+        # Check if raisewindow worked before redrawing.
+        # XXX Not sure if i like this....
+        if self.windowlist and self.windowlist[0] == win:
+            self.redraw()
 
     def redraw(self):
-        """ Redraw all visible windows. Any parents of transient windows will also be shown. """
+        """ Redraw all visible windows. Any parents of transient windows will also be shown.
+        The top window is mapped first, then any other visible windows are hidden. Only windows that are, or were,
+        visible are touched so the cost doesn't depend on how many windows are on the desktop. """
+        if self._transactions:
+            self._deferred.add('redraw')
+            return
         try:
             family = self.windowlist[0].family
         except IndexError:
@@ -243,15 +562,23 @@ class Desktop:
             w = family[0]
             # TODO use a layout object to decide ideal window size.
             w.resize(self.root.geom)
+            wasmapped = w.mapped
             w.show()
-            self.root.activewindow = w
-            w.focus()
+            self._visible.add(w)
+            # Focus only needs to be set again if it's moved to another window or the window was unmapped.
+            if w is not self._focused or not wasmapped:
+                self.root.activewindow = w
+                w.focus()
+                self._focused = w
+                self._logstate('active', str(w.window))
+                if self.subscribers:
+                    self._notify('windowfocused', window=w.window, name=w.name)
         # Hide every window that's not in the family of windows.
-        for w in self.windowlist:
-            if w not in family:
+        for w in [x for x in self._visible if x not in family]:
+            if w.mapped:
                 log.debug('0x%08x: hiding %s', w.window, w)
-                # XXX only hide visible windows!!
                 w.hide()
+            self._visible.discard(w)
 
     def withdrawwindow(self, win):
         # Note the use of stacklist, rather than winlist. That way windows in other desktops can be withdrawn.
@@ -5,7 +5,9 @@ Display abstracts away most of the direct access to the xlib library.
 
 Copyright (c) 2016 Akce
 """
+import array
 import collections
+import contextlib
 import ctypes
 import functools
 import operator
@@ -19,13 +21,143 @@ log = logmodule.make(name=__name__)
 # For when a Geometry is manually created.
 Geomtuple = collections.namedtuple('Geomtuple', ['x', 'y', 'width', 'height'])
 
+# Everything needed to build a window object for an existing window. See Display.getwindowinfo.
+# attributes is the (override_redirect, geom, map_state) tuple from getwindowattributes.
+# properties is dict(propertyname -> value) of properties that were read while importing.
+WindowInfo = collections.namedtuple('WindowInfo', ['attributes', 'transientfor', 'properties'])
+
+# Properties that getclientwindowinfo can read ahead, by property cache key. The values are the same as from:
+#   _NET_WM_NAME:       ewmh name, ie _NET_WM_NAME falling back to WM_NAME
+#   _NET_WM_DESKTOP:    getcardinalproperty
+#   WM_CLASS:           getclasshint
+#   WM_CLIENT_MACHINE:  getwmclientmachine
+clientproperties = ('_NET_WM_NAME', '_NET_WM_DESKTOP', 'WM_CLASS', 'WM_CLIENT_MACHINE')
+
 # addr = address-of, this is a handy shortcut for using ctypes.
 addr = ctypes.byref
 
+# Properties are read this many 32 bit units at a time. See Display.getproperty.
+propertychunk = 1 << 16
+
+# array typecodes of property data by format. Xlib passes format 16 data as shorts and format 32 data as longs.
+propertytypecodes = {8: 'B', 16: 'H', 32: 'L'}
+_propertyitemsizes = {f: array.array(t).itemsize for f, t in propertytypecodes.items()}
+
+def _propertydata(format_, count):
+    """ Zeroed buffer for count items of format_ property data. """
+    if format_ == 8:
+        return bytearray(count)
+    return array.array(propertytypecodes[format_], [0]) * count
+
+_wmstates = frozenset((xlib.WmStateState.Withdrawn, xlib.WmStateState.Normal, xlib.WmStateState.Iconic))
+
+def wmstatestate(windowid, value):
+    """ xlib.WmStateState of a WM_STATE state value, or None if it's not one of the states. Clients can write
+    anything, such a window is treated as if WM_STATE wasn't set. """
+    if value in _wmstates:
+        return xlib.WmStateState(value)
+    log.warning('0x%08x: WM_STATE state %s is not a WmStateState, ignored', windowid, value)
+    return None
+
 class DisplayError(Exception):
     """ Error connecting to or managing the display. """
     pass
 
+def opendisplay(displayname=None, backend='xlib'):
+    """ Connect to a display using the named backend.
+    backend is 'xlib' for a real X server, 'xcb' for a real X server with some requests pipelined (see xcbdisplay),
+    or 'fake' for the in process fake server. See fakedisplay. """
+    if backend == 'fake':
+        # Imported here as fakedisplay builds on this module.
+        from . import fakedisplay
+        ret = fakedisplay.FakeDisplay(displayname)
+    elif backend == 'xcb':
+        try:
+            from . import xcbdisplay
+        except ImportError as e:
+            raise DisplayError('xcb backend unavailable: {}'.format(e))
+        ret = xcbdisplay.XcbDisplay(displayname)
+    elif backend == 'xlib':
+        ret = Display(displayname)
+    else:
+        raise DisplayError('Unknown display backend {}'.format(backend))
+    return ret
+
+def roundtrip(count=1):
+    """ Decorator for Display methods that wait on a reply from the X server.
+    Display.roundtrips keeps a running total so that callers (and benchmarks) can see what an operation costs. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            self.requests.direct(count)
+            self.roundtrips += count
+            return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def request(func):
+    """ Decorator for Display methods that make a request that can't be coalesced. See RequestQueue. """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.requests.direct()
+        return func(self, *args, **kwargs)
+    return wrapper
+
+class RequestQueue:
+    """ Coalesce the requests made during one event dispatch cycle.
+
+    While a batch is open (see Display.batch) map/unmap, moveresize and property replace requests are held and keyed by
+    what they change. A later request with the same key supersedes the held one, eg map-then-unmap of a window only
+    sends the unmap and repeated _NET_CLIENT_LIST writes only send the last list. Property appends are joined on to
+    the held request for the property, see Display.changeproperty.
+
+    Held requests are sent before any other request is made (and before any reply is waited on) so the server still
+    sees requests in the order they were made. """
+
+    def __init__(self):
+        # dict(key -> (func, args))
+        self._pending = collections.OrderedDict()
+        # Number of open batches.
+        self.depth = 0
+        # Counts for the current cycle, and the last completed cycle.
+        self.counts = collections.Counter()
+        self.lastcounts = collections.Counter()
+
+    def put(self, key, func, *args):
+        """ Make a coalescable request. """
+        self.counts['requested'] += 1
+        if self.depth:
+            if key in self._pending:
+                self.counts['coalesced'] += 1
+            # A superseding request keeps the held one's place in the send order, so eg moveresize, map, moveresize of
+            # a window still sends the geometry change before the map.
+            self._pending[key] = (func, args)
+        else:
+            self.counts['sent'] += 1
+            func(*args)
+
+    def held(self, key):
+        """ The (func, args) held for key, or None. """
+        return self._pending.get(key)
+
+    def direct(self, count=1):
+        """ Account for requests that are sent straight away. Held requests must go first. """
+        self.commit()
+        self.counts['requested'] += count
+        self.counts['sent'] += count
+
+    def commit(self):
+        """ Send all held requests. """
+        while self._pending:
+            _, (func, args) = self._pending.popitem(last=False)
+            self.counts['sent'] += 1
+            func(*args)
+
+    def endcycle(self):
+        log.debug('request cycle: requested=%d sent=%d coalesced=%d', self.counts['requested'], self.counts['sent'], self.counts['coalesced'])
+        self.lastcounts = self.counts
+        self.counts = collections.Counter()
+
 class TwodArray:
     """ Abstract away x, y access to a linear list. """
 
@@ -37,6 +169,65 @@ class TwodArray:
         offset = y * self.xwidth + x
         return self.lst[offset]
 
+class AtomTable:
+    """ Interned atoms with O(1) lookup both ways.
+
+    ie, atomtable['WM_STATE'] -> atom id and atomtable.name(atomid) -> 'WM_STATE'
+
+    Names are queued with add() and interned in bulk, with one XInternAtoms round trip, the next time an atom is
+    looked up. Names for atoms that we didn't intern are fetched from the server once and then cached. """
+
+    def __init__(self, display):
+        self._display = display
+        # dict(name -> atom id)
+        self._atoms = {}
+        # dict(atom id -> name)
+        self._names = {}
+        # Names waiting to be interned, in add order.
+        self._pending = []
+
+    def add(self, names):
+        """ Queue names for interning. Names that are already interned (or queued) are skipped. """
+        for name in names:
+            if name not in self._atoms and name not in self._pending:
+                self._pending.append(name)
+
+    def intern(self):
+        """ Intern all queued names. """
+        if self._pending:
+            names, self._pending = self._pending, []
+            for name, atom in zip(names, self._display.internatoms(names)):
+                self._atoms[name] = atom
+                self._names[atom] = name
+
+    def name(self, atom):
+        """ Return the name of the atom id, or None for the None atom (0). """
+        try:
+            ret = self._names[atom]
+        except KeyError:
+            if atom:
+                ret = self._display.getatomname(atom)
+                self._atoms[ret] = atom
+                self._names[atom] = ret
+            else:
+                ret = None
+        return ret
+
+    def __contains__(self, name):
+        return name in self._atoms
+
+    def __getitem__(self, name):
+        try:
+            ret = self._atoms[name]
+        except KeyError:
+            self.add([name])
+            self.intern()
+            ret = self._atoms[name]
+        return ret
+
+    def items(self):
+        return self._atoms.items()
+
 class KeySym:
 
     def __init__(self, keysymid):
@@ -126,37 +317,125 @@ class SizeHints:
     def __str__(self):
         return self._string
 
+class Scratch:
+    """ Preallocated Xlib out-parameters, so that calls made for every event don't build ctypes objects each time.
+
+    A Display keeps one. Its methods copy what they need out of the scratch objects before returning, so the
+    objects are only valid until the next call that uses them. The *_p attributes are the matching byrefs. """
+
+    def __init__(self):
+        # getproperty. See XGetWindowProperty.
+        self.type = xlib.Atom()
+        self.format = ctypes.c_int()
+        self.nitems = ctypes.c_ulong()
+        self.bytes_after = ctypes.c_ulong()
+        self.prop = xlib.byte_p()
+        # The trailing XGetWindowProperty arguments.
+        self.propertyargs = tuple(addr(x) for x in (self.type, self.format, self.nitems, self.bytes_after, self.prop))
+        # getwindowattributes
+        self.windowattributes = xlib.XWindowAttributes()
+        self.windowattributes_p = addr(self.windowattributes)
+        # gettransientfor
+        self.window = xlib.Window()
+        self.window_p = addr(self.window)
+        # getclasshint
+        self.classhint = xlib.XClassHint()
+        self.classhint_p = addr(self.classhint)
+        # getwmname, gettextproperty
+        self.textproperty = xlib.XTextProperty()
+        self.textproperty_p = addr(self.textproperty)
+        # textprop_to_lines
+        self.stringlist = ctypes.POINTER(ctypes.c_char_p)()
+        self.stringlist_p = addr(self.stringlist)
+        # getwmnormalhints. Same layout as the XSizeHints from XAllocSizeHints, which Xlib zeroes and fully
+        # overwrites, so one can be reused.
+        self.sizehints = xlib.SizeHints()
+        self.sizehints_p = addr(self.sizehints)
+        self.supplied = ctypes.c_long()
+        self.supplied_p = addr(self.supplied)
+        # querytree
+        self.root = xlib.Window()
+        self.parent = xlib.Window()
+        self.children = xlib.window_p()
+        self.nchildren = ctypes.c_uint()
+        self.querytreeargs = tuple(addr(x) for x in (self.root, self.parent, self.children, self.nchildren))
+        # displaykeycodes, getkeyboardmapping, getprotocols, textprop_to_lines
+        self.int1 = ctypes.c_int()
+        self.int1_p = addr(self.int1)
+        self.int2 = ctypes.c_int()
+        self.int2_p = addr(self.int2)
+        # getprotocols
+        self.atoms = xlib.atom_p()
+        self.atoms_p = addr(self.atoms)
+
 class Display:
 
     def __init__(self, displayname=None):
         self.displayname = displayname
         #self._errorhandler = None
-        # xh = X handle.
-        self.xh = xlib.xlib.XOpenDisplay(displayname)
-        if self.xh is None:
-            raise DisplayError('Failed to connect to display {}'.format(displayname))
-        self.atom = {}
+        self._connect()
+        self.atom = AtomTable(self)
+        self.requests = RequestQueue()
+        # Running count of requests that waited on a server reply.
+        self.roundtrips = 0
         self._nextevent = xlib.XEvent()
+        self._scratch = Scratch()
         self._init_atoms()
 
+    def _connect(self):
+        # xh = X handle.
+        self.xh = xlib.xlib.XOpenDisplay(self.displayname)
+        # XOpenDisplay returns a NULL pointer on failure, which ctypes doesn't convert to None.
+        if not self.xh:
+            raise DisplayError('Failed to connect to display {}'.format(self.displayname))
+
     def _init_atoms(self):
         """ Initialise common atoms. """
-        # UTF8 data type. This was originally an XFree86 extension.
-        self.add_atom('UTF8_STRING')
-        # From ICCCM.
-        self.add_atom('WM_CLIENT_MACHINE')
-        self.add_atom('WM_STATE')
-        self.add_atom('WM_PROTOCOLS')
-        self.add_atom('WM_DELETE_WINDOW')
-        self.add_atom('WM_TAKE_FOCUS')
+        self.add_atoms([
+                # UTF8 data type. This was originally an XFree86 extension.
+                'UTF8_STRING',
+                # From ICCCM.
+                'WM_CLIENT_MACHINE',
+                'WM_STATE',
+                'WM_PROTOCOLS',
+                'WM_DELETE_WINDOW',
+                'WM_TAKE_FOCUS',
+                ])
 
     def fileno(self):
         """ Allow for use in select. """
         return xlib.xlib.XConnectionNumber(self.xh)
 
-    def add_atom(self, symbol, only_if_exists=False):
-        self.atom[symbol] = xlib.xlib.XInternAtom(self.xh, bytes(symbol, 'utf8'), only_if_exists)
-
+    def add_atom(self, symbol):
+        self.atom.add([symbol])
+
+    def add_atoms(self, symbols):
+        """ Queue atom names for interning. They're all interned together on the next atom lookup. """
+        self.atom.add(symbols)
+
+    @roundtrip()
+    def internatoms(self, symbols, only_if_exists=False):
+        """ Intern symbols in one round trip. Returns the list of atom ids. """
+        count = len(symbols)
+        cnames = (ctypes.c_char_p * count)(*[bytes(s, 'utf8') for s in symbols])
+        catoms = (xlib.Atom * count)()
+        xlib.xlib.XInternAtoms(self.xh, cnames, count, only_if_exists, catoms)
+        return list(catoms)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Coalesce requests made within the block. They're all sent with a single flush when the outermost batch ends. """
+        self.requests.depth += 1
+        try:
+            yield
+        finally:
+            self.requests.depth -= 1
+            if self.requests.depth == 0:
+                self.requests.commit()
+                self.flush()
+                self.requests.endcycle()
+
+    @request
     def allowevents(self, aevents, time=xlib.CurrentTime):
         log.debug('0x%08x: XAllowEvents aevents=%s', window.window, aevents)
         return xlib.xlib.XAllowEvents(self.xh, aevents, time)
@@ -166,13 +445,46 @@ class Display:
             w = window.window
         except AttributeError:
             w = window
-        return xlib.xlib.XChangeProperty(self.xh, w, self.atom[propertyname], type_, format_, mode, ctypes.cast(data, xlib.byte_p), nelements)
-
+        atom = self.atom[propertyname]
+        key = ('property', w, atom)
+        held = self.requests.held(key) if self.requests.depth else None
+        if mode == xlib.PropMode.Append and held is not None and held[1][2:4] == (type_, format_):
+            # Join on to the held replace or append, so that it's still one request.
+            _, (_, _, _, _, mode, helddata, heldelements) = held
+            data, nelements = self._joinpropertydata(format_, helddata, heldelements, data, nelements)
+            self.requests.put(key, self._changeproperty, w, atom, type_, format_, mode, data, nelements)
+        elif mode == xlib.PropMode.Replace or (mode == xlib.PropMode.Append and held is None):
+            if self.requests.depth:
+                # Request will be held, so take a copy of data as the caller is free to reuse it.
+                data, _ = self._joinpropertydata(format_, None, 0, data, nelements)
+            self.requests.put(key, self._changeproperty, w, atom, type_, format_, mode, data, nelements)
+        else:
+            self.requests.direct()
+            self._changeproperty(w, atom, type_, format_, mode, data, nelements)
+
+    @staticmethod
+    def _joinpropertydata(format_, helddata, heldelements, data, nelements):
+        """ Copy of held property data followed by data. Returns (buffer, nelements). """
+        # Format 32 data is passed to Xlib as longs.
+        itemsize = ctypes.sizeof(ctypes.c_long) if format_ == 32 else format_ // 8
+        heldsize = heldelements * itemsize
+        size = nelements * itemsize
+        buf = (ctypes.c_ubyte * (heldsize + size))()
+        if heldsize:
+            ctypes.memmove(buf, helddata, heldsize)
+        ctypes.memmove(ctypes.addressof(buf) + heldsize, data, size)
+        return buf, heldelements + nelements
+
+    def _changeproperty(self, w, atom, type_, format_, mode, data, nelements):
+        xlib.xlib.XChangeProperty(self.xh, w, atom, type_, format_, mode, ctypes.cast(data, xlib.byte_p), nelements)
+
+    @request
     def configurewindow(self, windowid, changemask, windowchanges):
         # XXX Note that window is the number for now.
         log.debug('0x%08x: XConfigureWindow', windowid)
         xlib.xlib.XConfigureWindow(self.xh, windowid, changemask, addr(windowchanges))
 
+    @request
     def createsimplewindow(self, parent, x, y, w, h, borderw, border, background):
         # XXX Should we wrap the return in a Window object?
         return xlib.xlib.XCreateSimpleWindow(self.xh, parent.window, x, y, w, h, borderw, border, background)
@@ -181,17 +493,17 @@ class Display:
     def defaultrootwindow(self):
         return xlib.xlib.XDefaultRootWindow(self.xh)
 
+    @request
     def destroywindow(self, window):
         # XXX Note that window is the number for now.
-        log.debug('0x%08x: XDestroyWindow', window.window)
+        log.debug('0x%08x: XDestroyWindow', window)
         xlib.xlib.XDestroyWindow(self.xh, window)
 
     @property
     def displaykeycodes(self):
-        kmin = ctypes.c_int()
-        kmax = ctypes.c_int()
-        xlib.xlib.XDisplayKeycodes(self.xh, addr(kmin), addr(kmax))
-        return kmin.value, kmax.value
+        scratch = self._scratch
+        xlib.xlib.XDisplayKeycodes(self.xh, scratch.int1_p, scratch.int2_p)
+        return scratch.int1.value, scratch.int2.value
 
     @property
     def errorhandler(self):
@@ -218,15 +530,17 @@ class Display:
     def free(self, xobject):
         xlib.xlib.XFree(xobject)
 
+    @roundtrip()
     def getatomname(self, atom, encoding='latin1'):
         caname = xlib.xlib.XGetAtomName(self.xh, atom)
         aname = str(ctypes.cast(caname, ctypes.c_char_p).value, encoding)
         self.free(caname)
         return aname
 
+    @roundtrip()
     def getkeyboardmapping(self, keymin, keycount):
-        keysyms_per_keycode = ctypes.c_int()
-        kbmapping = xlib.xlib.XGetKeyboardMapping(self.xh, keymin, keycount, ctypes.byref(keysyms_per_keycode))
+        keysyms_per_keycode = self._scratch.int1
+        kbmapping = xlib.xlib.XGetKeyboardMapping(self.xh, keymin, keycount, self._scratch.int1_p)
         #print('keysyms/keycode={}'.format(keysyms_per_keycode.value))
         kbarray = TwodArray(kbmapping, keysyms_per_keycode.value)
         # Convert to non-ctypes.
@@ -235,53 +549,53 @@ class Display:
         self.free(kbmapping)
         return ret
 
+    @roundtrip()
     def gettransientfor(self, windowid):
         """ Is the window a transient (eg, a modal dialog box for another window?).
         If it is, return that window's xwindow id. """
-        tf = xlib.Window()
-        tstatus = xlib.xlib.XGetTransientForHint(self.xh, windowid, addr(tf))
+        tstatus = xlib.xlib.XGetTransientForHint(self.xh, windowid, self._scratch.window_p)
         if tstatus > 0:
             # window is transient, transientfor will contain the window id of the parent window.
-            transientfor = tf.value
+            transientfor = self._scratch.window.value
         else:
             transientfor = None
         return transientfor
 
+    @roundtrip()
     def getclasshint(self, window):
-        xch = xlib.XClassHint()
-        status = xlib.xlib.XGetClassHint(self.xh, window.window, ctypes.byref(xch))
+        xch = self._scratch.classhint
+        status = xlib.xlib.XGetClassHint(self.xh, window.window, self._scratch.classhint_p)
         if status > 0:
             # See xlib.py: XClassHint for why we can't use ctypes.c_char_p here.
-            ret = str(ctypes.cast(xch.res_name, ctypes.c_char_p).value, 'utf8'), str(ctypes.cast(xch.res_class, ctypes.c_char_p).value, 'utf8')
-            if xch.res_name.contents is not None:
+            # WM_CLASS is a STRING property, so it's Latin-1 (ICCCM 4.1.2.5).
+            ret = str(ctypes.cast(xch.res_name, ctypes.c_char_p).value or b'', 'latin1'), str(ctypes.cast(xch.res_class, ctypes.c_char_p).value or b'', 'latin1')
+            # NULL pointers are false, .contents of one raises ValueError.
+            if xch.res_name:
                 self.free(xch.res_name)
-            if xch.res_class.contents is not None:
+            if xch.res_class:
                 self.free(xch.res_class)
         else:
             ret = "", ""
         return ret
 
+    @roundtrip()
     def getprotocols(self, window):
-        catoms = xlib.atom_p()
-        ncount = ctypes.c_int()
-        status = xlib.xlib.XGetWMProtocols(self.xh, window.window, addr(catoms), addr(ncount))
+        catoms = self._scratch.atoms
+        ncount = self._scratch.int1
+        status = xlib.xlib.XGetWMProtocols(self.xh, window.window, self._scratch.atoms_p, self._scratch.int1_p)
         protocols = {}
         if status != 0:
-            aids = [catoms[i] for i in range(ncount.value)]
+            aids = catoms[:ncount.value]
             self.free(catoms)
-            atomnames = {v: k for k, v in self.atom.items()}
             for aid in aids:
-                try:
-                    aname = atomnames[aid]
-                except KeyError:
-                    aname = self.getatomname(aid)
-                    log.debug('0x%08x: Unsupported WM_PROTOCOL atom %s=%d', window.window, aname, aid)
-                protocols[aname] = aid
+                protocols[self.atom.name(aid)] = aid
         return protocols
 
+    # XGetWindowAttributes makes both a GetWindowAttributes and a GetGeometry request.
+    @roundtrip(2)
     def getwindowattributes(self, windowid):
-        wa = xlib.XWindowAttributes()
-        astatus = xlib.xlib.XGetWindowAttributes(self.xh, windowid, ctypes.byref(wa))
+        wa = self._scratch.windowattributes
+        astatus = xlib.xlib.XGetWindowAttributes(self.xh, windowid, self._scratch.windowattributes_p)
         if astatus > 0:
             # XGetWindowAttr completed successfully.
             # Extract the parts of XWindowAttributes that we need.
@@ -295,6 +609,45 @@ class Display:
             ret = None
         return ret
 
+    def getwindowinfo(self, windowids):
+        """ Bulk fetch what's needed to import existing windows, eg at window manager startup.
+        Returns [(windowid, WindowInfo)] in windowids order. Windows that have gone away are dropped.
+
+        Only the requests that the import can make use of are made. ie, transient hints and WM_STATE are never read
+        for override_redirect windows as they'll never be managed, and WM_STATE is only needed to decide whether to
+        manage windows that aren't already viewable.
+
+        Xlib only offers blocking calls, so this will still cost a round trip per request. Display backends that can
+        pipeline requests should override this and collect all replies in one pass. """
+        attrs = [(wid, self.getwindowattributes(wid)) for wid in windowids]
+        infos = []
+        for wid, attributes in attrs:
+            if attributes is None:
+                continue
+            override_redirect, _, map_state = attributes
+            transientfor = None
+            properties = {}
+            if not override_redirect:
+                transientfor = self.gettransientfor(wid)
+                if map_state != xlib.MapState.IsViewable:
+                    properties['WM_STATE'] = self._getwmstate(wid)
+            infos.append((wid, WindowInfo(attributes, transientfor, properties)))
+        return infos
+
+    def getclientwindowinfo(self, windowids, propnames=()):
+        """ Bulk fetch what's needed to make client side window objects. Returns [(windowid, WindowInfo)] in
+        windowids order, windows that have gone away are dropped.
+
+        propnames are the properties a backend that can pipeline requests should read ahead of time. Values are
+        stored by property cache key, see utils.cachedproperty and clientproperties. Xlib would need a round trip
+        per property, which may not be needed, so only the window attributes are read here. """
+        infos = []
+        for wid in windowids:
+            attributes = self.getwindowattributes(wid)
+            if attributes is not None:
+                infos.append((wid, WindowInfo(attributes, None, {})))
+        return infos
+
     def getwmclientmachine(self, window):
         machines = self.gettextproperty(window, 'WM_CLIENT_MACHINE')
         if machines:
@@ -303,10 +656,11 @@ class Display:
             ret = ''
         return ret
 
+    @roundtrip()
     def getwmname(self, window):
         name = None
-        xtp = xlib.XTextProperty()
-        status = xlib.xlib.XGetWMName(self.xh, window.window, addr(xtp))
+        xtp = self._scratch.textproperty
+        status = xlib.xlib.XGetWMName(self.xh, window.window, self._scratch.textproperty_p)
         if status > 0:
             #log.debug('xtp %s', xtp)
             if xtp.nitems > 0:
@@ -317,6 +671,7 @@ class Display:
                 self.free(xtp.value)
         return name
 
+    @roundtrip()
     def getwmhints(self, win):
         cwmhints_p = xlib.xlib.XGetWMHints(self.xh, win.window)
         if cwmhints_p:
@@ -326,95 +681,149 @@ class Display:
             wmhints = None
         return wmhints
 
+    @roundtrip()
     def getwmnormalhints(self, win):
-        # Use XAllocSizeHints as the size hints structure may change (but not likely), but must be free'd.
-        cpsizehints = xlib.xlib.XAllocSizeHints(None)
-        lret = ctypes.c_long()
-        status = xlib.xlib.XGetWMNormalHints(self.xh, win.window, cpsizehints, addr(lret))
+        scratch = self._scratch
+        status = xlib.xlib.XGetWMNormalHints(self.xh, win.window, scratch.sizehints_p, scratch.supplied_p)
         if status != 0:
-            hints = SizeHints(cpsizehints.contents)
-            self.free(cpsizehints)
+            hints = SizeHints(scratch.sizehints)
         else:
             hints = None
         log.debug("0x%08x: getwmnormalsizehints status=%d hints=%s", win.window, status, hints)
         return hints
 
+    def getproperty(self, windowid, propertyname, type_=xlib.AnyPropertyType, length=None, delete=False):
+        """ Return (type-atom, format, data) of the property, or None if it's not set or isn't of type_.
+
+        data is a bytearray for format 8 properties, and an array.array for format 16 and 32 (see propertytypecodes)
+        that holds the whole property, or at most length 32 bit units of it. Xlib replies are copied straight into
+        data, which is sized from the first reply so it's only allocated once. Large properties are read
+        propertychunk at a time.
+
+        With delete=True the property is deleted by the read that reaches its end. """
+        atom = self.atom[propertyname]
+        out = self._scratch
+        data = None
+        while True:
+            if data is None:
+                # In 32 bit units, as are XGetWindowProperty offset and length.
+                offset = 0
+                want = propertychunk if length is None else min(length, propertychunk)
+                pos = 0
+            self.requests.direct()
+            self.roundtrips += 1
+            status = xlib.xlib.XGetWindowProperty(self.xh, windowid, atom, offset, want, delete, type_, *out.propertyargs)
+            if status != 0:
+                return None
+            format_ = out.format.value
+            nitems = out.nitems.value
+            if format_ == 0 or (type_ != xlib.AnyPropertyType and out.type.value != type_):
+                # Not set, or of another type in which case nothing was read.
+                if out.prop:
+                    self.free(out.prop)
+                return None
+            after = out.bytes_after.value // (format_ // 8)
+            if data is None:
+                # Items in the whole property.
+                full = nitems + after
+                data = _propertydata(format_, full if length is None else min(full, length * 32 // format_))
+            elif pos + nitems + after != full:
+                # The property changed between reads.
+                log.debug('0x%08x: getproperty %s changed while reading', windowid, propertyname)
+                if after:
+                    self.free(out.prop)
+                    data = None
+                    continue
+                # This was the last read (and may have deleted the property), keep what there is.
+                del data[pos + nitems:]
+            count = min(nitems, len(data) - pos)
+            if count:
+                itemsize = _propertyitemsizes[format_]
+                ctypes.memmove((ctypes.c_char * (count * itemsize)).from_buffer(data, pos * itemsize), out.prop, count * itemsize)
+            self.free(out.prop)
+            pos += count
+            if after == 0 or pos == len(data):
+                break
+            offset += nitems * format_ // 32
+            want = min(propertychunk, -(-(len(data) - pos) * format_ // 32))
+        return out.type.value, format_, data
+
+    def setproperty(self, window, propertyname, type_, format_, data, mode=xlib.PropMode.Replace):
+        """ Write a property from a buffer, the counterpart to getproperty. data is bytes or a bytearray for format 8,
+        and an array.array of the propertytypecodes typecode for format 16 and 32. It's passed to Xlib without a copy.
+        See changeproperty. """
+        view = memoryview(data)
+        if view.itemsize != _propertyitemsizes[format_]:
+            raise DisplayError('format {} property {} data must be array.array({!r})'.format(format_, propertyname, propertytypecodes[format_]))
+        nelements = len(view)
+        if view.readonly:
+            buf = data
+        else:
+            # Pass the address rather than a from_buffer array. ctypes.cast in _changeproperty makes a reference cycle
+            # that would keep the buffer exported, and so stop a bytearray or array being resized, until gc runs.
+            # data must stay referenced until the request has been sent or copied.
+            buf = ctypes.c_void_p(ctypes.addressof((ctypes.c_char * view.nbytes).from_buffer(data)) if view.nbytes else None)
+        # Release the export, a held buffer view would stop a bytearray or array being resized.
+        view.release()
+        self.changeproperty(window, propertyname, type_, format_, mode, buf, nelements)
+
     def getwmstate(self, window):
-        state = None
+        return self._getwmstate(window.window)
+
+    def _getwmstate(self, windowid):
         WM_STATE = self.atom['WM_STATE']
-        actual_type_return = xlib.Atom()
-        actual_format_return = ctypes.c_int()
-        nitems_return = ctypes.c_ulong(0)
-        bytes_after_return = ctypes.c_ulong()
-        prop_return = xlib.byte_p()
-        # sizeof return WmState struct in length of longs, not bytes. See XGetWindowProperty
-        long_length = int(ctypes.sizeof(xlib.WmState) / ctypes.sizeof(ctypes.c_long))
-
-        ret = xlib.xlib.XGetWindowProperty(self.xh, window.window, WM_STATE, 0, long_length, False, WM_STATE, addr(actual_type_return), addr(actual_format_return), addr(nitems_return), addr(bytes_after_return), addr(prop_return))
-        if ret == 0:
-            # Success! We need also check if anything was returned..
-            if nitems_return.value > 0:
-                # This wm doesn't support window icons, so only return WmState.state.
-                sp = ctypes.cast(prop_return, xlib.wmstate_p).contents
-                state = sp.state
-            xlib.xlib.XFree(prop_return)
-        return state
+        # This wm doesn't support window icons, so only read WmState.state.
+        prop = self.getproperty(windowid, 'WM_STATE', WM_STATE, length=1)
+        return wmstatestate(windowid, prop[2][0]) if prop and prop[2] else None
 
     def getcardinalproperty(self, win, propname):
-        cardinal = None
-        propatom = self.atom[propname]
-        actual_type_return = xlib.Atom()
-        actual_format_return = ctypes.c_int()
-        nitems_return = ctypes.c_ulong(0)
-        bytes_after_return = ctypes.c_ulong()
-        prop_return = xlib.byte_p()
-        llen = 1
-        ret = xlib.xlib.XGetWindowProperty(self.xh, win.window, propatom, 0, llen, False, xlib.XA.CARDINAL, addr(actual_type_return), addr(actual_format_return), addr(nitems_return), addr(bytes_after_return), addr(prop_return))
-        if ret == 0:
-            if nitems_return.value > 0:
-                cardinal = ctypes.cast(prop_return, xlib.uint_p).contents.value
-            self.free(prop_return)
-        log.debug('0x%08x: getcardinalproperty %s llen=%d ret=%d', win.window, propname, llen, ret)
+        prop = self.getproperty(win.window, propname, xlib.XA.CARDINAL, length=1)
+        cardinal = prop[2][0] if prop and prop[2] else None
+        log.debug('0x%08x: getcardinalproperty %s cardinal=%s', win.window, propname, cardinal)
         return cardinal
 
     def setcardinalproperty(self, win, propname, value):
-        ccardinal = xlib.Cardinal(value)
-        self.changeproperty(win, propname, xlib.XA.CARDINAL, 32, xlib.PropMode.Replace, ctypes.byref(ccardinal), 1)
+        self.setcardinalproperties(win, propname, [value])
+
+    def getcardinalproperties(self, win, propname):
+        """ Return array.array('L') of the property values. Empty if it's not set. """
+        prop = self.getproperty(win.window, propname, xlib.XA.CARDINAL)
+        return _propertydata(32, 0) if prop is None else prop[2]
+
+    def getbytesproperty(self, win, propname, delete=False):
+        """ Return (type-atom, bytearray) of a format 8 property, or None if it's not set.
+        With delete=True the property is read and deleted, but only if it is format 8. """
+        if delete:
+            # Check the type and format before the read that deletes, a property of another format would be lost
+            # without being read. Reading by type doesn't delete it if it's since been replaced with another type.
+            prop = self.getproperty(win.window, propname, length=0)
+            if prop is None:
+                return None
+            type_, format_, _ = prop
+            if format_ != 8:
+                log.error('0x%08x: %s ignored, format %d type %s is not format 8', win.window, propname, format_, self.getatomname(type_))
+                return None
+            prop = self.getproperty(win.window, propname, type_, delete=True)
+        else:
+            prop = self.getproperty(win.window, propname)
+        if prop is not None and prop[1] == 8:
+            return prop[0], prop[2]
+        return None
+
+    def setcardinalproperties(self, win, propname, values):
+        self.setproperty(win, propname, xlib.XA.CARDINAL, 32, array.array(propertytypecodes[32], values))
 
     def getpropertywindowid(self, win, propname):
-        wid = None
-        propatom = self.atom[propname]
-        actual_type_return = xlib.Atom()
-        actual_format_return = ctypes.c_int()
-        nitems_return = ctypes.c_ulong(0)
-        bytes_after_return = ctypes.c_ulong()
-        prop_return = xlib.byte_p()
-        llen = int(ctypes.sizeof(xlib.Window) / ctypes.sizeof(ctypes.c_long))
-        #llen = 1
-        ret = xlib.xlib.XGetWindowProperty(self.xh, win.window, propatom, 0, llen, False, xlib.XA.WINDOW, addr(actual_type_return), addr(actual_format_return), addr(nitems_return), addr(bytes_after_return), addr(prop_return))
-        if ret == 0:
-            if nitems_return.value > 0:
-                wid = ctypes.cast(prop_return, xlib.window_p).contents.value
-            self.free(prop_return)
-        return wid
+        prop = self.getproperty(win.window, propname, xlib.XA.WINDOW, length=1)
+        return prop[2][0] if prop and prop[2] else None
 
     def getpropertywindowids(self, win, propname):
-        wids = []
-        propatom = self.atom[propname]
-        actual_type_return = xlib.Atom()
-        actual_format_return = ctypes.c_int()
-        nitems_return = ctypes.c_ulong(0)
-        bytes_after_return = ctypes.c_ulong()
-        prop_return = xlib.byte_p()
-        llen = 4096
-        ret = xlib.xlib.XGetWindowProperty(self.xh, win.window, propatom, 0, llen, False, xlib.XA.WINDOW, addr(actual_type_return), addr(actual_format_return), addr(nitems_return), addr(bytes_after_return), addr(prop_return))
-        if ret == 0:
-            data = ctypes.cast(prop_return, xlib.window_p)
-            wids = [data[i] for i in range(nitems_return.value)]
-            self.free(prop_return)
-        return wids
+        """ Return array.array('L') of the window ids in the property. Empty if it's not set. """
+        prop = self.getproperty(win.window, propname, xlib.XA.WINDOW)
+        return _propertydata(32, 0) if prop is None else prop[2]
 
     @property
+    @roundtrip()
     def keymodifiercodes(self):
         xmodmap = xlib.xlib.XGetModifierMapping(self.xh)
         keypermod = xmodmap.contents.max_keypermod
@@ -425,6 +834,7 @@ class Display:
         self.free(xmodmap)
         return ret
 
+    @request
     def grabkey(self, keycode, modifiermask, grabwindow, ownerevents, pointermode, keyboardmode):
         log.debug('0x%08x: XGrabKey keycode=%d modmask=0x%08x', grabwindow.window, keycode, modifiermask)
         xlib.xlib.XGrabKey(self.xh, keycode, modifiermask, grabwindow.window, ownerevents, pointermode, keyboardmode)
@@ -447,11 +857,17 @@ class Display:
 
     def mapwindow(self, window):
         log.debug('0x%08x: XMapWindow', window.window)
-        xlib.xlib.XMapWindow(self.xh, window.window)
+        self.requests.put(('mapstate', window.window), self._mapwindow, window.window)
+
+    def _mapwindow(self, windowid):
+        xlib.xlib.XMapWindow(self.xh, windowid)
 
     def moveresizewindow(self, window, x, y, w, h):
         log.debug('0x%08x: XMoveResizeWindow x=%d y=%d w=%d h=%d', window.window, x, y, w, h)
-        xlib.xlib.XMoveResizeWindow(self.xh, window.window, x, y, w, h)
+        self.requests.put(('geometry', window.window), self._moveresizewindow, window.window, x, y, w, h)
+
+    def _moveresizewindow(self, windowid, x, y, w, h):
+        xlib.xlib.XMoveResizeWindow(self.xh, windowid, x, y, w, h)
 
     @property
     def nextevent(self):
@@ -462,34 +878,49 @@ class Display:
     def pendingevents(self):
         return xlib.xlib.XPending(self.xh)
 
+    def checkwindowevent(self, window, eventmask):
+        """ Remove and return the first event for window that matches eventmask, or None if there isn't one.
+        Other events stay queued. Like nextevent, the returned event is reused by the next call. """
+        if xlib.xlib.XCheckWindowEvent(self.xh, window.window, eventmask, addr(self._nextevent)):
+            return self._nextevent
+        return None
+
+    @property
+    def queuedevents(self):
+        """ Like pendingevents, but will not flush the output buffer. Used while batching requests. """
+        return xlib.xlib.XEventsQueued(self.xh, xlib.QueuedAfterReading)
+
+    @roundtrip()
     def querytree(self, window):
-        root_return = xlib.Window(0)
-        parent_of_root = xlib.Window(0)
-        childrenp = xlib.window_p()
-        nchildren = ctypes.c_uint(0)
+        scratch = self._scratch
         # XXX assert that root_return == root?
-        status = xlib.xlib.XQueryTree(self.xh, window.window, addr(root_return), addr(parent_of_root), addr(childrenp), addr(nchildren))
-        children = [childrenp[i] for i in range(nchildren.value)]
-        if nchildren.value > 0:
-            self.free(childrenp)
+        status = xlib.xlib.XQueryTree(self.xh, window.window, *scratch.querytreeargs)
+        children = []
+        if status != 0 and scratch.nchildren.value > 0:
+            children = scratch.children[:scratch.nchildren.value]
+            self.free(scratch.children)
         return children
 
+    @request
     def selectinput(self, window, eventmask):
         log.debug('0x%08x: XSelectInput eventmask=0x%0x', window.window, eventmask)
         xlib.xlib.XSelectInput(self.xh, window.window, eventmask)
 
+    @request
     def sendevent(self, window, event, eventtype=xlib.InputEventMask.NoEvent):
         """ Do the fancy ctypes event casting before calling XSendEvent. """
         status = xlib.xlib.XSendEvent(self.xh, window.window, False, eventtype, ctypes.cast(ctypes.byref(event), xlib.xevent_p))
         return status != 0
 
+    @request
     def setinputfocus(self, window, revertto, time=xlib.CurrentTime):
         log.debug('0x%08x: XSetInputFocus', window.window)
         xlib.xlib.XSetInputFocus(self.xh, window.window, revertto, time)
 
+    @roundtrip()
     def gettextproperty(self, window, propertyname):
-        tp = xlib.XTextProperty()
-        status = xlib.xlib.XGetTextProperty(self.xh, window.window, addr(tp), self.atom[propertyname])
+        tp = self._scratch.textproperty
+        status = xlib.xlib.XGetTextProperty(self.xh, window.window, self._scratch.textproperty_p, self.atom[propertyname])
         if status != 0:
             # Convert to list of strings and free the XTextProperty data.
             ret = self.textprop_to_lines(tp)
@@ -498,6 +929,7 @@ class Display:
             ret = []
         return ret
 
+    @request
     def settextproperty(self, window, strings, propertyname):
         slen = len(strings)
         cstrs = (ctypes.c_char_p * slen)()
@@ -514,11 +946,11 @@ class Display:
         state.state = xlib.WmStateState(winstate)
         state.icon = 0
         WM_STATE = self.atom['WM_STATE']
-        data_p = ctypes.cast(addr(state), xlib.byte_p)
         long_length = int(ctypes.sizeof(state) / ctypes.sizeof(ctypes.c_long))
         # Specify as 32 (longs), that way the Xlib client will handle endian translations.
-        xlib.xlib.XChangeProperty(self.xh, window.window, WM_STATE, WM_STATE, 32, xlib.PropMode.Replace, data_p, long_length)
+        self.changeproperty(window, 'WM_STATE', WM_STATE, 32, xlib.PropMode.Replace, addr(state), long_length)
 
+    @roundtrip()
     def sync(self, discard=False):
         log.debug('XSync discard=%s', discard)
         xlib.xlib.XSync(self.xh, discard)
@@ -561,15 +993,16 @@ class Display:
 #            #log.error('************ UNSUPPORTED TEXT ENCODING ATOM=%s %s', xtextprop.encoding, atomname)
 #            self.free(atomname)
         if enc:
-            nitems = ctypes.c_int()
-            list_return = ctypes.POINTER(ctypes.c_char_p)()
-            status = convertfunc(addr(xtextprop), addr(list_return), addr(nitems))
+            nitems = self._scratch.int2
+            list_return = self._scratch.stringlist
+            status = convertfunc(addr(xtextprop), self._scratch.stringlist_p, self._scratch.int2_p)
             if successp(status):
-                lines = [str(list_return[i], enc) for i in range(nitems.value)]
+                lines = [str(x, enc) for x in list_return[:nitems.value]]
                 #log.debug('xtext lines %s', lines)
                 xlib.xlib.XFreeStringList(list_return)
         return lines
 
+    @request
     def ungrabkey(self, keycode, modifiermask, grabwindow):
         log.debug('0x%08x: XUngrabKey keycode=%d modmask=0x%0x', grabwindow.window, keycode, modifiermask)
         xlib.xlib.XUngrabKey(self.xh, keycode, modifiermask, grabwindow.window)
@@ -577,6 +1010,9 @@ class Display:
     def unmapwindow(self, windowid):
         # XXX window must be an actual windowid for now. There may still be cases where we need to unmap a window with no associated object.
         log.debug('0x%08x: XUnmapWindow', windowid)
+        self.requests.put(('mapstate', windowid), self._unmapwindow, windowid)
+
+    def _unmapwindow(self, windowid):
         xlib.xlib.XUnmapWindow(self.xh, windowid)
 
     def __del__(self):
@@ -16,32 +16,34 @@ ewmh_version = (ewmh_major, ewmh_minor)
 import ctypes
 
 from . import log as logmodule
+from . import utils
 from . import xlib
 
 log = logmodule.make(name=__name__)
 
+# Supported EWMH atoms.
+supported = (
+        '_NET_ACTIVE_WINDOW',
+        '_NET_CLIENT_LIST',
+        '_NET_CLIENT_LIST_STACKING',
+        '_NET_CLOSE_WINDOW',
+        '_NET_CURRENT_DESKTOP',
+        '_NET_DESKTOP_NAMES',
+        '_NET_NUMBER_OF_DESKTOPS',
+        '_NET_SUPPORTING_WM_CHECK',
+        '_NET_WM_DESKTOP',
+        '_NET_WM_FULL_PLACEMENT',
+        '_NET_WM_NAME',
+        )
+
 class Base:
 
-    def __init__(self, display, windowid):
+    def __init__(self, display, windowid, **kwargs):
         """ Initialise EWMH support. """
-        super().__init__(display, windowid)
-        ## Initialise EWMH ATOMs.
-        self.supported = [
-                # Supported EWMH atoms.
-                '_NET_ACTIVE_WINDOW',
-                '_NET_CLIENT_LIST',
-                '_NET_CLIENT_LIST_STACKING',
-                '_NET_CLOSE_WINDOW',
-                '_NET_CURRENT_DESKTOP',
-                '_NET_DESKTOP_NAMES',
-                '_NET_NUMBER_OF_DESKTOPS',
-                '_NET_SUPPORTING_WM_CHECK',
-                '_NET_WM_DESKTOP',
-                '_NET_WM_FULL_PLACEMENT',
-                '_NET_WM_NAME',
-                ]
-        for s in self.supported:
-            self.display.add_atom(s)
+        super().__init__(display, windowid, **kwargs)
+        ## Initialise EWMH ATOMs. Only the first window will actually queue any for interning.
+        self.supported = supported
+        self.display.add_atoms(supported)
         self.display.add_atom('_NET_SUPPORTED')
 
     @property
@@ -59,7 +61,7 @@ class Base:
         """ _NET_DESKTOP_NAMES """
         self.display.settextproperty(self, names, '_NET_DESKTOP_NAMES')
 
-    @property
+    @utils.cachedproperty('_NET_WM_NAME', 'WM_NAME')
     def name(self):
         try:
             n = self.display.gettextproperty(self, '_NET_WM_NAME')[0]
@@ -71,7 +73,7 @@ class Base:
 class WmWindowClientWindowMixin(Base):
     """ EWMH window support for client and window manager windows. """
 
-    @property
+    @utils.cachedproperty('_NET_WM_DESKTOP')
     def desktop(self):
         """ _NET_WM_DESKTOP """
         return self.display.getcardinalproperty(self, '_NET_WM_DESKTOP')
@@ -86,28 +88,40 @@ class WmWindowMixin(WmWindowClientWindowMixin):
     @desktop.setter
     def desktop(self, index):
         self.display.setcardinalproperty(self, '_NET_WM_DESKTOP', index)
+        if self.watchingproperties:
+            self._propcache['_NET_WM_DESKTOP'] = index
 
 class ClientRootMixin(Base):
-    """ EWMH root window support for client windows. """
+    """ EWMH root window support for client windows.
+    Root properties are cached while PropertyChange is selected on the root. See window.ClientRoot mirror. """
 
     @property
     def clientlist(self):
         """ _NET_CLIENT_LIST """
-        return self._getwindows('_NET_CLIENT_LIST')
+        return self._getwindows(self.clientlistids)
 
     @property
     def clientliststacking(self):
         """ _NET_CLIENT_LIST_STACKING """
         # This atom stores stacking order from bottom to top, but for code it's easier
         # to work with top window at index 0 so internally work with a reversed list.
-        return list(reversed(self._getwindows('_NET_CLIENT_LIST_STACKING')))
+        return list(reversed(self._getwindows(self._clientliststackingids)))
 
-    def _getwindows(self, propname):
-        wids = self.display.getpropertywindowids(self, propname)
-        for wid in wids:
-            if wid not in self.children:
-                self.newchild(wid)
-        return [self.children[x] for x in wids]
+    @utils.cachedproperty('_NET_CLIENT_LIST')
+    def clientlistids(self):
+        """ _NET_CLIENT_LIST window ids. """
+        return self.display.getpropertywindowids(self, '_NET_CLIENT_LIST')
+
+    @utils.cachedproperty('_NET_CLIENT_LIST_STACKING')
+    def _clientliststackingids(self):
+        return self.display.getpropertywindowids(self, '_NET_CLIENT_LIST_STACKING')
+
+    def _getwindows(self, wids):
+        new = [wid for wid in wids if wid not in self.children]
+        if new:
+            self.newchildren(new)
+        # Windows destroyed since the list was published won't have been made.
+        return [self.children[x] for x in wids if x in self.children]
 
     @property
     def activewindow(self):
@@ -125,7 +139,7 @@ class ClientRootMixin(Base):
     def closewindow(self, win):
         self.clientmessage('_NET_CLOSE_WINDOW', win=win)
 
-    @property
+    @utils.cachedproperty('_NET_CURRENT_DESKTOP')
     def currentdesktop(self):
         return super().currentdesktop
 
@@ -133,6 +147,10 @@ class ClientRootMixin(Base):
     def currentdesktop(self, value):
         self.clientmessage('_NET_CURRENT_DESKTOP', l0=value)
 
+    @utils.cachedproperty('_NET_DESKTOP_NAMES')
+    def desktopnames(self):
+        return super().desktopnames
+
     def setwindowdesktop(self, win, desktopindex):
         # We're setting pager source to unspecified (l1=0). This wm doesn't care about the source of this message, eg apps or pagers.
         self.clientmessage('_NET_WM_DESKTOP', win=win, l0=desktopindex, l1=0)
@@ -157,8 +175,10 @@ class ClientRootMixin(Base):
 class WmRootMixin(Base):
     """ EWMH WindowManager Root window support. """
 
-    def __init__(self, display, windowid):
-        super().__init__(display, windowid)
+    def __init__(self, display, windowid, **kwargs):
+        super().__init__(display, windowid, **kwargs)
+        # Last published window lists. dict(propname -> array('L') of window ids)
+        self._published = {}
         self._installwmsupport()
         self._initsupportingwmcheck()
 
@@ -210,16 +230,14 @@ class WmRootMixin(Base):
         return super().clientliststacking
 
     @clientlist.setter
-    def clientlist(self, windows):
-        """ _NET_CLIENT_LIST """
-        self._setwindows(windows, '_NET_CLIENT_LIST')
+    def clientlist(self, ids):
+        """ _NET_CLIENT_LIST. ids is an array('L') of window ids in the order they were managed. """
+        self._setwindows(ids, '_NET_CLIENT_LIST')
 
     @clientliststacking.setter
-    def clientliststacking(self, windows):
-        """ _NET_CLIENT_LIST_STACKING """
-        # This atom stores stacking order from bottom to top, but for code it's easier
-        # to work with top window at index 0 so internally work with a reversed list.
-        self._setwindows(list(reversed(windows)), '_NET_CLIENT_LIST_STACKING')
+    def clientliststacking(self, ids):
+        """ _NET_CLIENT_LIST_STACKING. ids is an array('L') of window ids from bottom to top, see desktop.MruList. """
+        self._setwindows(ids, '_NET_CLIENT_LIST_STACKING')
 
     @property
     def currentdesktop(self):
@@ -238,12 +256,21 @@ class WmRootMixin(Base):
     def numberofdesktops(self, num):
         self.display.setcardinalproperty(self, '_NET_NUMBER_OF_DESKTOPS', num)
 
-    def _setwindows(self, windows, propname):
-        lw = len(windows)
-        cwindows = (ctypes.c_ulong * lw)()
-        for i, w in enumerate(windows):
-            cwindows[i] = w.window
-        self.display.changeproperty(self, propname, xlib.XA.WINDOW, 32, xlib.PropMode.Replace, ctypes.byref(cwindows), lw)
+    def _setwindows(self, new, propname):
+        """ Publish a window id array, only sending what changed since it was last published.
+        Unchanged lists aren't written and lists that only gained windows at the end are appended to. """
+        old = self._published.get(propname)
+        if new == old:
+            return
+        if old and len(new) > len(old) and new[:len(old)] == old:
+            mode = xlib.PropMode.Append
+            data = new[len(old):]
+        else:
+            mode = xlib.PropMode.Replace
+            data = new
+        self.display.setproperty(self, propname, xlib.XA.WINDOW, 32, data, mode)
+        # The caller keeps editing its array, so keep a copy.
+        self._published[propname] = new[:]
 
     def __del__(self):
         self.display.destroywindow(self._childwindow)
@@ -259,11 +286,7 @@ class WmCommandReader:
     def handle_clientmessage(self, msgid, clientevent, win=None):
         if msgid == self.display.atom['_NET_ACTIVE_WINDOW']:
             log.debug('0x%08x: _NET_ACTIVE_WINDOW', win.window)
-            self.desktop.raisewindow(win=win)
-            # Check if raisewindow worked before redrawing.
-            # XXX Not sure if i like this....
-            if self.desktop.windowlist[0] == win:
-                self.desktop.redraw()
+            self.desktop.activatewindow(win)
         elif msgid == self.display.atom['_NET_CLOSE_WINDOW']:
             win.delete()
             # Do nothing else. We'll receive DestroyNotify etc if the client window is deleted.
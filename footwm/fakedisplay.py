@@ -0,0 +1,683 @@
+"""
+In process fake X server for footwm.
+
+FakeDisplay implements the Display interface against a FakeServer held in memory, so the window manager and its
+clients can be run, measured and tested without an X server. Connections opened with the same display name share the
+same server, eg
+
+>>> foot = footwm.Foot(displayname=':bench', backend='fake')
+>>> client = display.opendisplay(':bench', backend='fake')
+
+Only what footwm needs is modelled: window tree, map state, geometry, properties, event selection (including
+SubstructureRedirect), focus, key grabs and a simple keyboard. Requests are processed immediately and events are put
+straight onto the receiving connections event queue.
+
+Round trips are accounted for exactly as the Xlib Display does, so Display.roundtrips and RequestQueue counts from a
+fake run are comparable with a real run.
+
+Copyright (c) 2016 Akce
+"""
+import array
+import collections
+import ctypes
+import os
+
+from . import display
+from . import keydefs
+from . import log as logmodule
+from . import xlib
+
+log = logmodule.make(name=__name__)
+
+# Stored window property. Format 8 data is bytes, format 16 & 32 data is a list of ints.
+Property = collections.namedtuple('Property', ['type', 'format', 'data'])
+
+# Predefined atoms. See X11/Xatom.h
+predefinedatoms = ['PRIMARY', 'SECONDARY', 'ARC', 'ATOM', 'BITMAP', 'CARDINAL', 'COLORMAP', 'CURSOR',
+        'CUT_BUFFER0', 'CUT_BUFFER1', 'CUT_BUFFER2', 'CUT_BUFFER3', 'CUT_BUFFER4', 'CUT_BUFFER5', 'CUT_BUFFER6',
+        'CUT_BUFFER7', 'DRAWABLE', 'FONT', 'INTEGER', 'PIXMAP', 'POINT', 'RECTANGLE', 'RESOURCE_MANAGER',
+        'RGB_COLOR_MAP', 'RGB_BEST_MAP', 'RGB_BLUE_MAP', 'RGB_DEFAULT_MAP', 'RGB_GRAY_MAP', 'RGB_GREEN_MAP',
+        'RGB_RED_MAP', 'STRING', 'VISUALID', 'WINDOW', 'WM_COMMAND', 'WM_HINTS', 'WM_CLIENT_MACHINE',
+        'WM_ICON_NAME', 'WM_ICON_SIZE', 'WM_NAME', 'WM_NORMAL_HINTS', 'WM_SIZE_HINTS', 'WM_ZOOM_HINTS', 'MIN_SPACE',
+        'NORM_SPACE', 'MAX_SPACE', 'END_SPACE', 'SUPERSCRIPT_X', 'SUPERSCRIPT_Y', 'SUBSCRIPT_X', 'SUBSCRIPT_Y',
+        'UNDERLINE_POSITION', 'UNDERLINE_THICKNESS', 'STRIKEOUT_ASCENT', 'STRIKEOUT_DESCENT', 'ITALIC_ANGLE',
+        'X_HEIGHT', 'QUAD_WIDTH', 'WEIGHT', 'POINT_SIZE', 'RESOLUTION', 'COPYRIGHT', 'NOTICE', 'FONT_NAME',
+        'FAMILY_NAME', 'FULL_NAME', 'CAP_HEIGHT', 'WM_CLASS', 'WM_TRANSIENT_FOR']
+
+# Keyboard layout of the fake server, keycode -> keysym names. Unlisted keycodes have no keysyms.
+keymap = dict(enumerate([
+        ['Escape'], ['1', 'exclam'], ['2', 'at'], ['3', 'numbersign'], ['4', 'dollar'], ['5', 'percent'],
+        ['6', 'asciicircum'], ['7', 'ampersand'], ['8', 'asterisk'], ['9', 'parenleft'], ['0', 'parenright'],
+        ['minus', 'underscore'], ['equal', 'plus'], ['BackSpace'], ['Tab'],
+        ['q', 'Q'], ['w', 'W'], ['e', 'E'], ['r', 'R'], ['t', 'T'], ['y', 'Y'], ['u', 'U'], ['i', 'I'], ['o', 'O'],
+        ['p', 'P'], ['bracketleft', 'braceleft'], ['bracketright', 'braceright'], ['Return'], ['Control_L'],
+        ['a', 'A'], ['s', 'S'], ['d', 'D'], ['f', 'F'], ['g', 'G'], ['h', 'H'], ['j', 'J'], ['k', 'K'], ['l', 'L'],
+        ['semicolon', 'colon'], ['apostrophe', 'quotedbl'], ['grave', 'asciitilde'], ['Shift_L'],
+        ['backslash', 'bar'], ['z', 'Z'], ['x', 'X'], ['c', 'C'], ['v', 'V'], ['b', 'B'], ['n', 'N'], ['m', 'M'],
+        ['comma', 'less'], ['period', 'greater'], ['slash', 'question'], ['Shift_R'], ['KP_Multiply'], ['Alt_L'],
+        ['space'], ['Caps_Lock'], ['F1'], ['F2'], ['F3'], ['F4'], ['F5'], ['F6'], ['F7'], ['F8'], ['F9'], ['F10'],
+        ['Num_Lock'], ['Scroll_Lock'],
+        ], start=9))
+keymap.update({
+        95: ['F11'], 96: ['F12'], 105: ['Control_R'], 108: ['Alt_R'], 110: ['Home'], 111: ['Up'], 112: ['Prior'],
+        113: ['Left'], 114: ['Right'], 115: ['End'], 116: ['Down'], 117: ['Next'], 118: ['Insert'], 119: ['Delete'],
+        133: ['Super_L'], 134: ['Super_R'],
+        })
+
+def modifiermap():
+    """ Modifier name -> keycodes for the fake keyboard, in KeyModifierMask order. """
+    keycodes = {name: code for code, names in keymap.items() for name in names}
+    modkeys = [['Shift_L', 'Shift_R'], ['Caps_Lock'], ['Control_L', 'Control_R'], ['Alt_L', 'Alt_R'], ['Num_Lock'], ['Scroll_Lock'], ['Super_L', 'Super_R'], []]
+    keypermod = max(len(k) for k in modkeys)
+    modnames = [n for n, _ in xlib.KeyModifierMask._bits_]
+    return {modname: [keycodes[k] for k in keys] + [0] * (keypermod - len(keys)) for modname, keys in zip(modnames, modkeys)}
+
+# Event types selected by an event mask. Only the masks that FakeDisplay.checkwindowevent is used with.
+maskevents = {
+        xlib.InputEventMask.PropertyChange: (xlib.EventName.PropertyNotify,),
+        xlib.InputEventMask.StructureNotify: (xlib.EventName.ConfigureNotify, xlib.EventName.DestroyNotify, xlib.EventName.MapNotify, xlib.EventName.UnmapNotify),
+        }
+
+# Fake servers by display name. See getserver.
+servers = {}
+
+def getserver(displayname=None):
+    """ Return the fake server for displayname, starting one if needed. """
+    try:
+        server = servers[displayname]
+    except KeyError:
+        server = servers[displayname] = FakeServer()
+    return server
+
+class FakeWindow:
+
+    def __init__(self, windowid, parent, x, y, width, height, override_redirect=False, owner=None):
+        self.window = windowid
+        self.parent = parent
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.override_redirect = override_redirect
+        # Connection that created the window, it receives events sent with an empty event mask.
+        self.owner = owner
+        self.mapped = False
+        # Stacking order, bottom first.
+        self.children = []
+        # dict(atom -> Property)
+        self.properties = {}
+        # dict(connection -> eventmask)
+        self.eventmasks = {}
+        # The connection that has selected SubstructureRedirect, ie the window manager when this is the root window.
+        self.redirect = None
+
+    @property
+    def viewable(self):
+        win = self
+        while win.parent is not None:
+            if not win.mapped:
+                return False
+            win = win.parent
+        return True
+
+class FakeServer:
+    """ State shared by all connections to one fake display. """
+
+    def __init__(self, width=1920, height=1080):
+        # dict(name -> atom id) and dict(atom id -> name)
+        self.atoms = {name: i for i, name in enumerate(predefinedatoms, start=1)}
+        self.atomnames = {i: name for name, i in self.atoms.items()}
+        self.root = FakeWindow(0x100, None, 0, 0, width, height)
+        self.root.mapped = True
+        # dict(windowid -> FakeWindow)
+        self.windows = {self.root.window: self.root}
+        self._nextid = 0x200000
+        self.focus = self.root
+        # dict((keycode, modifiers) -> (connection, grab window))
+        self.grabs = {}
+        self.serial = 0
+        # Server time, bumped for every timestamped event.
+        self.time = 0
+
+    def internatom(self, name, only_if_exists=False):
+        try:
+            atom = self.atoms[name]
+        except KeyError:
+            if only_if_exists:
+                atom = 0
+            else:
+                atom = self.atoms[name] = len(self.atomnames) + 1
+                self.atomnames[atom] = name
+        return atom
+
+    def getwindow(self, conn, windowid):
+        """ Return the FakeWindow for windowid. A BadWindow error is sent to conn and None returned if it doesn't exist. """
+        try:
+            return self.windows[windowid]
+        except KeyError:
+            conn.xerror(xlib.Error.BadWindow, windowid)
+            return None
+
+    def makeevent(self, eventtype, field, **values):
+        """ Build an XEvent. field is the XEvent union member name for the eventtype. eg, 'xmap' """
+        event = xlib.XEvent()
+        event.type = eventtype
+        self.serial += 1
+        fields = getattr(event, field)
+        fields.serial = self.serial
+        for name, value in values.items():
+            setattr(fields, name, value)
+        return event
+
+    def deliver(self, win, eventmask, eventtype, field, **values):
+        """ Send the event to every connection that selected eventmask on win. """
+        for conn, mask in list(win.eventmasks.items()):
+            if mask & eventmask:
+                conn.queueevent(self.makeevent(eventtype, field, **values))
+
+    def structurenotify(self, win, eventtype, field, **values):
+        """ Structure events go to StructureNotify listeners on the window and SubstructureNotify listeners on its parent. """
+        self.deliver(win, xlib.InputEventMask.StructureNotify, eventtype, field, event=win.window, window=win.window, **values)
+        if win.parent is not None:
+            self.deliver(win.parent, xlib.InputEventMask.SubstructureNotify, eventtype, field, event=win.parent.window, window=win.window, **values)
+
+    def redirected(self, conn, win):
+        """ Return the connection that a request made by conn on win should be redirected to, or None. """
+        if win.parent is not None and not win.override_redirect:
+            redirect = win.parent.redirect
+            if redirect is not None and redirect is not conn:
+                return redirect
+        return None
+
+    def createwindow(self, conn, parentid, x, y, width, height, override_redirect=False):
+        parent = self.getwindow(conn, parentid)
+        if parent is None:
+            return 0
+        self._nextid += 1
+        win = FakeWindow(self._nextid, parent, x, y, width, height, override_redirect=override_redirect, owner=conn)
+        self.windows[win.window] = win
+        parent.children.append(win)
+        self.deliver(parent, xlib.InputEventMask.SubstructureNotify, xlib.EventName.CreateNotify, 'xcreatewindow', parent=parent.window, window=win.window, x=x, y=y, width=width, height=height, override_redirect=override_redirect)
+        return win.window
+
+    def destroywindow(self, conn, windowid):
+        win = self.getwindow(conn, windowid)
+        if win is not None and win.parent is not None:
+            self.unmapwindow(conn, windowid)
+            # Children are destroyed first. See XDestroyWindow.
+            for child in reversed(win.children[:]):
+                self.destroywindow(conn, child.window)
+            self.structurenotify(win, xlib.EventName.DestroyNotify, 'xdestroywindow')
+            win.parent.children.remove(win)
+            del self.windows[windowid]
+            if self.focus is win:
+                self.focus = self.root
+            for key, (_, grabwin) in list(self.grabs.items()):
+                if grabwin is win:
+                    del self.grabs[key]
+
+    def mapwindow(self, conn, windowid):
+        win = self.getwindow(conn, windowid)
+        if win is not None and not win.mapped:
+            redirect = self.redirected(conn, win)
+            if redirect is None:
+                win.mapped = True
+                self.structurenotify(win, xlib.EventName.MapNotify, 'xmap', override_redirect=win.override_redirect)
+            else:
+                redirect.queueevent(self.makeevent(xlib.EventName.MapRequest, 'xmaprequest', parent=win.parent.window, window=win.window))
+
+    def unmapwindow(self, conn, windowid):
+        win = self.getwindow(conn, windowid)
+        if win is not None and win.mapped:
+            win.mapped = False
+            self.structurenotify(win, xlib.EventName.UnmapNotify, 'xunmap', from_configure=False)
+
+    def configurewindow(self, conn, windowid, changemask, x=0, y=0, width=0, height=0):
+        """ changemask is a ConfigureWindowStructure mask of which of x, y, width and height to change. """
+        win = self.getwindow(conn, windowid)
+        if win is None:
+            return
+        redirect = self.redirected(conn, win)
+        if redirect is None:
+            if changemask & xlib.ConfigureWindowStructure.CWX:
+                win.x = x
+            if changemask & xlib.ConfigureWindowStructure.CWY:
+                win.y = y
+            if changemask & xlib.ConfigureWindowStructure.CWWidth:
+                win.width = width
+            if changemask & xlib.ConfigureWindowStructure.CWHeight:
+                win.height = height
+            self.structurenotify(win, xlib.EventName.ConfigureNotify, 'xconfigure', x=win.x, y=win.y, width=win.width, height=win.height, override_redirect=win.override_redirect)
+        else:
+            redirect.queueevent(self.makeevent(xlib.EventName.ConfigureRequest, 'xconfigurerequest', parent=win.parent.window, window=win.window, x=x, y=y, width=width, height=height, value_mask=changemask))
+
+    def changeproperty(self, conn, windowid, atom, type_, format_, mode, data):
+        win = self.getwindow(conn, windowid)
+        if win is None:
+            return
+        if mode == xlib.PropMode.Replace or atom not in win.properties:
+            win.properties[atom] = Property(type_, format_, data)
+        else:
+            old = win.properties[atom]
+            if old.type != type_ or old.format != format_:
+                conn.xerror(xlib.Error.BadMatch, windowid)
+                return
+            if mode == xlib.PropMode.Append:
+                win.properties[atom] = Property(type_, format_, old.data + data)
+            else:
+                win.properties[atom] = Property(type_, format_, data + old.data)
+        self.propertynotify(win, atom, 0)
+
+    def deleteproperty(self, conn, windowid, atom):
+        win = self.getwindow(conn, windowid)
+        if win is not None and win.properties.pop(atom, None) is not None:
+            self.propertynotify(win, atom, 1)
+
+    def propertynotify(self, win, atom, state):
+        self.time += 1
+        self.deliver(win, xlib.InputEventMask.PropertyChange, xlib.EventName.PropertyNotify, 'xproperty', window=win.window, atom=atom, time=self.time, state=state)
+
+    def getproperty(self, windowid, atom):
+        """ Return the Property or None. """
+        try:
+            return self.windows[windowid].properties.get(atom)
+        except KeyError:
+            return None
+
+    def selectinput(self, conn, windowid, eventmask):
+        win = self.getwindow(conn, windowid)
+        if win is None:
+            return
+        if eventmask & xlib.InputEventMask.SubstructureRedirect:
+            if win.redirect is not None and win.redirect is not conn:
+                # Only one client may redirect a window. ie, another window manager is running.
+                conn.xerror(xlib.Error.BadAccess, windowid)
+                return
+            win.redirect = conn
+        elif win.redirect is conn:
+            win.redirect = None
+        if eventmask:
+            win.eventmasks[conn] = eventmask
+        else:
+            win.eventmasks.pop(conn, None)
+
+    def sendevent(self, conn, windowid, event, eventmask):
+        win = self.getwindow(conn, windowid)
+        if win is None:
+            return False
+        self.serial += 1
+        if eventmask:
+            receivers = [c for c, mask in win.eventmasks.items() if mask & eventmask]
+        elif win.owner is not None:
+            # An empty event mask sends the event to the client that created the window.
+            receivers = [win.owner]
+        else:
+            receivers = []
+        for receiver in receivers:
+            # event may be one of the XEvent union members, eg XClientMessageEvent.
+            e = xlib.XEvent()
+            ctypes.memmove(ctypes.addressof(e), ctypes.addressof(event), ctypes.sizeof(event))
+            e.xany.serial = self.serial
+            e.xany.send_event = True
+            receiver.queueevent(e)
+        return True
+
+    def setinputfocus(self, conn, windowid):
+        win = self.getwindow(conn, windowid)
+        if win is not None and win is not self.focus:
+            old, self.focus = self.focus, win
+            self.deliver(old, xlib.InputEventMask.FocusChange, xlib.EventName.FocusOut, 'xfocus', window=old.window)
+            self.deliver(win, xlib.InputEventMask.FocusChange, xlib.EventName.FocusIn, 'xfocus', window=win.window)
+
+    def disconnect(self, conn):
+        """ Forget everything the connection selected or grabbed. """
+        for win in self.windows.values():
+            win.eventmasks.pop(conn, None)
+            if win.redirect is conn:
+                win.redirect = None
+        for key, (grabconn, _) in list(self.grabs.items()):
+            if grabconn is conn:
+                del self.grabs[key]
+
+    def presskey(self, keycode, modifiers=0):
+        """ Simulate a key press. Grabbed keys go to the grabbing client, others to the focus window. """
+        self.time += 1
+        try:
+            conn, win = self.grabs[(keycode, modifiers)]
+        except KeyError:
+            try:
+                conn, win = self.grabs[(keycode, xlib.GrabKeyModifierMask.AnyModifier)]
+            except KeyError:
+                win = self.focus
+                self.deliver(win, xlib.InputEventMask.KeyPress, xlib.EventName.KeyPress, 'xkey', window=win.window, root=self.root.window, time=self.time, state=modifiers, keycode=keycode, same_screen=True)
+                return
+        conn.queueevent(self.makeevent(xlib.EventName.KeyPress, 'xkey', window=win.window, root=self.root.window, time=self.time, state=modifiers, keycode=keycode, same_screen=True))
+
+class FakeDisplay(display.Display):
+    """ Display connection to a FakeServer. See module docs. """
+
+    def _connect(self):
+        self.xh = None
+        self.server = getserver(self.displayname)
+        self._events = collections.deque()
+        self._errorhandler = None
+        # The read end of a pipe is used as fileno so that connections can be watched by select. See xevent.run
+        # A byte is written whenever the event queue goes from empty to non-empty.
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+
+    def queueevent(self, event):
+        """ Called by the server to deliver an event to this connection. """
+        if not self._events:
+            os.write(self._wfd, b'\0')
+        self._events.append(event)
+
+    def xerror(self, code, resourceid):
+        """ Called by the server to report a protocol error to this connection. """
+        if self._errorhandler is None:
+            log.error('X Error: code=%s resourceid=0x%08x', xlib.Error(code), resourceid)
+        else:
+            e = xlib.XErrorEvent()
+            e.error_code = code
+            e.resourceid = resourceid
+            e.serial = self.server.serial
+            self._errorhandler(self, e)
+
+    def fileno(self):
+        return self._rfd
+
+    @display.roundtrip()
+    def internatoms(self, symbols, only_if_exists=False):
+        return [self.server.internatom(s, only_if_exists) for s in symbols]
+
+    @display.request
+    def allowevents(self, aevents, time=xlib.CurrentTime):
+        pass
+
+    def _changeproperty(self, w, atom, type_, format_, mode, data, nelements):
+        if format_ == 8:
+            value = ctypes.string_at(data, nelements)
+        else:
+            # Kept as an array, like a real server keeps the bytes, so large window lists don't cost a Python list.
+            ctype = ctypes.c_short if format_ == 16 else ctypes.c_long
+            value = array.array('h' if format_ == 16 else 'l', ctypes.string_at(data, nelements * ctypes.sizeof(ctype)))
+        self.server.changeproperty(self, w, atom, type_, format_, mode, value)
+
+    @display.request
+    def configurewindow(self, windowid, changemask, windowchanges):
+        log.debug('0x%08x: XConfigureWindow', windowid)
+        self.server.configurewindow(self, windowid, changemask, windowchanges.x, windowchanges.y, windowchanges.width, windowchanges.height)
+
+    @display.request
+    def createsimplewindow(self, parent, x, y, w, h, borderw, border, background):
+        return self.server.createwindow(self, parent.window, x, y, w, h)
+
+    @display.request
+    def createwindow(self, parent, x, y, w, h, override_redirect=False):
+        """ Fake server extension, create a window with override_redirect set. """
+        return self.server.createwindow(self, parent.window, x, y, w, h, override_redirect=override_redirect)
+
+    @property
+    def defaultrootwindow(self):
+        return self.server.root.window
+
+    @display.request
+    def destroywindow(self, window):
+        log.debug('0x%08x: XDestroyWindow', window)
+        self.server.destroywindow(self, window)
+
+    @property
+    def displaykeycodes(self):
+        return 8, 255
+
+    @property
+    def errorhandler(self):
+        return self._errorhandler
+
+    @errorhandler.setter
+    def errorhandler(self, newhandler):
+        self._errorhandler = newhandler
+
+    def free(self, xobject):
+        pass
+
+    @display.roundtrip()
+    def getatomname(self, atom, encoding='latin1'):
+        return self.server.atomnames[atom]
+
+    @display.roundtrip()
+    def getkeyboardmapping(self, keymin, keycount):
+        keysymspercode = 2
+        ret = {}
+        for keycode in range(keymin, keymin + keycount):
+            names = keymap.get(keycode, [])
+            keysymids = [keydefs.keysymids[n] for n in names] + [xlib.NoSymbol] * (keysymspercode - len(names))
+            ret[keycode] = [display.KeySym(k) for k in keysymids]
+        return ret
+
+    def _getproperty(self, windowid, propertyname, format_=None):
+        """ Return the property data, or None if it's not set (or not of format_). """
+        prop = self.server.getproperty(windowid, self.atom[propertyname])
+        if prop is None or (format_ is not None and prop.format != format_):
+            return None
+        return prop.data
+
+    @display.roundtrip()
+    def gettransientfor(self, windowid):
+        data = self._getproperty(windowid, 'WM_TRANSIENT_FOR', 32)
+        return data[0] if data else None
+
+    @display.roundtrip()
+    def getclasshint(self, window):
+        data = self._getproperty(window.window, 'WM_CLASS', 8)
+        if data is None:
+            ret = "", ""
+        else:
+            parts = str(data, 'latin1').split('\0') + ['', '']
+            ret = parts[0], parts[1]
+        return ret
+
+    @display.roundtrip()
+    def getprotocols(self, window):
+        data = self._getproperty(window.window, 'WM_PROTOCOLS', 32) or []
+        return {self.atom.name(aid): aid for aid in data}
+
+    @display.roundtrip(2)
+    def getwindowattributes(self, windowid):
+        try:
+            win = self.server.windows[windowid]
+        except KeyError:
+            log.debug('0x%08x: XGetWindowAttributes failed', windowid)
+            ret = None
+        else:
+            if win.viewable:
+                map_state = xlib.MapState.IsViewable
+            elif win.mapped:
+                map_state = xlib.MapState.IsUnviewable
+            else:
+                map_state = xlib.MapState.IsUnmapped
+            ret = win.override_redirect, display.Geometry(win), map_state
+        return ret
+
+    @display.roundtrip()
+    def getwmname(self, window):
+        lines = self._gettextlines(window.window, 'WM_NAME')
+        return lines[0] if lines else None
+
+    @display.roundtrip()
+    def getwmhints(self, win):
+        data = self._getproperty(win.window, 'WM_HINTS', 32)
+        if data:
+            cwmhints = xlib.WMHints()
+            for (name, _), value in zip(xlib.WMHints._fields_, data):
+                setattr(cwmhints, name, value)
+            wmhints = display.WmHints(cwmhints)
+        else:
+            wmhints = None
+        return wmhints
+
+    @display.roundtrip()
+    def getwmnormalhints(self, win):
+        data = self._getproperty(win.window, 'WM_NORMAL_HINTS', 32)
+        if data:
+            # Flatten the field names so that they line up with the property data. ie, expand the Aspect pairs.
+            csizehints = xlib.SizeHints()
+            fields = []
+            for name, ftype in xlib.SizeHints._fields_:
+                if ftype is xlib.SizeHints.Aspect:
+                    fields.extend([(getattr(csizehints, name), 'x'), (getattr(csizehints, name), 'y')])
+                else:
+                    fields.append((csizehints, name))
+            for (obj, name), value in zip(fields, data):
+                setattr(obj, name, value)
+            hints = display.SizeHints(csizehints)
+        else:
+            hints = None
+        log.debug("0x%08x: getwmnormalsizehints hints=%s", win.window, hints)
+        return hints
+
+    @display.roundtrip()
+    def getproperty(self, windowid, propertyname, type_=xlib.AnyPropertyType, length=None, delete=False):
+        atom = self.atom[propertyname]
+        prop = self.server.getproperty(windowid, atom)
+        if prop is None or (type_ != xlib.AnyPropertyType and prop.type != type_):
+            return None
+        if prop.format == 8:
+            data = bytearray(prop.data)
+        else:
+            data = array.array(display.propertytypecodes[prop.format], prop.data)
+        if length is not None and len(data) > length * 32 // prop.format:
+            del data[length * 32 // prop.format:]
+        elif delete:
+            self.server.deleteproperty(self, windowid, atom)
+        return prop.type, prop.format, data
+
+    @property
+    @display.roundtrip()
+    def keymodifiercodes(self):
+        return modifiermap()
+
+    @display.request
+    def grabkey(self, keycode, modifiermask, grabwindow, ownerevents, pointermode, keyboardmode):
+        log.debug('0x%08x: XGrabKey keycode=%d modmask=0x%08x', grabwindow.window, keycode, modifiermask)
+        key = (keycode, int(modifiermask))
+        owner = self.server.grabs.get(key, (self, None))[0]
+        if owner is self:
+            self.server.grabs[key] = (self, self.server.windows[grabwindow.window])
+        else:
+            self.xerror(xlib.Error.BadAccess, grabwindow.window)
+
+    def _mapwindow(self, windowid):
+        self.server.mapwindow(self, windowid)
+
+    def _moveresizewindow(self, windowid, x, y, w, h):
+        mask = xlib.ConfigureWindowStructure.CWX | xlib.ConfigureWindowStructure.CWY | xlib.ConfigureWindowStructure.CWWidth | xlib.ConfigureWindowStructure.CWHeight
+        self.server.configurewindow(self, windowid, mask, x, y, w, h)
+
+    @property
+    def nextevent(self):
+        """ Unlike XNextEvent, this will not block. Only call it when there are queued events. """
+        event = self._events.popleft()
+        ctypes.memmove(ctypes.addressof(self._nextevent), ctypes.addressof(event), ctypes.sizeof(xlib.XEvent))
+        if not self._events:
+            try:
+                os.read(self._rfd, 4096)
+            except BlockingIOError:
+                pass
+        return self._nextevent
+
+    @property
+    def pendingevents(self):
+        return len(self._events)
+
+    def checkwindowevent(self, window, eventmask):
+        eventtypes = {t for mask, types in maskevents.items() if mask & int(eventmask) for t in types}
+        for event in self._events:
+            if event.type in eventtypes and event.xany.window == window.window:
+                self._events.remove(event)
+                ctypes.memmove(ctypes.addressof(self._nextevent), ctypes.addressof(event), ctypes.sizeof(xlib.XEvent))
+                if not self._events:
+                    try:
+                        os.read(self._rfd, 4096)
+                    except BlockingIOError:
+                        pass
+                return self._nextevent
+        return None
+
+    @property
+    def queuedevents(self):
+        return len(self._events)
+
+    @display.roundtrip()
+    def querytree(self, window):
+        try:
+            children = [w.window for w in self.server.windows[window.window].children]
+        except KeyError:
+            children = []
+        return children
+
+    @display.request
+    def selectinput(self, window, eventmask):
+        log.debug('0x%08x: XSelectInput eventmask=0x%0x', window.window, eventmask)
+        self.server.selectinput(self, window.window, int(eventmask))
+
+    @display.request
+    def sendevent(self, window, event, eventtype=xlib.InputEventMask.NoEvent):
+        return self.server.sendevent(self, window.window, event, int(eventtype))
+
+    @display.request
+    def setinputfocus(self, window, revertto, time=xlib.CurrentTime):
+        log.debug('0x%08x: XSetInputFocus', window.window)
+        self.server.setinputfocus(self, window.window)
+
+    def _gettextlines(self, windowid, propertyname):
+        prop = self.server.getproperty(windowid, self.atom[propertyname])
+        lines = []
+        if prop is not None and prop.format == 8:
+            if prop.type == xlib.XA.STRING:
+                enc = 'latin1'
+            elif prop.type == self.atom['UTF8_STRING']:
+                enc = 'utf8'
+            else:
+                enc = None
+            if enc:
+                lines = str(prop.data, enc).split('\0')
+                # Text properties may or may not have a trailing NUL.
+                if lines and lines[-1] == '' and prop.data.endswith(b'\0'):
+                    lines.pop()
+        return lines
+
+    @display.roundtrip()
+    def gettextproperty(self, window, propertyname):
+        return self._gettextlines(window.window, propertyname)
+
+    @display.request
+    def settextproperty(self, window, strings, propertyname):
+        data = b'\0'.join(s.encode('utf8') for s in strings)
+        self.server.changeproperty(self, window.window, self.atom[propertyname], self.atom['UTF8_STRING'], 8, xlib.PropMode.Replace, data)
+
+    @display.roundtrip()
+    def sync(self, discard=False):
+        if discard:
+            self._events.clear()
+
+    def flush(self):
+        pass
+
+    @display.request
+    def ungrabkey(self, keycode, modifiermask, grabwindow):
+        log.debug('0x%08x: XUngrabKey keycode=%d modmask=0x%0x', grabwindow.window, keycode, modifiermask)
+        for (code, mods), (conn, _) in list(self.server.grabs.items()):
+            if conn is self and keycode in (code, xlib.AnyKey) and int(modifiermask) in (mods, xlib.GrabKeyModifierMask.AnyModifier):
+                del self.server.grabs[(code, mods)]
+
+    def _unmapwindow(self, windowid):
+        self.server.unmapwindow(self, windowid)
+
+    def __del__(self):
+        self.server.disconnect(self)
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def __str__(self):
+        return 'FakeDisplay({})'.format(self.displayname)
@@ -0,0 +1,403 @@
+"""
+Benchmarks for footwm.
+
+Run startup and calls against a disposable X server (eg, Xvfb or Xephyr) as it creates and destroys lots of windows.
+
+The manage and switch benchmarks run the window manager in process against the fake X server (see fakedisplay) so
+their results are deterministic and reproducible.
+
+Copyright (c) 2016 Akce
+"""
+
+# Python standard modules.
+import argparse
+import collections
+import ctypes
+import random
+import sys
+import time
+
+# Local modules.
+from . import benchsuite
+from . import clientcmd
+from . import display
+from . import footwm
+from . import log as logger
+from . import nestedarg
+from . import window
+from . import xevent
+from . import xlib
+
+log = logger.make(name=__name__)
+
+# Lightweight stand-in for a window object. Display methods only need the .window attribute.
+Handle = collections.namedtuple('Handle', ['window'])
+
+def makewindows(dobj, count):
+    """ Create and map count top level windows. Returns [Handle]. """
+    root = Handle(dobj.defaultrootwindow)
+    handles = [Handle(dobj.createsimplewindow(root, 0, 0, 100, 100, 0, 0, 0)) for _ in range(count)]
+    for h in handles:
+        dobj.mapwindow(h)
+    dobj.sync()
+    return handles
+
+def destroywindows(dobj, handles):
+    for h in handles:
+        dobj.destroywindow(h.window)
+    dobj.sync()
+
+def report(name, count, roundtrips, seconds):
+    print('{}: windows={} roundtrips={} ({:.2f}/window) time={:.2f}ms ({:.1f}us/window)'.format(name, count, roundtrips, roundtrips / count, seconds * 1000, seconds * 1000000 / count))
+
+def reportcycles(name, count, unit, roundtrips, sent, seconds):
+    print('{}: count={} roundtrips={} ({:.2f}/{}) requests={} ({:.2f}/{}) time={:.2f}ms ({:.1f}us/{})'.format(name, count, roundtrips, roundtrips / count, unit, sent, sent / count, unit, seconds * 1000, seconds * 1000000 / count, unit))
+
+class FakeSession:
+    """ Window manager and a client connected to the same fake X server. """
+
+    def __init__(self, displayname=':footbench', configurepolicy='wanted'):
+        self.foot = footwm.Foot(displayname=displayname, backend='fake', configurepolicy=configurepolicy)
+        self.client, self.clientroot = clientcmd.makedisplayroot(displayname, backend='fake')
+        self.command = clientcmd.ClientCommand(self.clientroot)
+        # Totals for the window manager.
+        self.roundtrips = 0
+        self.sent = 0
+        self.settle()
+
+    def settle(self):
+        """ Have the window manager process everything sent to it. Fake server events are delivered immediately. """
+        wmdisplay = self.foot.display
+        roundtrips = wmdisplay.roundtrips
+        self.foot.xwatch.dispatchevent()
+        self.roundtrips += wmdisplay.roundtrips - roundtrips
+        self.sent += wmdisplay.requests.lastcounts['sent']
+
+    def mapwindows(self, count):
+        """ Create and map count client windows. Each map is handled by the window manager as it happens. """
+        handles = []
+        for i in range(count):
+            h = Handle(self.client.createsimplewindow(self.clientroot, 0, 0, 100, 100, 0, 0, 0))
+            wmclass = 'bench{}\0Bench\0'.format(i).encode('latin1')
+            self.client.changeproperty(h, 'WM_CLASS', xlib.XA.STRING, 8, xlib.PropMode.Replace, ctypes.c_char_p(wmclass), len(wmclass))
+            self.client.settextproperty(h, ['bench window {}'.format(i)], 'WM_NAME')
+            self.client.mapwindow(h)
+            self.settle()
+            handles.append(h)
+        return handles
+
+def manage(args):
+    """ Time the window manager managing newly mapped windows. """
+    session = FakeSession()
+    session.roundtrips = 0
+    session.sent = 0
+    start = time.perf_counter()
+    session.mapwindows(args.windows)
+    elapsed = time.perf_counter() - start
+    reportcycles('manage', args.windows, 'window', session.roundtrips, session.sent, elapsed)
+
+def switchcost(windows, desktops, switches, displayname=':footbench'):
+    """ Time desktop switches with windows spread across desktops. Returns (roundtrips, requests sent, seconds). """
+    session = FakeSession(displayname)
+    handles = session.mapwindows(windows)
+    # Insert after the current desktop so that the current desktop doesn't change.
+    for i in range(desktops):
+        session.command.adddesktop('desk{}'.format(i), 1)
+        session.settle()
+    for i, h in enumerate(handles):
+        session.clientroot.setwindowdesktop(h, 1 + i % desktops)
+        session.settle()
+    session.roundtrips = 0
+    session.sent = 0
+    start = time.perf_counter()
+    for _ in range(switches):
+        # Select the least recently used desktop, so every desktop gets drawn in turn.
+        session.command.selectdesktop(desktops)
+        session.settle()
+    return session.roundtrips, session.sent, time.perf_counter() - start
+
+def switch(args):
+    """ Time desktop switches with windows spread across desktops. """
+    roundtrips, sent, elapsed = switchcost(args.windows, args.desktops, args.switches)
+    reportcycles('switch', args.switches, 'switch', roundtrips, sent, elapsed)
+
+def mruops(windows, desktops, ops, displayname=':footbench-mru'):
+    """ Time the desktop window list operations. Desktop methods are called directly, one batch per operation.
+    Returns [(name, count, requests sent, seconds)] in run order. """
+    # Windows are mapped before the window manager starts, so they're all imported into the unassigned desktop.
+    clientdisplay = display.opendisplay(displayname, backend='fake')
+    makewindows(clientdisplay, windows)
+    foot = footwm.Foot(displayname=displayname, backend='fake')
+    wmdisplay = foot.display
+    desk = foot._desktop
+    wins = list(desk.stacklist)
+    for i in range(desktops):
+        desk.adddesktop('desk{}'.format(i), 1)
+    # Fixed seed so that every run does the same work.
+    rand = random.Random(0)
+    results = []
+    def timeit(name, ops):
+        count = 0
+        sent = 0
+        start = time.perf_counter()
+        for op, *opargs in ops:
+            with wmdisplay.batch():
+                op(*opargs)
+            sent += wmdisplay.requests.lastcounts['sent']
+            count += 1
+        results.append((name, count, sent, time.perf_counter() - start))
+    # Unassigned is desktop 0, the others are numbered from 1.
+    desk.selectdesktop(1)
+    timeit('spread', ((desk.setwindowdesktop, w, 1 + i % desktops) for i, w in enumerate(wins)))
+    timeit('raise', ((desk.raisewindow, rand.choice(wins)) for _ in range(ops)))
+    timeit('move', ((desk.setwindowdesktop, rand.choice(wins), rand.randrange(1, desktops + 1)) for _ in range(ops)))
+    timeit('publish', ((desk._updatewindowhints,) for _ in range(ops)))
+    # Unmanage the same number of windows at every window count, so the per operation cost can be compared.
+    rand.shuffle(wins)
+    timeit('unmanage', ((desk.unmanagewindow, w) for w in wins[:ops]))
+    return results
+
+def mru(args):
+    """ Microbenchmark of the desktop window lists. """
+    for name, count, sent, elapsed in mruops(args.windows, args.desktops, args.ops):
+        reportcycles(name, count, 'op', 0, sent, elapsed)
+
+# Operations that must cost the same however many windows there are. See scaling.
+flatoperations = ['raise', 'move', 'unmanage', 'switch']
+
+def measurescaling(counts, desktops, ops, repeat=3):
+    """ Per operation cost, in microseconds, of the flatoperations at each window count.
+    Returns dict(operation -> dict(count -> microseconds)). The fastest of repeat runs is used to cut down on noise. """
+    results = {name: {} for name in flatoperations}
+    def record(name, windows, us):
+        results[name][str(windows)] = min(us, results[name].get(str(windows), us))
+    for windows in counts:
+        for i in range(repeat):
+            # Fake servers are shared by display name, so every run needs its own.
+            for name, count, _, elapsed in mruops(windows, desktops, ops, displayname=':footbench-scaling{}-{}'.format(windows, i)):
+                if name in results:
+                    record(name, windows, elapsed * 1000000 / count)
+            _, _, elapsed = switchcost(windows, desktops, ops, displayname=':footbench-scalingswitch{}-{}'.format(windows, i))
+            record('switch', windows, elapsed * 1000000 / ops)
+    return results
+
+def printscaling(rows):
+    for name, small, smallus, large, largeus, ratio, failed in rows:
+        print('{:<8} windows={:>5} {:8.1f}us/op windows={:>5} {:8.1f}us/op {:6.2f}x{}'.format(name, small, smallus, large, largeus, ratio, ' NOT FLAT' if failed else ''))
+
+def scaling(args):
+    """ Check that the per operation cost of the flatoperations doesn't grow with the number of windows. """
+    rows = benchsuite.flatrows(measurescaling(args.counts, args.desktops, args.ops), args.maxratio)
+    printscaling(rows)
+    if any(failed for *_, failed in rows):
+        sys.exit(1)
+
+class NullHandlers:
+    """ XWatch callback whose handlers do nothing, so that only the cost of dispatch is measured. """
+
+    def handle_configurenotify(self, e):
+        pass
+
+    def handle_propertynotify(self, e, atomname):
+        pass
+
+    def handle_unmapnotify(self, e):
+        pass
+
+def dispatch(args):
+    """ Microbenchmark of XWatch event dispatch. The mix includes EnterNotify, which has no handler. """
+    dobj = display.opendisplay(':footbench-dispatch', backend='fake')
+    watch = xevent.XWatch(dobj, None, NullHandlers())
+    events = []
+    for eventtype in (xlib.EventName.ConfigureNotify, xlib.EventName.PropertyNotify, xlib.EventName.EnterNotify, xlib.EventName.UnmapNotify):
+        event = xlib.XEvent()
+        event.type = eventtype
+        event.xproperty.atom = dobj.atom['WM_NAME']
+        events.append(event)
+    start = time.perf_counter()
+    for i in range(args.events):
+        watch._dispatch(events[i % len(events)])
+    elapsed = time.perf_counter() - start
+    print('dispatch: count={} time={:.2f}ms ({:.2f}us/event) {:.0f} events/s'.format(args.events, elapsed * 1000, elapsed * 1000000 / args.events, args.events / elapsed))
+
+def configure(args):
+    """ Time the window manager answering a client that keeps asking for its own geometry. """
+    session = FakeSession(configurepolicy=args.policy)
+    # The last window mapped is the top window, so it's visible and has been sized by the window manager.
+    h = session.mapwindows(args.windows)[-1]
+    session.roundtrips = 0
+    session.sent = 0
+    start = time.perf_counter()
+    for i in range(args.requests):
+        wc = xlib.XWindowChanges()
+        wc.width = 200 + i % 2
+        wc.height = 100
+        session.client.configurewindow(h.window, xlib.ConfigureWindowStructure.CWWidth | xlib.ConfigureWindowStructure.CWHeight, wc)
+        session.settle()
+    elapsed = time.perf_counter() - start
+    reportcycles('configure', args.requests, 'request', session.roundtrips, session.sent, elapsed)
+
+def commandqueue(args):
+    """ Time FOOT_COMMANDV command bursts, and check that none are lost. """
+    session = FakeSession()
+    desk = session.foot._desktop
+    before = len(desk._desklist)
+    session.roundtrips = 0
+    session.sent = 0
+    start = time.perf_counter()
+    for i in range(args.commands):
+        # Insert after the current desktop so that each one doesn't redraw.
+        session.command.adddesktop('cmd{}'.format(i), 1)
+        if (i + 1) % args.burst == 0:
+            session.settle()
+    session.settle()
+    elapsed = time.perf_counter() - start
+    reportcycles('commands', args.commands, 'command', session.roundtrips, session.sent, elapsed)
+    lost = args.commands - (len(desk._desklist) - before)
+    print('lost={}'.format(lost))
+    # A client that exits between begin and commit mustn't leave the window manager deferring redraws.
+    session.clientroot.begintransaction()
+    session.command.adddesktop('unclosed', 0)
+    session.settle()
+    print('open={} deferred={}'.format(desk._transactions, len(desk._deferred)))
+
+def startup(args):
+    """ Time the window manager import of existing root children. """
+    clientdisplay = display.Display(args.display)
+    handles = makewindows(clientdisplay, args.windows)
+    try:
+        wmdisplay = display.Display(args.display)
+        root = window.WmRoot(wmdisplay, wmdisplay.defaultrootwindow)
+        # WmRoot has already imported once. Re-import so that the one off root setup is not included.
+        for _ in range(args.repeat):
+            roundtrips = wmdisplay.roundtrips
+            start = time.perf_counter()
+            root._import_children()
+            elapsed = time.perf_counter() - start
+            report('startup', len(root.children), wmdisplay.roundtrips - roundtrips, elapsed)
+    finally:
+        destroywindows(clientdisplay, handles)
+
+def calls(args):
+    """ Calls per second of the Display methods that are made for every event and menu build. """
+    clientdisplay = display.Display(args.display)
+    handles = makewindows(clientdisplay, args.windows)
+    for i, h in enumerate(handles):
+        clientdisplay.setproperty(h, 'WM_CLASS', xlib.XA.STRING, 8, 'bench{}\0Bench\0'.format(i).encode('latin1'))
+        clientdisplay.settextproperty(h, ['bench window {}'.format(i)], 'WM_NAME')
+    clientdisplay.sync()
+    try:
+        dobj = display.Display(args.display)
+        root = Handle(dobj.defaultrootwindow)
+        methods = [
+                ('getwindowattributes', lambda h: dobj.getwindowattributes(h.window)),
+                ('gettransientfor', lambda h: dobj.gettransientfor(h.window)),
+                ('getclasshint', dobj.getclasshint),
+                ('getwmname', dobj.getwmname),
+                ('getwmhints', dobj.getwmhints),
+                ('getwmnormalhints', dobj.getwmnormalhints),
+                ('querytree', lambda h: dobj.querytree(root)),
+                ('displaykeycodes', lambda h: dobj.displaykeycodes),
+                ]
+        for name, func in methods:
+            start = time.perf_counter()
+            for i in range(args.calls):
+                func(handles[i % len(handles)])
+            elapsed = time.perf_counter() - start
+            print('{}: count={} time={:.2f}ms ({:.1f}us/call) {:.0f} calls/s'.format(name, args.calls, elapsed * 1000, elapsed * 1000000 / args.calls, args.calls / elapsed))
+    finally:
+        destroywindows(clientdisplay, handles)
+
+def suite(args):
+    """ Run the Xvfb end to end suite, optionally checking for regressions against a baseline. """
+    try:
+        results = benchsuite.runsuite(args.display or ':99', counts=args.counts, switches=args.switches, timeout=args.timeout)
+    except benchsuite.BenchError as e:
+        print('suite failed: {}'.format(e), file=sys.stderr)
+        sys.exit(2)
+    # Per operation costs that have to stay flat as the window count grows, from the fake server.
+    results['scaling'] = measurescaling(args.scalingcounts, desktops=50, ops=200)
+    benchsuite.printresults(results)
+    if args.output:
+        benchsuite.save(results, args.output)
+    if args.baseline:
+        checkbaseline(results, benchsuite.load(args.baseline), args.threshold, args.maxratio)
+    else:
+        checkbaseline(results, {'results': {}}, args.threshold, args.maxratio)
+
+def compare(args):
+    """ Compare two saved suite results. """
+    checkbaseline(benchsuite.load(args.results), benchsuite.load(args.baseline), args.threshold, args.maxratio)
+
+def checkbaseline(results, baseline, threshold, maxratio):
+    rows = benchsuite.compare(results, baseline, threshold, maxratio)
+    benchsuite.printcompare(rows)
+    if any(regressed for *_, regressed in rows):
+        sys.exit(1)
+
+def parseargs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--display', help='X display name. eg, :4. default: %(default)s')
+    logger.addargs(parser)
+    commands = nestedarg.NestedSubparser(parser.add_subparsers())
+    with commands('startup', help='window manager import of existing windows') as c:
+        c.add_argument('--windows', type=int, default=200, help='number of windows to create. default: %(default)s')
+        c.add_argument('--repeat', type=int, default=3, help='number of import runs. default: %(default)s')
+        c.set_defaults(command=startup)
+    with commands('calls', help='calls per second of the Display methods used on every event') as c:
+        c.add_argument('--windows', type=int, default=100, help='number of windows to create. default: %(default)s')
+        c.add_argument('--calls', type=int, default=10000, help='number of calls per method. default: %(default)s')
+        c.set_defaults(command=calls)
+    with commands('manage', help='window manager handling of new windows (fake X server)') as c:
+        c.add_argument('--windows', type=int, default=1000, help='number of windows to map. eg, 10000. default: %(default)s')
+        c.set_defaults(command=manage)
+    with commands('switch', help='desktop switching (fake X server)') as c:
+        c.add_argument('--windows', type=int, default=1000, help='number of windows. eg, 10000. default: %(default)s')
+        c.add_argument('--desktops', type=int, default=20, help='number of desktops. default: %(default)s')
+        c.add_argument('--switches', type=int, default=2000, help='number of desktop switches. default: %(default)s')
+        c.set_defaults(command=switch)
+    with commands('mru', help='desktop window list operations (fake X server)') as c:
+        c.add_argument('--windows', type=int, default=5000, help='number of windows. default: %(default)s')
+        c.add_argument('--desktops', type=int, default=50, help='number of desktops. default: %(default)s')
+        c.add_argument('--ops', type=int, default=1000, help='number of raise, move and publish operations. default: %(default)s')
+        c.set_defaults(command=mru)
+    with commands('scaling', help='check that window list operations cost the same at any window count (fake X server). Exits with status 1 if not') as c:
+        c.add_argument('--counts', type=int, nargs='+', default=[300, 3000], help='window counts to compare. default: %(default)s')
+        c.add_argument('--desktops', type=int, default=50, help='number of desktops. default: %(default)s')
+        c.add_argument('--ops', type=int, default=200, help='number of operations per measurement. default: %(default)s')
+        c.add_argument('--maxratio', type=float, default=benchsuite.maxratio, help='fail when the cost at the largest count is more than this times the cost at the smallest. default: %(default)s')
+        c.set_defaults(command=scaling)
+    with commands('commands', help='FOOT_COMMANDV command queue (fake X server)') as c:
+        c.add_argument('--commands', type=int, default=2000, help='number of commands to send. default: %(default)s')
+        c.add_argument('--burst', type=int, default=100, help='commands sent before the window manager reads them. default: %(default)s')
+        c.set_defaults(command=commandqueue)
+    with commands('dispatch', help='XWatch event dispatch (fake X server)') as c:
+        c.add_argument('--events', type=int, default=1000000, help='number of events to dispatch. default: %(default)s')
+        c.set_defaults(command=dispatch)
+    with commands('configure', help='ConfigureRequest handling (fake X server)') as c:
+        c.add_argument('--windows', type=int, default=10, help='number of windows. default: %(default)s')
+        c.add_argument('--requests', type=int, default=1000, help='number of client configure requests. default: %(default)s')
+        c.add_argument('--policy', choices=footwm.configurepolicies, default=footwm.configurepolicies[0], help='window manager configure policy. default: %(default)s')
+        c.set_defaults(command=configure)
+    with commands('suite', help='end to end latencies. Starts Xvfb, footwm, footkeys and footrun. --display default: :99') as c:
+        c.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000], help='window counts to measure. default: %(default)s')
+        c.add_argument('--switches', type=int, default=50, help='desktop switches per window count. default: %(default)s')
+        c.add_argument('--timeout', type=float, default=10, help='seconds to wait for footwm to act. default: %(default)s')
+        c.add_argument('--output', help='save results to this JSON file')
+        c.add_argument('--baseline', help='compare results with this saved JSON file. Exits with status 1 on regression')
+        c.add_argument('--threshold', type=float, default=1.25, help='regression when slower than baseline by this factor. default: %(default)s')
+        c.add_argument('--scalingcounts', type=int, nargs='+', default=[300, 3000], help='window counts for the flat cost checks, see scaling. default: %(default)s')
+        c.add_argument('--maxratio', type=float, default=benchsuite.maxratio, help='regression when a flat cost operation is this many times slower at the largest scaling count. default: %(default)s')
+        c.set_defaults(command=suite)
+    with commands('compare', help='compare saved suite results against a baseline') as c:
+        c.add_argument('results', help='suite results JSON file')
+        c.add_argument('baseline', help='baseline JSON file')
+        c.add_argument('--threshold', type=float, default=1.25, help='regression when slower than baseline by this factor. default: %(default)s')
+        c.add_argument('--maxratio', type=float, default=benchsuite.maxratio, help='regression when a flat cost operation is this many times slower at the largest scaling count. default: %(default)s')
+        c.set_defaults(command=compare)
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    logger.startlogging(modulenames=args.logmodules, levelname=args.loglevel, outfilename=args.logfile)
+    args.command(args)
@@ -87,14 +87,15 @@ class KeyBuilder:
 
 class FootKeys:
 
-    def __init__(self, displayname=None, configfilename=None):
+    def __init__(self, displayname=None, configfilename=None, backend='xlib'):
         """
         FootKeys._handle_keypress() will apply requiremods & ignoremods to all grabbed keypresses.
         requiremods and ignoremods must be a set of footwm.xlib.KeyModifierMask values.
         All requiremods values must all be applied for a key in this keymap to match.
         All ignoremods values are all masked out and ignored in keypress events.
         """
-        self.display, self.root = clientcmd.makedisplayroot(displayname)
+        # Mirror window manager state so key actions don't have to wait for the X server.
+        self.display, self.root = clientcmd.makedisplayroot(displayname, backend=backend, mirror=True)
         self.configfilename = configfilename
         def xerrorhandler(display, xerrorevent):
             log.error('X Error: %s', xerrorevent)
@@ -164,7 +165,7 @@ class FootKeys:
 
     def _installkeycodes(self):
         """ Installs the key code actions with the x server. """
-        self.root.manage(xlib.InputEventMask.KeyPress)
+        self.root.manage(self.xwatch.eventmask & xlib.InputEventMask.KeyPress)
         for (keycode, keymodmask), keyaction in self._keycodeactions.items():
             log.debug('0x%08x: install keygrab keycode=0x%x modifier=0x%x', self.root.window, keycode, keymodmask)
             self.display.grabkey(keycode, keymodmask, self.root, True, xlib.GrabMode.Async, xlib.GrabMode.Async)
@@ -180,6 +181,9 @@ class FootKeys:
         else:
             log.error('0x%08x: no action defined for (keycode, modifier) %s', e.window, keycombo)
 
+    def handle_propertynotify(self, propertyevent, atomname):
+        self.root.handle_propertynotify(propertyevent, atomname)
+
     def handle_mappingnotify(self, event):
         """ X server has had a keyboard mapping changed. Update our keyboard layer. """
         self._rebuild()
@@ -202,7 +206,7 @@ def startkeys(args):
         log.error("Exiting: %s already running. pid=%d pidfile=%s", args.procname, pid, args.pidfile)
         sys.exit(1)
     config.writepid(args.pidfile)
-    fk = FootKeys(displayname=args.display, configfilename=args.configfile)
+    fk = FootKeys(displayname=args.display, configfilename=args.configfile, backend=args.backend)
     fk.loadconfig()
     try:
         fk.xwatch.flush()
@@ -231,6 +235,7 @@ def parseargs():
     parser.add_argument('--configfile', default=getconfigfilename(), help='Full path to configuration file. default: %(default)s')
     parser.add_argument('--pidfile', default=config.getpidfilename(parser.prog), help='Full path to pid file. default: %(default)s')
     parser.add_argument('--display', help='X display name. eg, :0.1. default: %(default)s')
+    parser.add_argument('--backend', choices=['xlib', 'xcb'], default='xlib', help='X display backend. default: %(default)s')
     logger.addargs(parser)
     commands = nestedarg.NestedSubparser(parser.add_subparsers())
     with commands('start', aliases=['s'], help='run a footkeys instance.') as c:
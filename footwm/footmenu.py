@@ -21,8 +21,8 @@ from . import log as logger
 
 log = logger.make(name=__name__)
 
-def xinit(displayname=None):
-    display, root = clientcmd.makedisplayroot(displayname)
+def xinit(displayname=None, backend='xlib'):
+    display, root = clientcmd.makedisplayroot(displayname, backend=backend)
     display.logerrors()
     client = clientcmd.ClientCommand(root)
     return client, display, root
@@ -62,7 +62,8 @@ class AppMixin:
             selfwin = self.client.root.children[int(os.environ['WINDOWID'])]
         except KeyError:
             selfwin = self.client.root.newchild(int(os.environ['WINDOWID']))
-        selfwin.manage(xlib.InputEventMask.FocusChange)
+        # For handle_focusout.
+        selfwin.manage(self.xwatch.eventmask & xlib.InputEventMask.FocusChange)
         # flush is needed or else the server never sends us events. Normally it's called by nextevent, but we need to do
         # it manually when using select.
         self.xwatch.flush()
@@ -115,12 +116,17 @@ class DesktopApp(AppMixin):
         super().__init__(client, display, root, skipfirst, msgduration)
 
     def _makemodel(self):
-        desktops = self.client.getdesktopnames()[self._offset:]
+        state = self.client.snapshot()
+        # Desktops in most recently used order, desknum is the position in that order.
+        desktops = [state['desktops'][i] for i in state['mru']][self._offset:]
         columns = [listbox.ListColumn(name='desk', label="Desktop"),
                    listbox.ListColumn(name='desknum', visible=False, label="Number"),
             ]
         model = listbox.Model(columns=columns, rows=[{'desk': d, 'desknum': i} for i, d in enumerate(desktops, self._offset)])
-        model.selectedindex = self.client.currentdesktop
+        try:
+            model.selectedindex = state['mru'].index(state['current'])
+        except ValueError:
+            model.selectedindex = state['current']
         return model
 
     def activateselection(self):
@@ -144,24 +150,21 @@ class WindowApp(AppMixin):
         super().__init__(client, display, root, skipfirst, msgduration)
 
     def _makemodel(self):
+        state = self.client.snapshot()
         # Ignore window that houses footmenu.
-        # FIXME: call client.getwindowlist first so it initialises all root.children windows. Then client.activewindow will exist.
-        allwindows = self.client.getwindowlist()
-        selfwin = self.client.root.children[int(os.environ['WINDOWID'])]
-        currentwin = self.client.activewindow
-        currentset = frozenset([selfwin, currentwin])
-        windows = [w for w in allwindows if w not in currentset][self._offset:]
+        aw = state['active']
+        currentset = frozenset([int(os.environ['WINDOWID']), aw])
+        windows = [w for w in state['windows'] if w['desktop'] == state['current'] and w['window'] not in currentset][self._offset:]
         columns = [
-            listbox.ListColumn(name='win', label='Window', visible=True, renderer=lambda x: '0x{:08x}'.format(x.window)),
+            listbox.ListColumn(name='win', label='Window', visible=True, renderer=lambda x: '0x{:08x}'.format(x)),
             listbox.ListColumn(name='res', label='Resource'),
             listbox.ListColumn(name='cls', label='Class'),
             listbox.ListColumn(name='host', label='Host'),
             listbox.ListColumn(name='title', label='Title'),
             ]
-        model = listbox.Model(rows=[{'res': w.resourcename, 'cls': w.resourceclass, 'host': w.clientmachine, 'title': w.name, 'win': w} for w in windows], columns=columns)
-        aw = self.client.activewindow
+        model = listbox.Model(rows=[{'res': w['res'], 'cls': w['cls'], 'host': w['host'], 'title': w['name'], 'win': w['window']} for w in windows], columns=columns)
         for i, w in enumerate(windows):
-            if w.window == aw.window:
+            if w['window'] == aw:
                 break
         else:
             i = 0
@@ -173,13 +176,13 @@ class WindowApp(AppMixin):
         winname = row['title']
         win = row['win']
         self.showmessage(content=[winname], title='Activating')
-        self.client.activatewindow(window=win.window)
+        self.client.activatewindow(window=win)
         self.scr.draw()
         self.stop()
 
     def closeselection(self):
         row = self._model.selected
-        wid = row['win'].window
+        wid = row['win']
         self.client.closewindow(window=wid)
         self.stop()
 
@@ -187,7 +190,7 @@ class WindowApp(AppMixin):
         log.debug('propertynotify %s', atomname)
 
 def windowmenu(args):
-    client, display, root = xinit(displayname=args.displayname)
+    client, display, root = xinit(displayname=args.displayname, backend=args.backend)
     app = WindowApp(client, display, root, skipfirst=args.skipfirst, msgduration=args.msgduration)
     try:
         app.run()
@@ -195,7 +198,7 @@ def windowmenu(args):
         app.close()
 
 def desktopmenu(args):
-    client, display, root = xinit(displayname=args.displayname)
+    client, display, root = xinit(displayname=args.displayname, backend=args.backend)
     app = DesktopApp(client, display, root, skipfirst=args.skipfirst, msgduration=args.msgduration)
     try:
         app.run()
@@ -205,6 +208,7 @@ def desktopmenu(args):
 def parse_args():
     dispparser = argparse.ArgumentParser(add_help=False)
     dispparser.add_argument('--displayname', help='X display name.')
+    dispparser.add_argument('--backend', choices=['xlib', 'xcb'], default='xlib', help='X display backend. default: %(default)s')
     dispparser.add_argument('--msgduration', default=1.2, type=float, help='Seconds to show message window before actioning')
     dispparser.add_argument('--skipfirst', default=False, action='store_true', help='Skip first entry in window/desktop list. Default: %(default)s')
     dispparser.add_argument('--escapedelay', default=25, type=int, help='Set curses escape delay')
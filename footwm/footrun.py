@@ -5,9 +5,7 @@ Copyright (c) 2016 Akce
 """
 # Python standard modules.
 import argparse
-import os
 import socket
-import stat
 import sys
 import time
 
@@ -43,21 +41,10 @@ def daemonstart(sockname):
     """ Start a footrun daemon instance. """
     # Since we're using Unix sockets, we need to remove stale socket files or
     # we'll get Address in use errors when we try to connect.
-    try:
-        st = os.stat(sockname)
-    except (FileNotFoundError, OSError) as e:
-        # Make sure to create the directory to the socket file.
-        dir_, path = os.path.split(sockname)
-        if dir_:
-            os.makedirs(dir_, exist_ok=True)
-    else:
-        # Only remove the file if it is a unix domain socket file.
-        if stat.S_ISSOCK(st.st_mode):
-            os.unlink(sockname)
-        else:
-            # File exists but is not a socket, don't remove and halt execution!
-            log.error('File %s exists and is not a unix socket. Remove or use alternate filename.', sockname)
-            sys.exit(1)
+    if not selectloop.removestalesocket(sockname):
+        # File exists but is not a socket, don't remove and halt execution!
+        log.error('File %s exists and is not a unix socket. Remove or use alternate filename.', sockname)
+        sys.exit(1)
     run = SelectRunner()
     server = selectloop.StreamServer(address=sockname, family=socket.AF_UNIX, newconn=run.addclient)
     run.go(server)
@@ -28,9 +28,13 @@ class FootShell:
 
     def window_ls(self, args):
         """ List windows. """
-        wins = self.client.getwindowlist(stacking=not args.created)
+        state = self.client.snapshot()
+        wins = [w for w in state['windows'] if w['desktop'] == state['current']]
+        if args.created:
+            order = {wid: i for i, wid in enumerate(state['clients'])}
+            wins.sort(key=lambda w: order.get(w['window'], len(order)))
         for i, win in enumerate(wins):
-            print('{: 2d} "{}"'.format(i, win.name))
+            print('{: 2d} "{}"'.format(i, win['name']))
 
     def window_mv(self, args):
         """ Move window to a different desktop. """
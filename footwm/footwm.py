@@ -8,6 +8,8 @@ Copyright (c) 2016 Akce
 import logging
 
 # Local modules.
+from . import config
+from . import control
 from . import desktop
 from . import display
 from . import window
@@ -17,26 +19,37 @@ import footwm.log
 
 log = footwm.log.make(name=__name__)
 
+# How to answer ConfigureRequests from managed windows. See Foot.handle_configurerequest
+#   wanted: configure the window to the geometry the window manager wants, or send a synthetic ConfigureNotify.
+#   grant:  give the client what it asks for, the window manager then asks for its own geometry in ConfigureNotify.
+configurepolicies = ('wanted', 'grant')
+
 class Foot(object):
 
-    def __init__(self, displayname=None):
-        self.display = display.Display(displayname)
+    def __init__(self, displayname=None, backend='xlib', configurepolicy='wanted'):
+        if configurepolicy not in configurepolicies:
+            raise ValueError('configurepolicy must be one of {}'.format(configurepolicies))
+        self.configurepolicy = configurepolicy
+        self.display = display.opendisplay(displayname, backend=backend)
         log.debug('%s: connect display=%s', self.__class__.__name__, self.display)
         # TODO: worry about screens, displays, xrandr and xinerama!
         self.root = window.WmRoot(self.display, self.display.defaultrootwindow)
-        eventmask = xlib.InputEventMask.PropertyChange |	\
-                    xlib.InputEventMask.StructureNotify |	\
-                    xlib.InputEventMask.SubstructureRedirect |	\
-                    xlib.InputEventMask.SubstructureNotify
-        self.display.install(self.root, eventmask)
+        # Noisy clients can send bursts of ConfigureNotify/PropertyNotify, only act on the latest.
+        self.xwatch = xevent.XWatch(self.display, self.root, self, coalesce=True)
+        self.display.install(self.root, self.root.eventmask & self.xwatch.eventmask)
         # We are now the window manager - continue initialisation.
         log.debug('0x%08x: root %s', self.root.window, self.root)
         # XXX Should we remove WM_ICON_SIZE from root? In case an old WM installed it. See ICCCM 4.1.9
         self.display.logerrors()
-        self.xwatch = xevent.XWatch(self.display, self.root, self)
-        self._desktop = desktop.Desktop(self.display, self.root)
+        self._desktop = desktop.Desktop(self.display, self.root, eventmask=self.xwatch.eventmask)
         self._desktop.redraw()
 
+    def startcontrol(self, sockname, watchers):
+        """ Serve control clients on unix socket sockname. See control module. Returns the server, or None if it
+        couldn't be started. """
+        server = control.ControlServer(sockname, self.display, self.root, self._desktop, watchers)
+        return server if server.start() else None
+
     def handle_clientmessage(self, e):
         try:
             win = self.root.children[e.window]
@@ -45,12 +58,16 @@ class Foot(object):
         self._desktop.handle_clientmessage(e.message_type, e, win=win)
 
     def handle_createnotify(self, e):
-        # New window has been created.
+        # New window has been created. Many are never mapped (toolkit helper windows etc) so only note that it
+        # exists, the window object is made if a MapRequest arrives.
         if not e.override_redirect:
-            self.root.newchild(e.window)
+            self.root.placeholders.add(e.window)
 
     def handle_configurenotify(self, e):
         # This block of code resizes the window if it's still not at the ideal geometry.
+        if e.send_event:
+            # Synthetic, most likely our own reply to a ConfigureRequest. Nothing has actually changed.
+            return
         geom = display.Geometry(e)
         log.debug('0x%08x: ConfigureNotify %s', e.window, geom)
         try:
@@ -68,11 +85,32 @@ class Foot(object):
                 self.display.moveresizewindow(win, wg.x, wg.y, wg.w, wg.h)
 
     def handle_configurerequest(self, e):
+        geom = display.Geometry(e)
+        log.debug('0x%08x: ConfigureRequest parent=0x%08x %s %s', e.window, e.parent, geom, e.value_mask)
+        try:
+            win = self.root.children[e.window]
+        except KeyError:
+            win = None
+        if self.configurepolicy == 'wanted' and win in self._desktop.stacklist:
+            self._answerconfigurerequest(win)
+        else:
+            self._grantconfigurerequest(e)
+
+    def _answerconfigurerequest(self, win):
+        """ Reply to a managed window ConfigureRequest with the geometry that the window manager wants it to have.
+        The client gets a ConfigureNotify either way. See ICCCM 4.1.5 """
+        wg = win.wantedgeom
+        if wg != win.geom and win.configurebackoff.allow():
+            log.debug('0x%08x: ConfigureRequest answered with wanted %s', win.window, wg)
+            self.display.moveresizewindow(win, wg.x, wg.y, wg.w, wg.h)
+        else:
+            log.debug('0x%08x: ConfigureRequest refused, geom stays %s', win.window, win.geom)
+            win.sendconfigurenotify()
+
+    def _grantconfigurerequest(self, e):
         # NOTE: Allow all configure requests, even if their dimensions are not what we want.
         # Most clients get slow and behave weird if they don't get their way, so we'll honour all
         # requests but we'll request the dimensions we want in the callback configure notify handler.
-        geom = display.Geometry(e)
-        log.debug('0x%08x: ConfigureRequest parent=0x%08x %s %s', e.window, e.parent, geom, e.value_mask)
         wc = xlib.XWindowChanges()
         changemask = 0
         if e.value_mask.value & e.value_mask.CWX:
@@ -93,40 +131,50 @@ class Foot(object):
         if changemask:
             self.display.configurewindow(e.window, changemask, wc)
 
+    # Structure events (configure, destroy, map and unmap) come from the root SubstructureNotify only, windows don't
+    # select StructureNotify. So they arrive for every top level window, not only managed ones.
+
     def handle_destroynotify(self, destroywindowevent):
-        # Only handle if the notify event not caused by a sub-structure redirect.
-        if destroywindowevent.event == destroywindowevent.window:
-            try:
-                win = self.root.children[destroywindowevent.window]
-            except KeyError:
-                log.debug('0x%08x: not found in root %s', destroywindowevent.window, self.root)
-            else:
-                self._desktop.unmanagewindow(win)
+        self.root.placeholders.discard(destroywindowevent.window)
+        try:
+            win = self.root.children[destroywindowevent.window]
+        except KeyError:
+            log.debug('0x%08x: not found in root %s', destroywindowevent.window, self.root)
+        else:
+            self._desktop.unmanagewindow(win)
 
     def handle_mapnotify(self, mapevent):
-        # Only handle if the notify event not caused by a sub-structure redirect.
-        if mapevent.event == mapevent.window:
+        win = self.root.children.get(mapevent.window)
+        if win in self._desktop.stacklist:
             # Add a WM_STATE property to the window. See ICCCM 4.1.3.1
-            try:
-                win = self.root.children[mapevent.window]
-            except KeyError:
-                log.error('0x%08x: window not found, cannot set WM_STATE=Normal', mapevent.window)
-            else:
-                win.wm_state = xlib.WmStateState.Normal
+            win.mapped = True
+            win.wm_state = xlib.WmStateState.Normal
 
     def handle_maprequest(self, maprequestevent):
         # A window has requested that it be shown.
         windowid = maprequestevent.window
         try:
-            win = self.root.children[windowid]
+            win = self.root.materialise(windowid)
         except KeyError:
             log.error('0x%08x: MapRequest for unknown window!!!', windowid)
         else:
             self._desktop.managewindow(win)
 
     def handle_propertynotify(self, propertyevent, atomname):
-        """ Property on the root window has changed. """
-        self._desktop.handle_propertynotify(propertyevent.atom)
+        if propertyevent.window == self.root.window:
+            # Property on the root window has changed. Deletes are ignored, they're from consuming the command queue.
+            if propertyevent.state.value == xlib.PropertyState.NewValue:
+                self._desktop.handle_propertynotify(propertyevent.atom)
+        else:
+            # A managed window property has changed, drop the stale value.
+            try:
+                win = self.root.children[propertyevent.window]
+            except KeyError:
+                pass
+            else:
+                win.invalidate(atomname)
+                if atomname in desktop.stateproperties:
+                    self._desktop.windowchanged(win)
 
     def handle_unmapnotify(self, unmapevent):
         if unmapevent.send_event:
@@ -135,14 +183,10 @@ class Foot(object):
             log.debug('0x%08x: Client requests unmap.. calling XUnmapWindow', unmapevent.window)
             self.display.unmapwindow(unmapevent.window)
         else:
-            # Only handle if the notify event not caused by a sub-structure redirect. See man XUnmapEvent
-            if unmapevent.event == unmapevent.window:
-                try:
-                    win = self.root.children[unmapevent.window]
-                except KeyError:
-                    log.error('0x%08x: UnmapRequest for unknown window!!!', unmapevent.window)
-                else:
-                    self._desktop.withdrawwindow(win=win)
+            win = self.root.children.get(unmapevent.window)
+            if win in self._desktop.stacklist:
+                win.mapped = False
+                self._desktop.withdrawwindow(win=win)
 
     def __del__(self):
         self.display = None
@@ -150,18 +194,25 @@ class Foot(object):
 def parseargs():
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['xlib', 'xcb'], default='xlib', help='X display backend. default: %(default)s')
+    parser.add_argument('--configurepolicy', choices=configurepolicies, default=configurepolicies[0], help='How to answer client ConfigureRequests. default: %(default)s')
+    parser.add_argument('--sockname', default=config.getuserconfig(control.SOCKNAME), help='control unix socket filename, empty to disable. default: %(default)s')
     footwm.log.addargs(parser)
     args = parser.parse_args()
     footwm.log.startlogging(modulenames=args.logmodules, levelname=args.loglevel, outfilename=args.logfile)
+    return args
 
 def main():
-    parseargs()
+    args = parseargs()
     try:
-        foot = Foot()
+        foot = Foot(backend=args.backend, configurepolicy=args.configurepolicy)
     except Exception as e:
         log.exception(e)
     else:
         # Flush ensures that our x config has been pushed to the server, and then we can receive events on the X socket.
         # Required now since we don't wait on display.nextevent (which calls flush internally).
         foot.xwatch.flush()
-        xevent.run([foot.xwatch], logfilename='footwmerrors.log')
+        watchers = [foot.xwatch]
+        if args.sockname:
+            foot.startcontrol(args.sockname, watchers)
+        xevent.run(watchers, logfilename='footwmerrors.log')
@@ -21,6 +21,16 @@ def encode_command(cmd, *args, **kwargs):
     s = json.dumps(d)
     return s
 
+def encode_call(callid, cmd, args=(), kwargs=None):
+    """ Encode a python function call that expects a reply. See LocalObject. """
+    d = {
+            'id': callid,
+            'cmd': cmd,
+            'args': args,
+            'kwargs': kwargs or {},
+        }
+    return json.dumps(d)
+
 def make_encode_and_post(funcname, postfunc):
     def encode_and_post(self, *args, **kwargs):
         d = encode_command(funcname, *args, **kwargs)
@@ -42,10 +52,13 @@ class RemoteObject:
             setattr(self, f, functools.partial(make_encode_and_post(f, postfunc), self))
 
 class LocalObject:
-    """ Receive JSON RPC method invocations and pass on to obj(ect). """
+    """ Receive JSON RPC method invocations and pass on to obj(ect).
+    When postfunc is given, calls that include an 'id' are answered with {"id": id, "result": ...} or
+    {"id": id, "error": "..."} """
 
-    def __init__(self, obj):
+    def __init__(self, obj, postfunc=None):
         self._obj = obj
+        self._postfunc = postfunc
 
     def decode_msg_and_call(self, msg):
         """
@@ -59,17 +72,38 @@ class LocalObject:
             # Problem converting msg to json struct.
             log.warn('Could not convert from JSON. data="%s"', msg)
         else:
+            callid = cmddict.get('id')
             try:
                 cmdname = cmddict['cmd']
+                if cmdname.startswith('_'):
+                    # Only public methods may be called.
+                    raise AttributeError(cmdname)
                 method = getattr(self._obj, cmdname)
             except KeyError:
                 # cmd not defined.
                 log.warn("'cmd' key not in JSON cmddict %s", str(list(cmddict.keys())))
+                self._reply(callid, error="'cmd' missing")
             except AttributeError:
                 log.warn('method %s not found in object', cmdname)
+                self._reply(callid, error='unknown method {}'.format(cmdname))
             else:
                 # XXX should args default to [] and kwargs default to {}?
                 args = cmddict.get('args', None)
                 kwargs = cmddict.get('kwargs', None)
-                method(*args, **kwargs)
+                if callid is None or self._postfunc is None:
+                    method(*args, **kwargs)
+                else:
+                    try:
+                        result = method(*args, **kwargs)
+                    except Exception as e:
+                        log.warn('%s failed: %s', cmdname, e)
+                        self._reply(callid, error=str(e))
+                    else:
+                        self._reply(callid, result=result)
         return ret
+
+    def _reply(self, callid, **reply):
+        """ Post the reply to call callid. Calls without an id don't get a reply. """
+        if callid is not None and self._postfunc is not None:
+            reply['id'] = callid
+            self._postfunc(json.dumps(reply))
@@ -5,8 +5,10 @@ Copyright (c) 2014-2016 Akce
 """
 # Python standard modules.
 import errno
+import os
 import select as selectmod
 import socket
+import stat
 import time
 
 # Python local modules.
@@ -14,6 +16,25 @@ from . import log as loghelp
 
 log = loghelp.make(name=__name__)
 
+def removestalesocket(sockname):
+    """ Remove a unix socket file left behind by an earlier server, so binding to sockname won't fail with Address in
+    use. The directory for the socket file is created if needed.
+    Returns False if sockname exists and is not a socket, it's not removed in that case. """
+    try:
+        st = os.stat(sockname)
+    except OSError:
+        # Make sure to create the directory to the socket file.
+        dir_, path = os.path.split(sockname)
+        if dir_:
+            os.makedirs(dir_, exist_ok=True)
+    else:
+        # Only remove the file if it is a unix domain socket file.
+        if stat.S_ISSOCK(st.st_mode):
+            os.unlink(sockname)
+        else:
+            return False
+    return True
+
 class StreamServer(object):
 
     def __init__(self, address=None, family=socket.AF_INET, newconn=None):
@@ -5,20 +5,44 @@ Decorator utilities.
 
 import functools
 
-def memoise(func):
-    results = {}
-    @functools.wraps(func)
-    def memoiser(*args, **kwargs):
-        nonlocal results
-        # kwargs is a dict and can't be hashed. Trialling id as a workaround.
-        key = (args, id(kwargs))
-        if key not in results:
-            result = func(*args, **kwargs)
-            # Only store non None results. Having a problem where
-            # we're memoising a bit too early still so make sure we
-            # only store worthwhile values.
-            if result is not None:
-                results[key] = result
-            #print('memoise: added result {} for key {}'.format(result, key))
-        return results.get(key, None)
-    return memoiser
+# Map of X property name -> cache key. Several properties may share a cache entry, eg WM_NAME and _NET_WM_NAME.
+_cachekeys = {}
+
+# Cache keys of static properties, see cachedproperty.
+_statickeys = set()
+
+def cachekey(propname):
+    """ Return the property cache key for the X property name. """
+    return _cachekeys.get(propname, propname)
+
+def isstatic(propname):
+    """ True if the X property name is read by a static cachedproperty. """
+    return cachekey(propname) in _statickeys
+
+def cachedproperty(*propnames, static=False):
+    """ Make a property whose value is kept in the owning objects _propcache dict.
+
+    propnames are the X property names the getter reads. The first is used as the cache key and a change to any of
+    them should invalidate the entry. See window.Base.invalidate.
+
+    Values are only cached while the object has watchingproperties set, ie it will receive PropertyNotify for the
+    window and can invalidate entries when they change. static properties aren't expected to change over the life of
+    a window so their (non None) values are always cached. """
+    key = propnames[0]
+    for name in propnames:
+        _cachekeys[name] = key
+    if static:
+        _statickeys.add(key)
+    def decorator(func):
+        @functools.wraps(func)
+        def getter(self):
+            cache = self._propcache
+            try:
+                value = cache[key]
+            except KeyError:
+                value = func(self)
+                if self.watchingproperties or (static and value is not None):
+                    cache[key] = value
+            return value
+        return property(getter)
+    return decorator
@@ -38,6 +38,7 @@ eg,
 """
 
 import collections
+import time
 
 from . import command
 from . import display
@@ -104,14 +105,54 @@ def transientsizer(windowgeom, rootgeom, sizehints):
     """ Transient sizer centres position in the available geometry but width/height are unchanged from sizehints. """
     return centregeom(windowgeom, rootgeom, sizehints)
 
+class ConfigureBackoff:
+    """ Limit how often the window manager will reconfigure a window for a client that keeps asking for a geometry
+    it won't get. After retries requests in quick succession, requests are refused for a holdoff time that doubles
+    each time the client keeps going. The client is forgiven once it's been quiet for quiet seconds. """
+
+    def __init__(self, retries=4, quiet=1.0, initial=0.5, maximum=30.0):
+        self.retries = retries
+        self.quiet = quiet
+        self.initial = initial
+        self.maximum = maximum
+        self.count = 0
+        self.backoff = 0.0
+        # monotonic times.
+        self.last = 0.0
+        self.holdoff = 0.0
+
+    def allow(self, now=None):
+        """ Return True if the window may be reconfigured for this request. """
+        now = time.monotonic() if now is None else now
+        if now - self.last > self.quiet:
+            self.count = 0
+            self.backoff = 0.0
+        self.last = now
+        if now < self.holdoff:
+            return False
+        self.count += 1
+        if self.count > self.retries:
+            self.backoff = min(self.backoff * 2 or self.initial, self.maximum)
+            self.holdoff = now + self.backoff
+            self.count = 0
+            return False
+        return True
+
 class Base:
 
-    def __init__(self, display, windowid):
+    def __init__(self, display, windowid, info=None):
+        """ info is an optional display.WindowInfo with prefetched window data. See WmRoot._import_children. """
         super().__init__()
         self.display = display
         self.window = windowid
+        # Cached X property values. dict(cachekey -> value) See utils.cachedproperty.
+        # Start with any properties that were read ahead of time, eg during bulk import.
+        self._propcache = {} if info is None else dict(info.properties)
+        # True when PropertyChange events are selected for this window. ie, property values may be cached.
+        self.watchingproperties = False
         try:
-            self.override_redirect, self.geom, self.map_state = self.display.getwindowattributes(self.window)
+            attributes = self.display.getwindowattributes(self.window) if info is None else info.attributes
+            self.override_redirect, self.geom, self.map_state = attributes
         except (TypeError, ValueError) as e:
             raise WindowError('0x%08x: getwindowattributes failed %s', self.window, e)
 
@@ -120,9 +161,30 @@ class Base:
         #log.debug('0x%08x: Get WM_NAME name=%s status=%d', self.window, name)
         return self.display.getwmname(self)
 
-    def manage(self, eventmask):
+    # Properties that only this client sets, so PropertyNotify for them is just the echo of our own change.
+    ownedproperties = frozenset()
+
+    # The events that this class of window needs. manage selects these unless told otherwise.
+    eventmask = xlib.InputEventMask.NoEvent
+
+    def manage(self, eventmask=None):
+        """ Select eventmask, default is the class eventmask. """
         # watch, maintain, manage, control etc.
+        if eventmask is None:
+            eventmask = self.eventmask
         self.display.selectinput(self, eventmask)
+        self.watchingproperties = bool(eventmask & xlib.InputEventMask.PropertyChange)
+        if not self.watchingproperties:
+            # No way of knowing when cached values go stale anymore.
+            self.clearcache()
+
+    def invalidate(self, propname):
+        """ Forget the cached value for X property propname. Call when a PropertyNotify is received. """
+        if propname not in self.ownedproperties:
+            self._propcache.pop(utils.cachekey(propname), None)
+
+    def clearcache(self):
+        self._propcache.clear()
 
     def __str__(self):
         args = [
@@ -133,13 +195,13 @@ class Base:
                 ]
         # XXX Should abstract this better...
         try:
-            if self.res_name:
-                args.append('res_name="{}"'.format(self.res_name))
+            if self.resourcename:
+                args.append('res_name="{}"'.format(self.resourcename))
         except AttributeError:
             pass
         try:
-            if self.res_class:
-                args.append('res_class="{}"'.format(self.res_class))
+            if self.resourceclass:
+                args.append('res_class="{}"'.format(self.resourceclass))
         except AttributeError:
             pass
         try:
@@ -172,11 +234,17 @@ class Base:
             pass
         return '{}({})'.format(self.__class__.__name__, ' '.join(args))
 
-class WmRoot(ewmh.WmRootMixin, Base):
+class WmRoot(command.WmRootMixin, ewmh.WmRootMixin, Base):
     """ WindowManager-side root window. ie, The WmRoot instance will handle Client -> root-window messages. """
 
+    # SubstructureNotify is the one stream of structure events for all top level windows. See WmWindow.eventmask
+    eventmask = xlib.InputEventMask.PropertyChange | xlib.InputEventMask.StructureNotify | xlib.InputEventMask.SubstructureRedirect | xlib.InputEventMask.SubstructureNotify
+
     def __init__(self, display, windowid):
         super().__init__(display, windowid)
+        # Ids of child windows that have been created but never mapped.
+        # Window objects are only made for these when they're first needed, usually on MapRequest.
+        self.placeholders = set()
         self._import_children()
 
     def newchild(self, windowid):
@@ -186,33 +254,45 @@ class WmRoot(ewmh.WmRootMixin, Base):
         self.children[windowid] = window
         return window
 
+    def materialise(self, windowid):
+        """ Return the child window object, making it from its placeholder if needed.
+        Raises KeyError if windowid is not a known child. """
+        try:
+            return self.children[windowid]
+        except KeyError:
+            self.placeholders.remove(windowid)
+            return self.newchild(windowid)
+
     def _import_children(self):
         """ Import all the children of the root window, regardless of whether they have override_redirect set.
-        The window manager will keep its own managed window lists. """
+        The window manager will keep its own managed window lists.
+        Window data is fetched in bulk up front so that building each window object makes no further requests. """
         self.children = collections.OrderedDict()
-        for windowid in self.display.querytree(self):
-            self.children[windowid] = self._make_window(windowid)
+        for windowid, info in self.display.getwindowinfo(self.display.querytree(self)):
+            self.children[windowid] = self._make_window(windowid, info)
 
-    def _make_window(self, windowid):
+    def _make_window(self, windowid, info=None):
         """ Window object factory method.
         Will handle creating Normal, Transient managed windows. """
-        transientfor = self.display.gettransientfor(windowid)
+        transientfor = self.display.gettransientfor(windowid) if info is None else info.transientfor
         log.debug('0x%08x: transientfor=%s', windowid, transientfor)
         if transientfor is None:
             # Regular window.
-            window = WmNormal(self.display, windowid)
+            window = WmNormal(self.display, windowid, info=info)
         else:
-            window = WmTransient(self.display, windowid, self.children.get(transientfor, None))
+            try:
+                transientwin = self.materialise(transientfor)
+            except KeyError:
+                transientwin = None
+            window = WmTransient(self.display, windowid, transientwin, info=info)
         return window
 
 class WmWindowClientWindow(ewmh.WmWindowClientWindowMixin, Base):
     """ Methods common to both WindowManager windows, and Client windows. """
 
-    def __init__(self, display, windowid):
-        super().__init__(display, windowid)
+    def __init__(self, display, windowid, **kwargs):
+        super().__init__(display, windowid, **kwargs)
         self.wantedgeom = self.geom
-        wm_state = self.wm_state
-        self.res_name, self.res_class = self.wm_class
 
     def _sendclientmessage(self, atom, time_):
         """ Send a ClientMessage event to window. """
@@ -250,41 +330,35 @@ class WmWindowClientWindow(ewmh.WmWindowClientWindowMixin, Base):
         return self.map_state == self.map_state.IsUnmapped
 
     @property
-    @utils.memoise
     def resourcename(self):
         ret, _ = self.wm_class
         return ret
 
     @property
-    @utils.memoise
     def resourceclass(self):
         _, ret = self.wm_class
         return ret
 
-    @property
-    @utils.memoise
+    @utils.cachedproperty('WM_CLASS', static=True)
     def wm_class(self):
         """ WM_CLASS is a tuple of resource name & class. See ICCCM 4.1.2.5 """
         return self.display.getclasshint(self)
 
-    @property
-    @utils.memoise
+    @utils.cachedproperty('WM_CLIENT_MACHINE', static=True)
     def clientmachine(self):
         """ WM_CLIENT_MACHINE """
         return self.display.getwmclientmachine(self)
 
-    @property
-    @utils.memoise
+    @utils.cachedproperty('WM_HINTS', static=True)
     def wmhints(self):
         return self.display.getwmhints(self)
 
-    @property
-    @utils.memoise
+    @utils.cachedproperty('WM_PROTOCOLS', static=True)
     def wm_protocols(self):
         """ Return dict(name -> atom) of ATOMs comprising supported WM_PROTOCOLS for the client window. """
         return self.display.getprotocols(self)
 
-    @property
+    @utils.cachedproperty('WM_STATE')
     def wm_state(self):
         state = self.display.getwmstate(self)
         log.debug('0x%08x: Get WM_STATE state=%s', self.window, state)
@@ -293,21 +367,49 @@ class WmWindowClientWindow(ewmh.WmWindowClientWindowMixin, Base):
 class WmWindow(ewmh.WmWindowMixin, WmWindowClientWindow):
     """ Window functions as needed by the Window Manager. """
 
-    def __init__(self, display, windowid, sizer):
-        super().__init__(display, windowid)
+    # The window manager is the only one that sets these.
+    ownedproperties = frozenset(['WM_STATE', '_NET_WM_DESKTOP'])
+
+    # No StructureNotify. The root selects SubstructureNotify, so the server would send every configure, map, unmap
+    # and destroy event twice.
+    eventmask = xlib.InputEventMask.EnterWindow | xlib.InputEventMask.FocusChange | xlib.InputEventMask.PropertyChange
+
+    def __init__(self, display, windowid, sizer, **kwargs):
+        super().__init__(display, windowid, **kwargs)
         self.sizer = sizer
+        # The window managers view of the map state, used to avoid sending redundant map/unmap requests.
+        # Kept in sync via MapNotify/UnmapNotify for changes the window manager didn't initiate.
+        self.mapped = self.map_state != xlib.MapState.IsUnmapped
+        self.configurebackoff = ConfigureBackoff()
 
-    @property
-    @utils.memoise
+    @utils.cachedproperty('WM_NORMAL_HINTS', static=True)
     def sizehints(self):
         return self.display.getwmnormalhints(self)
 
     def hide(self):
-        self.display.unmapwindow(self.window)
+        if self.mapped:
+            self.mapped = False
+            self.display.unmapwindow(self.window)
 
     def show(self):
-        log.debug('0x%08x: show window=%s', self.window, self)
-        self.display.mapwindow(self)
+        if not self.mapped:
+            log.debug('0x%08x: show window=%s', self.window, self)
+            self.mapped = True
+            self.display.mapwindow(self)
+
+    def sendconfigurenotify(self):
+        """ Send a synthetic ConfigureNotify with the current geometry. ie, tell the client its configure request
+        has been refused. See ICCCM 4.1.5 """
+        ev = xlib.XConfigureEvent()
+        ev.type = xlib.EventName.ConfigureNotify
+        ev.event = self.window
+        ev.window = self.window
+        # Managed windows are root children, so these are already root coordinates.
+        ev.x = self.geom.x
+        ev.y = self.geom.y
+        ev.width = self.geom.w
+        ev.height = self.geom.h
+        return self.display.sendevent(self, ev, xlib.InputEventMask.StructureNotify)
 
     def focus(self):
         # ICCCM 4.1.7 Input Focus
@@ -341,29 +443,35 @@ class WmWindow(ewmh.WmWindowMixin, WmWindowClientWindow):
     def wm_state(self, winstate):
         log.debug('0x%08x: Set WM_STATE state=%s', self.window, xlib.WmStateState(winstate))
         self.display.setwmstate(self, winstate)
+        if self.watchingproperties:
+            self._propcache['WM_STATE'] = winstate
 
     def resize(self, availablegeom):
         """ resize the window given the available geometry area. """
         # Actual geom will be set in the configure notify handler.
-        self.wantedgeom = self.sizer(self.geom, availablegeom, self.sizehints)
-        if self.wantedgeom != self.geom:
-            log.debug('0x%08x: attempt resize %s -> %s', self.window, self.geom, self.wantedgeom)
-            self.display.moveresizewindow(self, self.wantedgeom.x, self.wantedgeom.y, self.wantedgeom.w, self.wantedgeom.h)
-        else:
+        wantedgeom = self.sizer(self.geom, availablegeom, self.sizehints)
+        if wantedgeom == self.geom:
             # Send a synthetic configure notify to the window?
             log.debug('0x%08x: resize do nothing - geom is ideal %s', self.window, self.geom)
+        elif wantedgeom == self.wantedgeom:
+            # The configure notify handler will keep asking for wantedgeom, don't ask twice.
+            log.debug('0x%08x: resize do nothing - already requested %s', self.window, wantedgeom)
+        else:
+            log.debug('0x%08x: attempt resize %s -> %s', self.window, self.geom, wantedgeom)
+            self.display.moveresizewindow(self, wantedgeom.x, wantedgeom.y, wantedgeom.w, wantedgeom.h)
+        self.wantedgeom = wantedgeom
 
 class WmNormal(WmWindow):
 
-    def __init__(self, display, windowid, sizer=honourablemaxsizer):
-        super().__init__(display, windowid, sizer)
+    def __init__(self, display, windowid, sizer=honourablemaxsizer, **kwargs):
+        super().__init__(display, windowid, sizer, **kwargs)
         # The family of windows for a normal window is only itself.
         self.family = [self]
 
 class WmTransient(WmWindow):
 
-    def __init__(self, display, windowid, transientfor):
-        super().__init__(display, windowid, transientsizer)
+    def __init__(self, display, windowid, transientfor, **kwargs):
+        super().__init__(display, windowid, transientsizer, **kwargs)
         self.transientfor = transientfor
         # The family of windows for a transient includes the parent, and potentially, that parents parents etc..
         try:
@@ -376,20 +484,72 @@ class WmTransient(WmWindow):
 
 class ClientRoot(command.ClientRootMixin, ewmh.ClientRootMixin, Base):
 
-    def __init__(self, display, windowid):
+    def __init__(self, display, windowid, mirror=False):
+        """ mirror: Keep root and child window property values in memory, updated by handle_propertynotify. So
+        repeated queries, eg, the stacking list and window desktops, don't need any round trips. """
         super().__init__(display, windowid)
         self.children = collections.OrderedDict()
+        self.mirror = mirror
+        if self.mirror:
+            self.manage(0)
+
+    def manage(self, eventmask=None):
+        if eventmask is None:
+            eventmask = self.eventmask
+        if self.mirror:
+            eventmask |= xlib.InputEventMask.PropertyChange
+        super().manage(eventmask)
 
     def newchild(self, windowid):
         """ Create a new child window. """
-        window = ClientWindow(self.display, windowid)
+        return self._addchild(ClientWindow(self.display, windowid))
+
+    def newchildren(self, windowids):
+        """ Create new child windows in bulk. Windows that have gone away are skipped.
+        Display backends that can pipeline requests fetch what the windows need in one go. """
+        propnames = display.clientproperties
+        if not self.mirror:
+            # Only static values may be cached when nothing will invalidate them, see utils.cachedproperty.
+            propnames = [name for name in propnames if utils.isstatic(name)]
+        for windowid, info in self.display.getclientwindowinfo(windowids, propnames):
+            if not self.mirror:
+                info = info._replace(properties={k: v for k, v in info.properties.items() if v is not None})
+            self._addchild(ClientWindow(self.display, windowid, info=info))
+
+    def _addchild(self, window):
+        if self.mirror:
+            window.manage()
         # Add the window to our child dict.
-        self.children[windowid] = window
+        self.children[window.window] = window
         return window
 
+    def handle_propertynotify(self, propertyevent, atomname):
+        """ Forget the mirrored value of the changed property. """
+        if propertyevent.window == self.window:
+            self.invalidate(atomname)
+            if atomname == '_NET_CLIENT_LIST':
+                self._prunechildren()
+        else:
+            try:
+                win = self.children[propertyevent.window]
+            except KeyError:
+                pass
+            else:
+                win.invalidate(atomname)
+
+    def _prunechildren(self):
+        """ Drop mirrored windows that are no longer managed, they've most likely been destroyed. """
+        managed = frozenset(self.clientlistids)
+        for windowid in [w for w in self.children if w not in managed]:
+            log.debug('0x%08x: forget unmanaged window', windowid)
+            del self.children[windowid]
+
 class ClientWindow(WmWindowClientWindow):
 
-    def __init__(self, display, windowid):
-        super().__init__(display, windowid)
+    # Mirrored windows only need to know about property changes. See ClientRoot.
+    eventmask = xlib.InputEventMask.PropertyChange
+
+    def __init__(self, display, windowid, info=None):
+        super().__init__(display, windowid, info=info)
 
 __all__ = WmRoot, ClientRoot
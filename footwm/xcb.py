@@ -0,0 +1,146 @@
+"""
+Minimal libxcb ctypes interface.
+
+Only the requests that xcbdisplay pipelines are here. The requests are made on the xcb connection underneath an Xlib
+Display, see XGetXCBConnection. libxcb keeps Xlib and xcb requests in order on the shared connection.
+
+Raises ImportError if libxcb or libX11-xcb can't be found.
+
+Copyright (c) 2016 Akce
+"""
+
+import ctypes
+import ctypes.util
+
+from . import xlib
+
+def _load(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise ImportError('lib{} not found'.format(name))
+    return ctypes.CDLL(path)
+
+xcb = _load('xcb')
+x11xcb = _load('X11-xcb')
+# Replies are malloc'd by xcb and must be released with free.
+libc = _load('c')
+
+connection_p = ctypes.c_void_p
+
+class Cookie(ctypes.Structure):
+    """ xcb_get_window_attributes_cookie_t, xcb_get_geometry_cookie_t, xcb_get_property_cookie_t etc. """
+    _fields_ = [
+            ('sequence', ctypes.c_uint),
+            ]
+
+class GenericError(ctypes.Structure):
+    _fields_ = [
+            ('response_type', ctypes.c_uint8),
+            ('error_code', ctypes.c_uint8),
+            ('sequence', ctypes.c_uint16),
+            ('resource_id', ctypes.c_uint32),
+            ('minor_code', ctypes.c_uint16),
+            ('major_code', ctypes.c_uint8),
+            ('pad0', ctypes.c_uint8),
+            ('pad', ctypes.c_uint32 * 5),
+            ('full_sequence', ctypes.c_uint32),
+            ]
+
+genericerror_p = ctypes.POINTER(GenericError)
+
+class GetWindowAttributesReply(ctypes.Structure):
+    _fields_ = [
+            ('response_type', ctypes.c_uint8),
+            ('backing_store', ctypes.c_uint8),
+            ('sequence', ctypes.c_uint16),
+            ('length', ctypes.c_uint32),
+            ('visual', ctypes.c_uint32),
+            ('_class', ctypes.c_uint16),
+            ('bit_gravity', ctypes.c_uint8),
+            ('win_gravity', ctypes.c_uint8),
+            ('backing_planes', ctypes.c_uint32),
+            ('backing_pixel', ctypes.c_uint32),
+            ('save_under', ctypes.c_uint8),
+            ('map_is_installed', ctypes.c_uint8),
+            ('map_state', ctypes.c_uint8),
+            ('override_redirect', ctypes.c_uint8),
+            ('colormap', ctypes.c_uint32),
+            ('all_event_masks', ctypes.c_uint32),
+            ('your_event_mask', ctypes.c_uint32),
+            ('do_not_propagate_mask', ctypes.c_uint16),
+            ('pad0', ctypes.c_uint8 * 2),
+            ]
+
+class GetGeometryReply(ctypes.Structure):
+    _fields_ = [
+            ('response_type', ctypes.c_uint8),
+            ('depth', ctypes.c_uint8),
+            ('sequence', ctypes.c_uint16),
+            ('length', ctypes.c_uint32),
+            ('root', ctypes.c_uint32),
+            ('x', ctypes.c_int16),
+            ('y', ctypes.c_int16),
+            ('width', ctypes.c_uint16),
+            ('height', ctypes.c_uint16),
+            ('border_width', ctypes.c_uint16),
+            ('pad0', ctypes.c_uint8 * 2),
+            ]
+
+class GetPropertyReply(ctypes.Structure):
+    _fields_ = [
+            ('response_type', ctypes.c_uint8),
+            ('format', ctypes.c_uint8),
+            ('sequence', ctypes.c_uint16),
+            ('length', ctypes.c_uint32),
+            ('type', ctypes.c_uint32),
+            ('bytes_after', ctypes.c_uint32),
+            ('value_len', ctypes.c_uint32),
+            ('pad0', ctypes.c_uint8 * 12),
+            ]
+
+getwindowattributesreply_p = ctypes.POINTER(GetWindowAttributesReply)
+getgeometryreply_p = ctypes.POINTER(GetGeometryReply)
+getpropertyreply_p = ctypes.POINTER(GetPropertyReply)
+
+# xcb_connection_t *XGetXCBConnection(Display *dpy);
+x11xcb.XGetXCBConnection.restype = connection_p
+x11xcb.XGetXCBConnection.argtypes = xlib.display_p,
+
+# xcb_get_window_attributes_cookie_t xcb_get_window_attributes(xcb_connection_t *c, xcb_window_t window);
+xcb.xcb_get_window_attributes.restype = Cookie
+xcb.xcb_get_window_attributes.argtypes = connection_p, ctypes.c_uint32
+
+# xcb_get_window_attributes_reply_t *xcb_get_window_attributes_reply(xcb_connection_t *c, xcb_get_window_attributes_cookie_t cookie, xcb_generic_error_t **e);
+xcb.xcb_get_window_attributes_reply.restype = getwindowattributesreply_p
+xcb.xcb_get_window_attributes_reply.argtypes = connection_p, Cookie, ctypes.POINTER(genericerror_p)
+
+# xcb_get_geometry_cookie_t xcb_get_geometry(xcb_connection_t *c, xcb_drawable_t drawable);
+xcb.xcb_get_geometry.restype = Cookie
+xcb.xcb_get_geometry.argtypes = connection_p, ctypes.c_uint32
+
+# xcb_get_geometry_reply_t *xcb_get_geometry_reply(xcb_connection_t *c, xcb_get_geometry_cookie_t cookie, xcb_generic_error_t **e);
+xcb.xcb_get_geometry_reply.restype = getgeometryreply_p
+xcb.xcb_get_geometry_reply.argtypes = connection_p, Cookie, ctypes.POINTER(genericerror_p)
+
+# xcb_get_property_cookie_t xcb_get_property(xcb_connection_t *c, uint8_t _delete, xcb_window_t window, xcb_atom_t property, xcb_atom_t type, uint32_t long_offset, uint32_t long_length);
+xcb.xcb_get_property.restype = Cookie
+xcb.xcb_get_property.argtypes = connection_p, ctypes.c_uint8, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32
+
+# xcb_get_property_reply_t *xcb_get_property_reply(xcb_connection_t *c, xcb_get_property_cookie_t cookie, xcb_generic_error_t **e);
+xcb.xcb_get_property_reply.restype = getpropertyreply_p
+xcb.xcb_get_property_reply.argtypes = connection_p, Cookie, ctypes.POINTER(genericerror_p)
+
+# void *xcb_get_property_value(const xcb_get_property_reply_t *R);
+xcb.xcb_get_property_value.restype = ctypes.c_void_p
+xcb.xcb_get_property_value.argtypes = getpropertyreply_p,
+
+# int xcb_get_property_value_length(const xcb_get_property_reply_t *R);
+xcb.xcb_get_property_value_length.restype = ctypes.c_int
+xcb.xcb_get_property_value_length.argtypes = getpropertyreply_p,
+
+# int xcb_flush(xcb_connection_t *c);
+xcb.xcb_flush.restype = ctypes.c_int
+xcb.xcb_flush.argtypes = connection_p,
+
+libc.free.restype = None
+libc.free.argtypes = ctypes.c_void_p,
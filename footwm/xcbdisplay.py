@@ -0,0 +1,190 @@
+"""
+Xlib Display with bulk requests pipelined through xcb.
+
+Xlib calls block until their reply arrives, so reading N properties costs
+N round trips. XcbDisplay is an Xlib Display that makes its bulk
+requests (see getwindowinfo and getclientwindowinfo) with xcb on the same
+connection instead. All the requests are sent, then all the replies are
+collected, so the whole batch costs one round trip. That matters most on
+slow links, eg remote or ssh forwarded displays.
+
+Everything else is inherited from the Xlib Display.
+
+Use with display.opendisplay(backend='xcb').
+
+Copyright (c) 2016 Akce
+"""
+
+import ctypes
+import sys
+
+from . import display
+from . import log as logmodule
+from . import xcb
+from . import xlib
+
+log = logmodule.make(name=__name__)
+
+# In 32 bit units. Large enough for any text property.
+_textlength = 1 << 24
+
+class XcbDisplay(display.Display):
+
+    def _connect(self):
+        super()._connect()
+        # Owned by the Xlib display, it's closed with it.
+        self.xc = xcb.x11xcb.XGetXCBConnection(self.xh)
+
+    def _init_atoms(self):
+        super()._init_atoms()
+        # Atoms used in pipelined requests, they must be interned before the requests are made.
+        self.add_atoms(['WM_CLASS', 'WM_CLIENT_MACHINE', 'WM_NAME', 'WM_STATE', 'WM_TRANSIENT_FOR', '_NET_WM_DESKTOP', '_NET_WM_NAME'])
+
+    def _pipeline(self, count):
+        """ Account for count requests whose replies will all be collected in one round trip. """
+        self.atom.intern()
+        self.requests.direct(count)
+        self.roundtrips += 1
+
+    def _getproperty(self, windowid, propname, type_=xlib.AnyPropertyType, length=_textlength):
+        """ Send a GetProperty request, returns the cookie. See _propertyreply. """
+        return xcb.xcb.xcb_get_property(self.xc, 0, windowid, self.atom[propname], type_, 0, length)
+
+    def _reply(self, replyfunc, cookie):
+        """ Return a pointer to the reply for cookie, or None if the request failed. The reply must be freed. """
+        error = xcb.genericerror_p()
+        reply = replyfunc(self.xc, cookie, ctypes.byref(error))
+        if error:
+            log.debug('xcb request failed: sequence=%d error_code=%d resource_id=0x%08x', cookie.sequence, error.contents.error_code, error.contents.resource_id)
+            xcb.libc.free(error)
+        return reply or None
+
+    def _propertyreply(self, cookie):
+        """ Return (type-atom, format, bytes) for the GetProperty cookie, or None if the property isn't set. """
+        ret = None
+        reply = self._reply(xcb.xcb.xcb_get_property_reply, cookie)
+        if reply is not None:
+            if reply.contents.format:
+                data = ctypes.string_at(xcb.xcb.xcb_get_property_value(reply), xcb.xcb.xcb_get_property_value_length(reply))
+                ret = reply.contents.type, reply.contents.format, data
+            xcb.libc.free(reply)
+        return ret
+
+    def _attributesrequest(self, windowid):
+        """ Send the requests for getwindowattributes. Returns the cookies for _attributesreply. """
+        return xcb.xcb.xcb_get_window_attributes(self.xc, windowid), xcb.xcb.xcb_get_geometry(self.xc, windowid)
+
+    def _attributesreply(self, windowid, cookies):
+        """ Return the same as getwindowattributes. """
+        attrcookie, geomcookie = cookies
+        ret = None
+        attrs = self._reply(xcb.xcb.xcb_get_window_attributes_reply, attrcookie)
+        geom = self._reply(xcb.xcb.xcb_get_geometry_reply, geomcookie)
+        if attrs is not None and geom is not None:
+            ret = bool(attrs.contents.override_redirect), display.Geometry(geom.contents), attrs.contents.map_state
+        else:
+            log.debug('0x%08x: GetWindowAttributes failed', windowid)
+        for reply in (attrs, geom):
+            if reply is not None:
+                xcb.libc.free(reply)
+        return ret
+
+    def getwindowinfo(self, windowids):
+        """ As Display.getwindowinfo, but in one round trip. The transient hint and WM_STATE are requested for every
+        window and the replies that aren't needed are dropped, it's cheaper than waiting to find out. """
+        wmstate = self.atom['WM_STATE']
+        self._pipeline(4 * len(windowids))
+        cookies = [(wid, self._attributesrequest(wid), self._getproperty(wid, 'WM_TRANSIENT_FOR', xlib.XA.WINDOW, 1), self._getproperty(wid, 'WM_STATE', wmstate, 2)) for wid in windowids]
+        infos = []
+        for wid, attrcookies, transientcookie, statecookie in cookies:
+            # Every reply is collected, xcb would otherwise hold them forever.
+            attributes = self._attributesreply(wid, attrcookies)
+            transientprop = self._propertyreply(transientcookie)
+            stateprop = self._propertyreply(statecookie)
+            if attributes is None:
+                continue
+            override_redirect, _, map_state = attributes
+            transientfor = None
+            properties = {}
+            if not override_redirect:
+                transientfor = _cardinal(transientprop)
+                if map_state != xlib.MapState.IsViewable:
+                    state = _cardinal(stateprop)
+                    properties['WM_STATE'] = None if state is None else display.wmstatestate(wid, state)
+            infos.append((wid, display.WindowInfo(attributes, transientfor, properties)))
+        return infos
+
+    def getclientwindowinfo(self, windowids, propnames=()):
+        """ As Display.getclientwindowinfo, with the propnames properties read ahead in the same round trip. """
+        # Properties requested for each of propnames, and how their values are made from the replies.
+        readers = {
+                '_NET_WM_NAME':         (('_NET_WM_NAME', 'WM_NAME'), self._name),
+                '_NET_WM_DESKTOP':      (('_NET_WM_DESKTOP',), _cardinal),
+                'WM_CLASS':             (('WM_CLASS',), _classhint),
+                'WM_CLIENT_MACHINE':    (('WM_CLIENT_MACHINE',), self._clientmachine),
+                }
+        try:
+            wanted = [(name,) + readers[name] for name in propnames]
+        except KeyError as e:
+            raise display.DisplayError('{} can not be read ahead'.format(e))
+        self._pipeline(len(windowids) * (2 + sum(len(props) for _, props, _ in wanted)))
+        cookies = []
+        for wid in windowids:
+            propcookies = [[self._getproperty(wid, p) for p in props] for _, props, _ in wanted]
+            cookies.append((wid, self._attributesrequest(wid), propcookies))
+        infos = []
+        for wid, attrcookies, propcookies in cookies:
+            attributes = self._attributesreply(wid, attrcookies)
+            properties = {}
+            for (name, _, reader), pcookies in zip(wanted, propcookies):
+                properties[name] = reader(*[self._propertyreply(c) for c in pcookies])
+            if attributes is not None:
+                infos.append((wid, display.WindowInfo(attributes, None, properties)))
+        return infos
+
+    def _textlines(self, prop):
+        """ Like textprop_to_lines, for a GetProperty reply. """
+        lines = []
+        if prop is not None:
+            type_, format_, data = prop
+            if type_ == xlib.XA.STRING:
+                # ICCCM 2.7.1 - XA_STRING == latin-1 encoding.
+                enc = 'latin1'
+            elif type_ == self.atom['UTF8_STRING']:
+                enc = 'utf8'
+            else:
+                enc = None
+            if enc and format_ == 8 and data:
+                lines = [str(x, enc, 'replace') for x in data.split(b'\0')]
+                if data.endswith(b'\0'):
+                    # Trailing terminator, not an empty last line.
+                    lines.pop()
+        return lines
+
+    def _name(self, netwmname, wmname):
+        """ ewmh window name: _NET_WM_NAME, falling back to WM_NAME. """
+        lines = self._textlines(netwmname) or self._textlines(wmname)
+        return lines[0] if lines else None
+
+    def _clientmachine(self, prop):
+        lines = self._textlines(prop)
+        return lines[0] if lines else ''
+
+    def __str__(self):
+        return 'XcbDisplay({})'.format(self.displayname)
+
+def _cardinal(prop):
+    """ The first value of a format 32 property, or None. """
+    if prop is not None:
+        _, format_, data = prop
+        if format_ == 32 and len(data) >= 4:
+            return int.from_bytes(data[:4], sys.byteorder)
+    return None
+
+def _classhint(prop):
+    """ Like Display.getclasshint, ie (res_name, res_class). WM_CLASS is a STRING property, so Latin-1. """
+    if prop is None:
+        return "", ""
+    _, _, data = prop
+    parts = [str(x, 'latin1') for x in data.split(b'\0')]
+    return parts[0], parts[1] if len(parts) > 1 else ''
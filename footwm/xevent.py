@@ -3,6 +3,8 @@ Simple xevent generator.
 
 Copyright (c) 2016 Akce
 """
+import operator
+
 from . import log as logger
 from . import selectloop
 from . import xlib
@@ -10,6 +12,8 @@ from . import xlib
 log = logger.make(name=__name__)
 
 def run(watchers, logfilename):
+    """ Dispatch events from watchers, objects with fileno and dispatchevent methods.
+    Watchers may add to, or remove from, the watchers list while dispatching. See control.ControlServer """
     # Setup a local logger that is always available so that we can catch unhandled exceptions.
     elog = logger.make(name='applog', levelname='error', outfilename=logfilename)
     while True:
@@ -20,28 +24,81 @@ def run(watchers, logfilename):
         except Exception as e:
             elog.exception(e)
 
+def coalesceevents(events):
+    """ Return events without those superseded by a later event in the list.
+    Only the latest ConfigureNotify per window, and the latest PropertyNotify per window/atom pair, are kept. Those
+    handlers only care about the current geometry or property value, which is what the latest event tells them. """
+    seen = set()
+    kept = []
+    # Walk backwards so that the latest event for each key is the one kept.
+    for event in reversed(events):
+        if event.type == xlib.EventName.ConfigureNotify:
+            key = (event.type, event.xconfigure.event, event.xconfigure.window)
+        elif event.type == xlib.EventName.PropertyNotify:
+            key = (event.type, event.xproperty.window, event.xproperty.atom)
+        else:
+            key = None
+        if key is None or key not in seen:
+            seen.add(key)
+            kept.append(event)
+    kept.reverse()
+    if len(kept) != len(events):
+        log.debug('coalesceevents: received=%d dispatched=%d', len(events), len(kept))
+    return kept
+
+# Events that XWatch dispatches. dict(event type -> (callback method, XEvent union member passed to it, event mask
+# that selects the event)). The whole XEvent is passed when the member is None. A mask of 0 is for events that are
+# always sent. Structure events are selected by StructureNotify on the window or SubstructureNotify on its parent.
+_structure = xlib.InputEventMask.StructureNotify | xlib.InputEventMask.SubstructureNotify
+eventtable = {
+        xlib.EventName.ClientMessage:       ('handle_clientmessage', 'xclient', 0),
+        xlib.EventName.CreateNotify:        ('handle_createnotify', 'xcreatewindow', xlib.InputEventMask.SubstructureNotify),
+        xlib.EventName.ConfigureNotify:     ('handle_configurenotify', 'xconfigure', _structure),
+        xlib.EventName.ConfigureRequest:    ('handle_configurerequest', 'xconfigurerequest', xlib.InputEventMask.SubstructureRedirect),
+        xlib.EventName.DestroyNotify:       ('handle_destroynotify', 'xdestroywindow', _structure),
+        xlib.EventName.EnterNotify:         ('handle_enternotify', 'xany', xlib.InputEventMask.EnterWindow),
+        xlib.EventName.FocusIn:             ('handle_focusin', 'xfocus', xlib.InputEventMask.FocusChange),
+        xlib.EventName.FocusOut:            ('handle_focusout', 'xfocus', xlib.InputEventMask.FocusChange),
+        xlib.EventName.KeyPress:            ('handle_keypress', 'xkey', xlib.InputEventMask.KeyPress),
+        xlib.EventName.MapNotify:           ('handle_mapnotify', 'xmap', _structure),
+        xlib.EventName.MapRequest:          ('handle_maprequest', 'xmaprequest', xlib.InputEventMask.SubstructureRedirect),
+        xlib.EventName.MappingNotify:       ('handle_mappingnotify', None, 0),
+        xlib.EventName.PropertyNotify:      ('handle_propertynotify', 'xproperty', xlib.InputEventMask.PropertyChange),
+        xlib.EventName.UnmapNotify:         ('handle_unmapnotify', 'xunmap', _structure),
+        }
+
 class XWatch:
 
-    def __init__(self, display, root, callback):
+    def __init__(self, display, root, callback, coalesce=False):
+        """ coalesce: Drop events superseded by later events in the same queue read. See coalesceevents. """
         self.display = display
         self.root = root
         self.callback = callback
-        self.eventhandlers = {
-                xlib.EventName.ClientMessage:       self.handle_clientmessage,
-                xlib.EventName.CreateNotify:        self.handle_createnotify,
-                xlib.EventName.ConfigureNotify:     self.handle_configurenotify,
-                xlib.EventName.ConfigureRequest:    self.handle_configurerequest,
-                xlib.EventName.DestroyNotify:       self.handle_destroynotify,
-                xlib.EventName.EnterNotify:         self.handle_enternotify,
-                xlib.EventName.FocusIn:             self.handle_focusin,
-                xlib.EventName.FocusOut:            self.handle_focusout,
-                xlib.EventName.KeyPress:            self.handle_keypress,
-                xlib.EventName.MapNotify:           self.handle_mapnotify,
-                xlib.EventName.MapRequest:          self.handle_maprequest,
-                xlib.EventName.MappingNotify:       self.handle_mappingnotify,
-                xlib.EventName.PropertyNotify:      self.handle_propertynotify,
-                xlib.EventName.UnmapNotify:         self.handle_unmapnotify,
-            }
+        self.coalesce = coalesce
+        # dict(event type -> function(event)), only for the events that callback has a handler for.
+        self.eventhandlers = {}
+        # The events that callback handles. Selecting anything else only makes events that would be dropped.
+        self.eventmask = 0
+        for eventtype, (methodname, member, mask) in eventtable.items():
+            handler = getattr(callback, methodname, None)
+            if handler is not None:
+                self.eventhandlers[eventtype] = self._makehandler(eventtype, handler, member)
+                self.eventmask |= mask
+        log.debug('%s: handled events=%s eventmask=%s', callback.__class__.__name__,
+                sorted(eventtable[t][0] for t in self.eventhandlers), xlib.InputEventMask(self.eventmask))
+
+    def _makehandler(self, eventtype, handler, member):
+        """ Return function(event) that calls handler with the event union member. """
+        if eventtype == xlib.EventName.PropertyNotify:
+            atomname = self.display.atom.name
+            def propertynotify(event):
+                e = event.xproperty
+                handler(e, atomname(e.atom))
+            return propertynotify
+        if member is None:
+            return handler
+        getmember = operator.attrgetter(member)
+        return lambda event: handler(getmember(event))
 
     def fileno(self):
         """ For select.select. """
@@ -52,98 +109,30 @@ class XWatch:
 
     def dispatchevent(self):
         log.debug('dispatchevent called')
-        while self.display.pendingevents:
-            event = self.display.nextevent
-            e = xlib.EventName(event.type)
-            log.debug('dispatchevent: %s', e)
-            try:
-                handler = self.eventhandlers[e.value]
-                handler(event)
-            except KeyError:
-                log.warn('XWatch unhandled event %s', e)
-            except AttributeError:
-                log.warn('XWatch.callback unhandled event %s', e)
-
-    def handle_clientmessage(self, event):
-        e = event.xclient
-        try:
-            msg = self.display.atom[e.message_type]
-        except KeyError:
-            msg = self.display.getatomname(e.message_type)
-        log.debug('0x%08x: handle_clientmessage msgid=%d name=%s', e.window, e.message_type, msg)
-        self.callback.handle_clientmessage(e)
-
-    def handle_createnotify(self, event):
-        # New window has been created.
-        e = event.xcreatewindow
-        log.debug('0x%08x: CreateNotify parent=0x%08x override_redirect=%s', e.window, e.parent, e.override_redirect)
-        self.callback.handle_createnotify(e)
-
-    def handle_configurenotify(self, event):
-        # The X server has moved and/or resized window e.window
-        e = event.xconfigure
-        log.debug('0x%08x: ConfigureNotify event=0x%08x', e.window, e.event)
-        self.callback.handle_configurenotify(e)
-
-    def handle_configurerequest(self, event):
-        # Some other client tried to reconfigure e.window
-        e = event.xconfigurerequest
-        log.debug('0x%08x: ConfigureRequest %s', e.window, e.value_mask)
-        self.callback.handle_configurerequest(e)
-
-    def handle_destroynotify(self, event):
-        # Window has been destroyed.
-        e = event.xdestroywindow
-        log.debug('0x%08x: DestroyNotify event=0x%08x', e.window, e.event)
-        self.callback.handle_destroynotify(e)
-
-    def handle_enternotify(self, event):
-        #e = event.xcrossing
-        log.debug('0x%08x: EnterNotify', event.xany.window)
-        self.callback.handle_enternotify(event.xany)
-
-    def handle_focusin(self, event):
-        e = event.xfocus
-        log.debug('0x%08x: focusin mode=%s detail=%s', e.window, e.mode, e.detail)
-        self.callback.handle_focusin(e)
-
-    def handle_focusout(self, event):
-        e = event.xfocus
-        log.debug('0x%08x: focusout mode=%s detail=%s', e.window, e.mode, e.detail)
-        self.callback.handle_focusout(e)
-
-    def handle_keypress(self, event):
-        e = event.xkey
-        log.debug('0x%08x: handle_keypress keycode=0x%x modifiers=%s', e.window, e.keycode, e.state.value)
-        self.callback.handle_keypress(e)
-
-    def handle_mapnotify(self, event):
-        # Server has displayed the window.
-        e = event.xmap
-        log.debug('0x%08x: MapNotify event=0x%08x override_redirect=%s', e.window, e.event, e.override_redirect)
-        self.callback.handle_mapnotify(e)
-
-    def handle_maprequest(self, event):
-        # A window has requested that it be shown.
-        e = event.xmaprequest
-        log.debug('0x%08x: MapRequest', e.window)
-        self.callback.handle_maprequest(e)
-
-    def handle_mappingnotify(self, event):
-        self.callback.handle_mappingnotify(event)
-
-    def handle_propertynotify(self, event):
-        e = event.xproperty
-        for k, v in self.display.atom.items():
-            if v == e.atom:
-                atomname = k
-                break
+        # Requests made by the handlers are coalesced and sent with one flush at the end of the cycle.
+        with self.display.batch():
+            if self.coalesce:
+                # Handlers may read more events off the connection, so keep going until the queue is empty.
+                events = self._drainevents()
+                while events:
+                    for event in events:
+                        self._dispatch(event)
+                    events = self._drainevents()
+            else:
+                while self.display.queuedevents:
+                    self._dispatch(self.display.nextevent)
+
+    def _drainevents(self):
+        events = []
+        while self.display.queuedevents:
+            # Copy as display.nextevent reuses the same event structure.
+            events.append(xlib.XEvent.from_buffer_copy(self.display.nextevent))
+        return coalesceevents(events)
+
+    def _dispatch(self, event):
+        handler = self.eventhandlers.get(event.type)
+        if handler is None:
+            # Only events that are always sent, or that something else selected, get here. eg, MappingNotify.
+            log.debug('XWatch unhandled event %s', xlib.EventName(event.type))
         else:
-            atomname = None
-        log.debug('0x%08x: PropertyNotify %s:%d send_event=%s', e.window, atomname, e.atom, e.send_event)
-        self.callback.handle_propertynotify(e, atomname)
-
-    def handle_unmapnotify(self, event):
-        e = event.xunmap
-        log.debug('0x%08x: UnmapNotify', e.window)
-        self.callback.handle_unmapnotify(e)
+            handler(event)
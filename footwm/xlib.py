@@ -10,6 +10,7 @@ import ctypes.util
 # Resource constants X.h
 PointerRoot = 1
 CurrentTime = 0
+AnyPropertyType = 0
 
 class EnumMixin(object):
 
@@ -165,6 +166,8 @@ xlib.XInternAtom.restype = Atom
 xlib.XInternAtom.argtypes = display_p, ctypes.c_char_p, Bool
 
 # Status XInternAtoms(Display *display, char **names, int count, Bool only_if_exists, Atom *atoms_return);
+xlib.XInternAtoms.restype = Status
+xlib.XInternAtoms.argtypes = display_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_int, Bool, atom_p
 
 # char *XGetAtomName(Display *display, Atom atom);
 xlib.XGetAtomName.restype = ctypes.c_char_p
@@ -198,6 +201,14 @@ xlib.XSync.argtypes = display_p, Bool
 # int XPending(Display *display);
 xlib.XPending.argtypes = display_p,
 
+# XEventsQueued modes. See Xlib.h
+QueuedAlready = 0
+QueuedAfterReading = 1
+QueuedAfterFlush = 2
+
+# int XEventsQueued(Display *display, int mode);
+xlib.XEventsQueued.argtypes = display_p, ctypes.c_int
+
 # int XFlush(Display *display);
 xlib.XFlush.argtypes = display_p,
 
@@ -497,6 +508,9 @@ class InputEventMask(ctypes.c_long, metaclass=BitmapMetaMaker(ctypes.c_long)):
 # int XMaskEvent(Display *display, long event_mask, XEvent *event_return);
 xlib.XMaskEvent.argtypes = display_p, InputEventMask, xevent_p
 
+# Bool XCheckWindowEvent(Display *display, Window w, long event_mask, XEvent *event_return);
+xlib.XCheckWindowEvent.argtypes = display_p, Window, InputEventMask, xevent_p
+
 # Status XSendEvent(Display *display, Window w, Bool propagate, long event_mask, XEvent *event_send);
 xlib.XSendEvent.restype = Status
 xlib.XSendEvent.argtypes = display_p, Window, Bool, InputEventMask, xevent_p